@@ -0,0 +1,143 @@
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+
+class AuthCache:
+    """
+    Cache of authorization checks of requests authenticated by username
+    and password. Verified credentials and permission checks are kept per
+    user, least recently used users are evicted when there are more than
+    max_users of them. Changes of ownership or sharing invalidate only the
+    entries of the affected user and file.
+    Only successful credential verifications are cached, passwords are
+    kept as keyed digests, not in plain text.
+    """
+
+    def __init__(self, max_users=4096) -> None:
+        """
+        :param max_users: limit of users with cached entries
+        :type max_users: int
+        """
+        self.max_users = max_users
+        # credential digest and permissions by (owner, filename) per user
+        self.__users: OrderedDict[str, Tuple[bytes or None,
+                                             Dict[tuple, bool]]] = \
+            OrderedDict()
+        self.__key = os.urandom(32)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def check_credentials(self, username, password) -> bool:
+        """
+        :type username: str
+        :type password: str
+        :return: True if credentials were verified before
+        """
+        entry = self.__users.get(username)
+        if entry is not None and entry[0] is not None and \
+                hmac.compare_digest(entry[0], self.__digest(password)):
+            self.__touch(username)
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add_credentials(self, username, password) -> None:
+        """
+        Remember successfully verified credentials
+        :type username: str
+        :type password: str
+        """
+        _, permissions = self.__entry(username)
+        self.__users[username] = (self.__digest(password), permissions)
+
+    def get_permission(self, username, owner, filename) -> bool or None:
+        """
+        :type username: str
+        :type owner: str
+        :type filename: str
+        :return: cached permission, None if it is not cached
+        """
+        entry = self.__users.get(username)
+        allowed = None if entry is None else entry[1].get((owner, filename))
+        if allowed is None:
+            self.misses += 1
+        else:
+            self.__touch(username)
+            self.hits += 1
+        return allowed
+
+    def add_permission(self, username, owner, filename, allowed) -> None:
+        """
+        :type username: str
+        :type owner: str
+        :type filename: str
+        :type allowed: bool
+        """
+        self.__entry(username)[1][(owner, filename)] = allowed
+
+    def invalidate(self, username, filename=None) -> None:
+        """
+        Drop cached permissions of user, only the ones of the file if it
+        is specified. Credentials stay cached.
+        :type username: str
+        :type filename: str
+        """
+        entry = self.__users.get(username)
+        if entry is None:
+            return
+        permissions = entry[1]
+        for key in [key for key in permissions
+                    if filename is None or key[1] == filename]:
+            del permissions[key]
+            self.invalidations += 1
+
+    def forget(self, username) -> None:
+        """
+        Drop all cached entries of user
+        :type username: str
+        """
+        self.__users.pop(username, None)
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """
+        :return: number of cached users, hits, misses, hit rate,
+        invalidated permissions and evicted users
+        """
+        return {"users": len(self.__users), "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hit_rate,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions}
+
+    def __entry(self, username) -> Tuple[bytes or None, Dict[tuple, bool]]:
+        """
+        Get entry of user, create it and evict least recently used users
+        if there is none
+        :type username: str
+        """
+        entry = self.__users.get(username)
+        if entry is None:
+            entry = self.__users[username] = (None, {})
+            while len(self.__users) > self.max_users:
+                self.__users.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.__touch(username)
+        return entry
+
+    def __touch(self, username) -> None:
+        self.__users.move_to_end(username)
+
+    def __digest(self, password) -> bytes:
+        return hmac.new(self.__key, password.encode("utf-8"),
+                        hashlib.sha256).digest()
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from file_service import FileService
+
+
+class AutosaveScheduler:
+    """
+    Periodically saves dirty documents of FileService in the background.
+    Any number of changes of a document between two rounds results in
+    a single save, files are written in a pool of max_concurrent threads,
+    so disk latency never blocks the event loop. A save writes only the
+    text of the document, its patch log is truncated afterwards.
+    """
+
+    def __init__(self, file_service, interval=5.0, max_concurrent=2) -> None:
+        """
+        :param interval: seconds between autosave rounds
+        :param max_concurrent: limit of files written at once
+        :type file_service: FileService
+        :type interval: float
+        :type max_concurrent: int
+        """
+        self.file_service = file_service
+        self.interval = interval
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.rounds = 0
+        self.failed = 0
+        self.__task: asyncio.Task or None = None
+
+    def start(self, loop=None) -> None:
+        """
+        Start autosave task
+        :param loop: event loop to run the task in, current one if None
+        :type loop: asyncio.AbstractEventLoop
+        """
+        loop = loop or asyncio.get_event_loop()
+        self.__task = loop.create_task(self.__run())
+
+    async def stop(self) -> None:
+        """
+        Stop autosave task and save all dirty documents
+        """
+        if self.__task is not None:
+            self.__task.cancel()
+            try:
+                await self.__task
+            except asyncio.CancelledError:
+                pass
+            self.__task = None
+        await self.save_dirty()
+        self.executor.shutdown()
+
+    async def save_dirty(self) -> int:
+        """
+        Save all dirty documents. A document that fails to save is
+        logged and left dirty, other documents are saved anyway.
+        :return: number of documents that failed to save
+        """
+        dirty = list(self.file_service.dirty)
+        results = await asyncio.gather(*[
+            self.file_service.save_document(file_id, self.executor)
+            for file_id in dirty], return_exceptions=True)
+        for file_id, result in zip(dirty, results):
+            if isinstance(result, Exception):
+                logging.info(f"Failed to autosave {file_id}",
+                             exc_info=result)
+        failed = sum(result is not True for result in results)
+        self.rounds += 1
+        self.failed += failed
+        if dirty:
+            logging.info(f"Autosaved {len(dirty) - failed} of {len(dirty)} "
+                         f"dirty files")
+        return failed
+
+    async def __run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save_dirty()
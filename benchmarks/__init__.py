@@ -0,0 +1,4 @@
+"""
+Performance benchmarks. Run every benchmark as a module from the repository
+root, e.g. ``python -m benchmarks.bench_broadcast``
+"""
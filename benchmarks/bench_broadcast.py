@@ -0,0 +1,81 @@
+"""
+Broadcast latency of ClientHandler.handle_new_patch depending on the total
+number of connections and on the size of the room receiving the patch.
+The legacy column scans a flat list of all connections, as the handler did
+before rooms were introduced.
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from client_handler import ClientHandler
+from file_service import FileService
+
+
+class FakeConnection:
+    """
+    Connection stub that accepts every message immediately
+    """
+    async def send(self, message) -> None:
+        pass
+
+
+async def legacy_broadcast(authors, file_id, raw_patch) -> None:
+    room = [user for user in authors if user["current_file"] == file_id]
+    if room:
+        await asyncio.gather(*[user["connection"].send(raw_patch)
+                               for user in room])
+
+
+async def measure(total, room_size, rounds) -> tuple:
+    """
+    :return: mean microseconds per broadcast for registry and legacy scan
+    """
+    with tempfile.TemporaryDirectory() as users_dir:
+        handler = ClientHandler(None, FileService(Path(users_dir)))
+        legacy_authors = []
+        connections = []
+        for i in range(total):
+            ws = FakeConnection()
+            # first room_size connections edit the measured file, the rest
+            # are spread over other documents
+            file_id = "target" if i < room_size else f"file{i % 100}"
+            handler.rooms.register(ws)
+            handler.assign_file(file_id, ws)
+            connections.append(ws)
+            legacy_authors.append({"connection": ws, "current_file": file_id})
+
+        raw_patch = b'{"type": "patch"}'
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await handler.handle_new_patch("target", "", raw_patch,
+                                           connections[0])
+        registry_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            await legacy_broadcast(legacy_authors, "target", raw_patch)
+        legacy_time = time.perf_counter() - start
+
+    return registry_time / rounds * 1e6, legacy_time / rounds * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'connections':>12} {'room':>6} {'registry us':>12} "
+          f"{'legacy us':>10}")
+    for total in (100, 1000, 5000, 20000):
+        for room_size in (1, 10, 50):
+            registry_us, legacy_us = asyncio.run(
+                measure(total, room_size, args.rounds))
+            print(f"{total:>12} {room_size:>6} {registry_us:>12.1f} "
+                  f"{legacy_us:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Cold-open time of a document: bulk loading with Doc.load_text compared to
+inserting the text one character at a time, as files were loaded before.
+"""
+import argparse
+import json
+import time
+
+from docengine import Doc
+
+
+def max_depth(doc) -> int:
+    return max((len(json.loads(patch)["pos"]) for patch in doc.patches),
+               default=0)
+
+
+def load_bulk(text) -> tuple:
+    start = time.perf_counter()
+    doc = Doc()
+    doc.load_text(text)
+    return time.perf_counter() - start, doc
+
+
+def load_per_char(text) -> tuple:
+    start = time.perf_counter()
+    doc = Doc()
+    for pos, char in enumerate(text):
+        doc.insert(pos, char)
+    return time.perf_counter() - start, doc
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--max-per-char', type=int, default=100000,
+                        help='largest size to load one char at a time')
+    args = parser.parse_args()
+
+    print(f"{'chars':>9} {'bulk s':>8} {'depth':>6} {'per char s':>11} "
+          f"{'depth':>6}")
+    for size in args.sizes:
+        text = ("lorem ipsum dolor sit amet\n" * (size // 27 + 1))[:size]
+        bulk_time, doc = load_bulk(text)
+        line = f"{size:>9} {bulk_time:>8.2f} {max_depth(doc):>6}"
+        if size <= args.max_per_char:
+            per_char_time, doc = load_per_char(text)
+            line += f" {per_char_time:>11.2f} {max_depth(doc):>6}"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Memory per character and insert throughput of docengine.Doc
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from benchmarks.bench_doc_index import build_patches
+from docengine import Doc
+
+
+def memory_per_char(size) -> float:
+    """
+    :return: bytes allocated per character of a document of size chars
+    """
+    patches = build_patches(size)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    doc = Doc(site=0)
+    for patch in patches:
+        doc.apply_patch(patch)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(doc.text) == size
+    return (after - before) / size
+
+
+def local_inserts_per_sec(size) -> float:
+    """
+    :return: Doc.insert calls per second at random positions
+    """
+    doc = Doc(site=1)
+    positions = [random.randint(0, i) for i in range(size)]
+    start = time.perf_counter()
+    for pos in positions:
+        doc.insert(pos, "x")
+    return size / (time.perf_counter() - start)
+
+
+def remote_inserts_per_sec(size) -> float:
+    """
+    :return: applied insert patches per second, in random order
+    """
+    patches = build_patches(size)
+    random.shuffle(patches)
+    doc = Doc(site=0)
+    start = time.perf_counter()
+    for patch in patches:
+        doc.apply_patch(patch)
+    return size / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000])
+    args = parser.parse_args()
+
+    print(f"{'chars':>9} {'bytes/char':>11} {'local ins/s':>12} "
+          f"{'remote ins/s':>13}")
+    for size in args.sizes:
+        print(f"{size:>9} {memory_per_char(size):>11.0f} "
+              f"{local_inserts_per_sec(size):>12.0f} "
+              f"{remote_inserts_per_sec(size):>13.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Cost of remote deletes and of position lookups in docengine.Doc for
+documents of different sizes. The legacy column scans the whole document
+the way Doc did before the identity index was introduced.
+"""
+import argparse
+import json
+import random
+import time
+
+from docengine import Doc
+from docengine.char_position import CharPosition
+
+
+def build_patches(size, site=1) -> list:
+    """
+    Generate insert patches of size evenly spaced characters
+    """
+    depth, slots = 1, 2 ** CharPosition.BASE_BITS - 1
+    while slots <= size:
+        depth += 1
+        slots <<= CharPosition.BASE_BITS + depth - 1
+    step = slots // (size + 1)
+    patches = []
+    for i in range(size):
+        pos = CharPosition.create_from_int(step * (i + 1), depth,
+                                           [site] * depth,
+                                           base_bits=CharPosition.BASE_BITS)
+        patches.append(json.dumps({"op": "i", "char": "x", "clock": i + 1,
+                                   "pos": list(pos.position),
+                                   "sites": list(pos.sites)},
+                                  sort_keys=True))
+    return patches
+
+
+def legacy_lookup(doc, patch):
+    json_char = json.loads(patch)
+    return next((i for i, c in enumerate(doc._Doc__doc) if
+                 list(c.position.position) == json_char["pos"] and
+                 list(c.position.sites) == json_char["sites"] and
+                 c.clock == json_char["clock"]), None)
+
+
+def per_op_us(func, args) -> float:
+    start = time.perf_counter()
+    for arg in args:
+        func(arg)
+    return (time.perf_counter() - start) / len(args) * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--ops', type=int, default=1000)
+    parser.add_argument('--legacy-ops', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'chars':>9} {'lookup us':>10} {'delete us':>10} "
+          f"{'legacy lookup us':>17}")
+    for size in args.sizes:
+        patches = build_patches(size)
+        doc = Doc(site=0)
+        for patch in patches:
+            doc.apply_patch(patch)
+
+        sample = random.sample(patches, args.ops)
+        lookup = per_op_us(doc.get_real_position, sample)
+        legacy = per_op_us(lambda p: legacy_lookup(doc, p),
+                           sample[:args.legacy_ops])
+        deletes = [patch.replace('"op": "i"', '"op": "d"')
+                   for patch in sample]
+        delete = per_op_us(doc.apply_patch, deletes)
+        print(f"{size:>9} {lookup:>10.1f} {delete:>10.1f} {legacy:>17.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Microbenchmarks of docengine hot paths for documents of different sizes:
+sequential typing, random inserts, interleaved edits of several sites,
+large pastes, delete-heavy editing, remote patches, and the Allocator,
+CharPosition and Doc.text primitives under them.
+
+Times of 1000 operations are normalized by a fixed pure Python
+calibration loop, so that a baseline recorded on one machine can be
+compared on another. Record the
+baseline with --update, compare with --check, which fails if a case is
+slower than the baseline by more than the threshold factor.
+test_docengine_perf runs the check when pytest is given --run-benchmarks.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from docengine import Doc
+from docengine.allocator import Allocator
+
+BASELINE = Path(__file__).resolve().parent / "docengine_baseline.json"
+SIZES = [1000, 10000]
+THRESHOLD = 2.0
+
+
+def calibrate(repeat=5) -> float:
+    """
+    :return: best seconds of the calibration loop
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        values = {}
+        for i in range(200000):
+            values[i % 1000] = values.get(i % 1000, 0) + i
+        sorted(values.items(), key=lambda item: item[1])
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def make_doc(size, site=0) -> Doc:
+    doc = Doc(site=site)
+    doc.load_text("x" * size)
+    return doc
+
+
+def typing(size, ops, rand) -> Callable[[], None]:
+    doc = make_doc(size, site=1)
+    cursor = rand.randint(0, size)
+
+    def run() -> None:
+        for i in range(ops):
+            doc.insert(cursor + i, "a")
+    return run
+
+
+def random_inserts(size, ops, rand) -> Callable[[], None]:
+    doc = make_doc(size, site=1)
+    positions = [rand.randint(0, size + i) for i in range(ops)]
+
+    def run() -> None:
+        for position in positions:
+            doc.insert(position, "a")
+    return run
+
+
+def interleaved(size, ops, rand) -> Callable[[], None]:
+    """
+    Every site inserts in turn near a shared spot, other sites apply it
+    """
+    docs = [make_doc(size) for _ in range(3)]
+    for site, doc in enumerate(docs, 1):
+        doc.site = site
+    spot = rand.randint(0, size)
+    offsets = [rand.randint(0, 4) for _ in range(ops)]
+
+    def run() -> None:
+        for i, offset in enumerate(offsets):
+            author = docs[i % len(docs)]
+            patch = author.insert(spot + offset, "a")
+            for doc in docs:
+                if doc is not author:
+                    doc.apply_patch(patch)
+    return run
+
+
+def paste(size, ops, rand) -> Callable[[], None]:
+    doc = make_doc(size, site=1)
+    position = rand.randint(0, size)
+    text = "p" * ops
+
+    def run() -> None:
+        doc.insert_text(position, text)
+    return run
+
+
+def delete_heavy(size, ops, rand) -> Callable[[], None]:
+    """
+    Four deletes for every insert
+    """
+    doc = make_doc(size + ops, site=1)
+    steps = []
+    length = size + ops
+    for i in range(ops):
+        if i % 5 == 4:
+            steps.append((True, rand.randint(0, length)))
+            length += 1
+        else:
+            length -= 1
+            steps.append((False, rand.randint(0, length)))
+
+    def run() -> None:
+        for insert, position in steps:
+            if insert:
+                doc.insert(position, "a")
+            else:
+                doc.delete(position)
+    return run
+
+
+def remote_patches(size, ops, rand) -> Callable[[], None]:
+    doc = make_doc(size)
+    author = make_doc(size)
+    author.site = 1
+    patches = [author.insert(rand.randint(0, size + i), "a")
+               for i in range(ops)]
+
+    def run() -> None:
+        for patch in patches:
+            doc.apply_patch(patch)
+    return run
+
+
+def allocate(size, ops, rand) -> Callable[[], None]:
+    doc = make_doc(size)
+    chars = doc._Doc__doc
+    pairs = [(chars[i].position, chars[i + 1].position) for i in
+             (rand.randint(0, size) for _ in range(ops))]
+    allocator = Allocator(1)
+
+    def run() -> None:
+        for p, q in pairs:
+            allocator.allocate(p, q)
+    return run
+
+
+def convert_to_int(size, ops, rand) -> Callable[[], None]:
+    doc = make_doc(size)
+    chars = doc._Doc__doc
+    # cheap enough to need more calls for a stable measure
+    positions = [chars[rand.randint(1, size)].position
+                 for _ in range(ops * 20)]
+
+    def run() -> None:
+        for position in positions:
+            position.convert_to_int(len(position.position) + 1)
+    return run
+
+
+def text(size, ops, rand) -> Callable[[], None]:
+    doc = make_doc(size)
+    reads = max(1, ops // 10)
+
+    def run() -> None:
+        for _ in range(reads):
+            doc.text
+    return run
+
+
+CASES: Dict[str, Callable[[int, int, random.Random], Callable[[], None]]] = {
+    "typing": typing,
+    "random_inserts": random_inserts,
+    "interleaved": interleaved,
+    "paste": paste,
+    "delete_heavy": delete_heavy,
+    "remote_patches": remote_patches,
+    "allocate": allocate,
+    "convert_to_int": convert_to_int,
+    "text": text,
+}
+
+
+def measure(case, size, ops, repeat) -> float:
+    """
+    :return: best seconds of 1000 operations of a case over repeats,
+    setup is not timed
+    """
+    best = float("inf")
+    for attempt in range(repeat):
+        run = CASES[case](size, ops, random.Random(attempt))
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best / ops * 1000
+
+
+def run_suite(sizes, ops=500, repeat=3) -> Dict[str, float]:
+    """
+    :return: time of 1000 operations of every case by "case/size", in
+    calibration loops
+    """
+    unit = calibrate()
+    return {f"{case}/{size}": measure(case, size, ops, repeat) / unit
+            for case in CASES for size in sizes}
+
+
+def load_baseline(path=BASELINE) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(results, baseline, threshold) -> List[str]:
+    """
+    :param results: normalized times by case
+    :param baseline: normalized baseline times by case
+    :param threshold: slowdown factor that counts as a regression
+    :type results: Dict[str, float]
+    :type baseline: Dict[str, float]
+    :type threshold: float
+    :return: description of every regressed case
+    """
+    return [f"{name}: {results[name] / expected:.2f}x of baseline"
+            for name, expected in baseline.items()
+            if name in results and results[name] > expected * threshold]
+
+
+def find_regressions(baseline, results=None, threshold=None, repeat=3) \
+        -> List[str]:
+    """
+    Compare results with the baseline. Regressed cases are measured once
+    more, so that a single noisy run does not fail.
+    :param baseline: loaded baseline
+    :param results: results of run_suite, cases of the baseline are run
+    if None
+    :param threshold: slowdown factor, the baseline threshold if None
+    :type baseline: dict
+    :type results: Dict[str, float]
+    :type threshold: float
+    :type repeat: int
+    :return: description of every regressed case
+    """
+    expected = baseline["results"]
+    threshold = threshold or baseline["threshold"]
+    if results is None:
+        sizes = sorted({int(name.split("/")[1]) for name in expected})
+        results = run_suite(sizes, baseline["ops"], repeat)
+    regressed = [name for name in expected if name in results and
+                 results[name] > expected[name] * threshold]
+    if regressed:
+        unit = calibrate()
+        for name in regressed:
+            case, size = name.split("/")
+            results[name] = min(results[name], measure(
+                case, int(size), baseline["ops"], repeat) / unit)
+    return compare(results, expected, threshold)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--ops', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--update', action='store_true',
+                        help='record results as the baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='exit with an error on regressions')
+    parser.add_argument('--threshold', type=float, default=None,
+                        help='slowdown factor counted as regression, the '
+                             'baseline threshold by default')
+    args = parser.parse_args()
+
+    results = run_suite(args.sizes, args.ops, args.repeat)
+    baseline = load_baseline() if BASELINE.exists() else \
+        {"threshold": THRESHOLD, "ops": args.ops, "results": {}}
+    print(f"{'case':>24} {'per 1000 ops':>12} {'baseline':>9}")
+    for name, value in results.items():
+        expected = baseline["results"].get(name)
+        print(f"{name:>24} {value:>12.4f} "
+              f"{expected if expected is not None else '-':>9}")
+
+    if args.update:
+        baseline["ops"] = args.ops
+        baseline["results"].update({name: round(value, 4)
+                                    for name, value in results.items()})
+        with open(BASELINE, "w") as file:
+            json.dump(baseline, file, indent=2, sort_keys=True)
+            file.write("\n")
+    if args.check:
+        regressions = find_regressions(baseline, results, args.threshold,
+                                       args.repeat)
+        for regression in regressions:
+            print(f"Regression {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Server cost of a paste relayed to a room: one patch message per character
+compared to a single patch_batch message, both going through
+ClientHandler.handle_message.
+"""
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from client_handler import ClientHandler
+from docengine import Doc
+from file_service import FileService
+
+
+class FakeConnection:
+    """
+    Connection stub that counts sent frames and bytes
+    """
+    def __init__(self) -> None:
+        self.frames = 0
+        self.bytes = 0
+
+    async def send(self, message) -> None:
+        self.frames += 1
+        self.bytes += len(message)
+
+
+class FakeUserService:
+    """
+    User service stub that lets everybody edit every file
+    """
+    @staticmethod
+    def check_is_author(username, filename) -> bool:
+        return True
+
+
+def make_messages(file_id, token, size, batched) -> list:
+    """
+    Encoded messages of a paste of size chars into an empty document
+    """
+    patches = Doc(site=1).insert_text(0, "x" * size)
+    if batched:
+        contents = [("patch_batch", patches)]
+    else:
+        contents = [("patch", patch) for patch in patches]
+    return [json.dumps({"type": msg_type, "token": token, "filename": "file",
+                        "file_id": file_id, "content": content}
+                       ).encode("utf-8") for msg_type, content in contents]
+
+
+async def measure(size, room_size, batched) -> tuple:
+    """
+    :return: server seconds including sending to the room, received
+    frames and bytes per peer
+    """
+    with tempfile.TemporaryDirectory() as users_dir:
+        (Path(users_dir) / "user").mkdir()
+        (Path(users_dir) / "user" / "file").write_text("")
+        file_service = FileService(Path(users_dir))
+        handler = ClientHandler(FakeUserService(), file_service)
+        file_id = file_service.load_file("user", "file")
+        connections = [FakeConnection() for _ in range(room_size)]
+        for ws in connections:
+            handler.rooms.register(ws, "user")
+            handler.assign_file(file_id, ws)
+        sender = connections[0]
+        token = handler.rooms.get_session(sender).token
+        messages = make_messages(file_id, token, size, batched)
+
+        start = time.perf_counter()
+        for message in messages:
+            await handler.handle_message(message, sender)
+            # receiving the next frame lets send queues drain
+            await asyncio.sleep(0)
+        for ws in connections:
+            await handler.rooms.get_session(ws).queue.join()
+        elapsed = time.perf_counter() - start
+        assert len(file_service.documents[file_id].text) == size
+    peer = connections[-1]
+    return elapsed, peer.frames, peer.bytes
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=10000)
+    parser.add_argument('--room', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"{'mode':>8} {'server ms':>10} {'frames/peer':>12} "
+          f"{'bytes/peer':>11}")
+    for name, batched in (("patch", False), ("batch", True)):
+        elapsed, frames, size = asyncio.run(
+            measure(args.size, args.room, batched))
+        print(f"{name:>8} {elapsed * 1e3:>10.1f} {frames:>12} {size:>11}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Throughput of durable patch logging: patches registered per second until
+all of them are fsynced, with group commit and with an fsync per patch.
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from docengine import Doc
+from file_service import FileService
+from patch_log import PatchLog
+
+
+async def measure(patches, commit_window, writers) -> tuple:
+    """
+    :return: patches per second and number of commits
+    """
+    with tempfile.TemporaryDirectory() as users_dir:
+        users_dir = Path(users_dir)
+        patch_log = PatchLog(users_dir / "log", commit_window)
+        file_service = FileService(users_dir, patch_log=patch_log)
+        file_ids = []
+        for i in range(writers):
+            (users_dir / "user").mkdir(exist_ok=True)
+            (users_dir / "user" / f"file{i}").write_text("")
+            file_ids.append(file_service.load_file("user", f"file{i}"))
+
+        start = time.perf_counter()
+        for i, patch in enumerate(patches):
+            file_service.register_patch(file_ids[i % writers], patch)
+            # receiving the next frame lets the commit timer fire
+            await asyncio.sleep(0)
+        await patch_log.flush()
+        elapsed = time.perf_counter() - start
+        patch_log.close()
+    return len(patches) / elapsed, patch_log.commits
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--patches', type=int, default=5000)
+    parser.add_argument('--writers', type=int, default=10,
+                        help='number of files patched in turn')
+    args = parser.parse_args()
+
+    # inserts of distinct characters, every patch changes its file
+    doc = Doc(site=1)
+    patches = [doc.insert(i, "a") for i in range(args.patches)]
+
+    print(f"{'commit window':>14} {'patches/s':>10} {'commits':>8}")
+    for window in (0, 0.001, 0.005, 0.02):
+        per_sec, commits = asyncio.run(
+            measure(patches, window, args.writers))
+        print(f"{window:>14} {per_sec:>10.0f} {commits:>8}")
+
+
+if __name__ == "__main__":
+    main()
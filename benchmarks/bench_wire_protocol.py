@@ -0,0 +1,78 @@
+"""
+Size of a relayed patch frame and encode/decode throughput of the JSON
+and binary wire protocols.
+"""
+import argparse
+import json
+import random
+import time
+
+import wire_protocol
+from docengine import Doc
+from file_service import FileService
+
+
+def make_patches(count) -> list:
+    """
+    Patches of random typing into a loaded document
+    """
+    doc = Doc(site=random.getrandbits(31))
+    doc.load_text("x" * 5000)
+    return [json.loads(doc.insert(random.randint(0, 5000 + i), "a"))
+            for i in range(count)]
+
+
+def json_frame(file_id, patch) -> bytes:
+    return json.dumps({"type": "patch", "file_id": file_id,
+                       "token": "t" * 43,
+                       "content": json.dumps(patch, sort_keys=True)}
+                      ).encode("utf-8")
+
+
+def json_decode(frame) -> dict:
+    data = json.loads(frame.decode("utf-8"))
+    return json.loads(data["content"])
+
+
+def binary_decode(frame) -> dict:
+    wire_protocol.read_header(frame)
+    return wire_protocol.decode_patch(frame[wire_protocol.HEADER_SIZE:])
+
+
+def per_sec(func, items) -> float:
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (time.perf_counter() - start)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--patches', type=int, default=20000)
+    args = parser.parse_args()
+
+    file_id = FileService.get_file_id("user", "file")
+    patches = make_patches(args.patches)
+    json_frames = [json_frame(file_id, patch) for patch in patches]
+    binary_frames = [wire_protocol.encode_patch_frame(file_id, patch)
+                     for patch in patches]
+
+    rows = [
+        ("json", json_frames,
+         lambda p: json_frame(file_id, p), json_decode,
+         lambda f: json.loads(f.decode("utf-8"))["file_id"]),
+        ("binary", binary_frames,
+         lambda p: wire_protocol.encode_patch_frame(file_id, p),
+         binary_decode, wire_protocol.read_header),
+    ]
+    print(f"{'protocol':>9} {'bytes/patch':>12} {'encode/s':>10} "
+          f"{'decode/s':>10} {'route/s':>10}")
+    for name, frames, encode, decode, route in rows:
+        size = sum(map(len, frames)) / len(frames)
+        print(f"{name:>9} {size:>12.1f} {per_sec(encode, patches):>10.0f} "
+              f"{per_sec(decode, frames):>10.0f} "
+              f"{per_sec(route, frames):>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
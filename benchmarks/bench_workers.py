@@ -0,0 +1,134 @@
+"""
+Relay throughput of a local server with one worker process compared to
+files sharded across several workers. Every file is edited by a writer
+connection and watched by reader connections, each file is driven by its
+own client process, so that clients do not limit the server.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import websockets
+
+from docengine import Doc
+
+LAUNCH = Path(__file__).resolve().parent.parent / "launch.py"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+async def connect(url) -> "websockets.WebSocketClientProtocol":
+    for _ in range(200):
+        try:
+            return await websockets.connect(url, max_size=None)
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise TimeoutError(url)
+
+
+async def login(url, username, register) -> tuple:
+    ws = await connect(url)
+    await ws.send(json.dumps({
+        "type": "user_register" if register else "user_login",
+        "username": username, "password": "password"}).encode("utf-8"))
+    response = json.loads(await ws.recv())
+    assert response["success"], response
+    return ws, response["token"]
+
+
+async def drive_file(url, index, patches, readers) -> float:
+    """
+    :return: seconds until every reader received every patch
+    """
+    owner = f"user{index}"
+    filename = f"file{index}"
+    writer, token = await login(url, owner, True)
+    await writer.send(json.dumps({"type": "create_file_request",
+                                  "token": token, "filename": filename}
+                                 ).encode("utf-8"))
+    await writer.recv()
+    request = {"type": "file_request", "token": token, "filename": filename}
+    await writer.send(json.dumps(request).encode("utf-8"))
+    file_id = json.loads(await writer.recv())["file_id"]
+    connections = []
+    for _ in range(readers):
+        ws, reader_token = await login(url, owner, False)
+        await ws.send(json.dumps({**request, "token": reader_token}
+                                 ).encode("utf-8"))
+        await ws.recv()
+        connections.append(ws)
+
+    async def receive(ws) -> None:
+        for _ in range(len(patches)):
+            await ws.recv()
+
+    start = time.perf_counter()
+    receiving = asyncio.gather(*[receive(ws) for ws in connections])
+    for patch in patches:
+        await writer.send(json.dumps({
+            "type": "patch", "token": token, "filename": filename,
+            "file_id": file_id, "content": patch}).encode("utf-8"))
+    await receiving
+    elapsed = time.perf_counter() - start
+    for ws in connections + [writer]:
+        await ws.close()
+    return elapsed
+
+
+def run_client(url, index, patches, readers) -> float:
+    return asyncio.run(drive_file(url, index, patches, readers))
+
+
+def measure(workers, files, patches, readers) -> float:
+    """
+    :return: patches delivered to readers per second
+    """
+    with tempfile.TemporaryDirectory() as cwd:
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, str(LAUNCH), "-p", str(port), "--workers",
+             str(workers), "--user-db", "users.db", "--no-patch-log",
+             "--autosave-interval", "0"],
+            cwd=cwd, stdout=subprocess.DEVNULL)
+        try:
+            url = f"ws://localhost:{port}"
+            with multiprocessing.Pool(files) as pool:
+                times = pool.starmap(run_client, [
+                    (url, index, patches, readers)
+                    for index in range(files)])
+        finally:
+            server.terminate()
+            server.wait()
+    return files * len(patches) * readers / max(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--files', type=int, default=8)
+    parser.add_argument('--patches', type=int, default=2000)
+    parser.add_argument('--readers', type=int, default=3,
+                        help='connections receiving patches of every file')
+    args = parser.parse_args()
+
+    doc = Doc(site=1)
+    patches = [doc.insert(i, "a") for i in range(args.patches)]
+    print(f"{'workers':>8} {'patches/s':>10}")
+    for workers in sorted({1, args.workers}):
+        per_sec = measure(workers, args.files, patches, args.readers)
+        print(f"{workers:>8} {per_sec:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
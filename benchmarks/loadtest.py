@@ -0,0 +1,279 @@
+"""
+End-to-end load test of a local server. Starts ServerLauncher in its own
+process and drives it with simulated clients spread over files, every
+client logs in, opens its file and streams inserts and deletes at a fixed
+rate while applying the patches of its peers. Reports throughput and
+latency from a keystroke to its arrival at a peer, and checks that every
+client and the server end with the same text.
+
+Clients of a file run in one process, files are spread over client
+processes. Server arguments are passed after ``--``, e.g.
+``python -m benchmarks.loadtest --clients 40 -- --workers 2``
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import List
+
+from benchmarks.bench_workers import connect, free_port
+from docengine import Doc
+
+PASSWORD = "password"
+
+
+def run_server(argv, cwd) -> None:
+    """
+    Run server in the working directory until SIGTERM
+    :type argv: List[str]
+    :type cwd: str
+    """
+    os.chdir(cwd)
+    from launch import ServerLauncher
+    ServerLauncher(argv).run()
+
+
+async def send(ws, message) -> None:
+    await ws.send(json.dumps(message).encode("utf-8"))
+
+
+async def receive(ws, response_type) -> dict:
+    """
+    Wait for response of type, skipping patches of peers
+    """
+    while True:
+        message = json.loads(await ws.recv())
+        if message["type"] == response_type:
+            return message
+
+
+class LoadClient:
+    """
+    Simulated editor of a file
+    """
+
+    def __init__(self, client_id, owner, filename, seed) -> None:
+        """
+        :param client_id: id unique across all clients, used as doc site
+        :param owner: login of the file owner all clients log in as
+        :type client_id: int
+        :type owner: str
+        :type filename: str
+        :type seed: int
+        """
+        self.client_id = client_id
+        self.owner = owner
+        self.filename = filename
+        self.random = random.Random(seed)
+        self.doc = Doc(site=client_id + 1)
+        self.ws = None
+        self.token = None
+        self.file_id = None
+        self.received = 0
+        self.latencies: List[float] = []
+
+    async def open(self, url, register) -> None:
+        self.ws = await connect(url)
+        await send(self.ws, {
+            "type": "user_register" if register else "user_login",
+            "username": self.owner, "password": PASSWORD})
+        response = await receive(self.ws, "auth_response")
+        assert response["success"], response
+        self.token = response["token"]
+        if register:
+            await send(self.ws, {"type": "create_file_request",
+                                 "token": self.token,
+                                 "filename": self.filename})
+            await receive(self.ws, "create_file_response")
+
+    async def request_file(self) -> List[str]:
+        """
+        :return: patches of the file snapshot
+        """
+        await send(self.ws, {"type": "file_request", "token": self.token,
+                             "filename": self.filename})
+        response = await receive(self.ws, "file_request_response")
+        assert response["success"], response
+        self.file_id = response["file_id"]
+        return response["content"]
+
+    async def edit(self, patches, rate, delete_ratio) -> None:
+        """
+        Send patches at rate per second, without waiting for peers
+        :type patches: int
+        :param rate: patches per second, 0 to send as fast as possible
+        :type rate: float
+        :type delete_ratio: float
+        """
+        start = time.perf_counter()
+        for index in range(patches):
+            if rate:
+                delay = start + index / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            text_size = len(self.doc.text)
+            if text_size and self.random.random() < delete_ratio:
+                patch = self.doc.delete(self.random.randrange(text_size))
+            else:
+                patch = self.doc.insert(self.random.randint(0, text_size),
+                                        self.random.choice("abcdef "))
+            # extra fields are relayed to peers as is
+            await send(self.ws, {"type": "patch", "token": self.token,
+                                 "filename": self.filename,
+                                 "file_id": self.file_id, "content": patch,
+                                 "client": self.client_id,
+                                 "sent": time.perf_counter()})
+
+    async def listen(self, expected) -> None:
+        """
+        Apply patches of peers until expected number of them arrived
+        :type expected: int
+        """
+        while self.received < expected:
+            message = json.loads(await self.ws.recv())
+            if message["type"] != "patch" or \
+                    message["client"] == self.client_id:
+                continue
+            self.latencies.append(time.perf_counter() - message["sent"])
+            self.doc.apply_patch(message["content"])
+            self.received += 1
+
+
+async def drive_file(url, file_index, client_ids, args) -> dict:
+    """
+    Run clients editing one file
+    :return: sent and received patches, latencies, seconds of editing
+    and whether clients and server converged
+    """
+    owner, filename = f"load{file_index}", f"file{file_index}"
+    clients = [LoadClient(client_id, owner, filename,
+                          args.seed * 100003 + client_id)
+               for client_id in client_ids]
+    await clients[0].open(url, True)
+    await asyncio.gather(*[client.open(url, False)
+                           for client in clients[1:]])
+    for client in clients:
+        client.doc.apply_operations(
+            [json.loads(patch) for patch in await client.request_file()])
+
+    expected = (len(clients) - 1) * args.patches
+    start = time.perf_counter()
+    listening = asyncio.gather(*[client.listen(expected)
+                                 for client in clients])
+    await asyncio.gather(*[client.edit(args.patches, args.rate,
+                                       args.delete_ratio)
+                           for client in clients])
+    try:
+        await asyncio.wait_for(listening, args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - start
+
+    server_doc = Doc()
+    server_doc.apply_operations(
+        [json.loads(patch) for patch in await clients[0].request_file()])
+    texts = {client.doc.text for client in clients} | {server_doc.text}
+    for client in clients:
+        await client.ws.close()
+    return {"sent": len(clients) * args.patches,
+            "received": sum(client.received for client in clients),
+            "latencies": [latency for client in clients
+                          for latency in client.latencies],
+            "elapsed": elapsed, "converged": len(texts) == 1}
+
+
+def run_files(url, files, args) -> List[dict]:
+    """
+    Run clients of files in this process
+    :param files: file index and ids of its clients
+    :type files: List[Tuple[int, List[int]]]
+    """
+    async def run() -> List[dict]:
+        return await asyncio.gather(*[
+            drive_file(url, file_index, client_ids, args)
+            for file_index, client_ids in files])
+    return asyncio.run(run())
+
+
+def percentile(values, fraction) -> float:
+    """
+    :param values: sorted values
+    :type values: List[float]
+    :type fraction: float
+    """
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--patches', type=int, default=200,
+                        help='patches sent by every client')
+    parser.add_argument('--rate', type=float, default=20.0,
+                        help='patches per second of every client, 0 to '
+                             'send as fast as possible')
+    parser.add_argument('--delete-ratio', type=float, default=0.2)
+    parser.add_argument('--client-processes', type=int,
+                        default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--timeout', type=float, default=60.0,
+                        help='seconds to wait for patches of peers after '
+                             'the last one is sent')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('server_args', nargs='*',
+                        help='arguments of launch.py')
+    args = parser.parse_args()
+    if args.clients < 2 * args.files:
+        parser.error("every file needs at least 2 clients")
+
+    files = [(index, list(range(index, args.clients, args.files)))
+             for index in range(args.files)]
+    processes = min(args.client_processes, args.files)
+    groups = [files[index::processes] for index in range(processes)]
+    port = free_port()
+    argv = ["-p", str(port), "--user-db", "users.db"] + args.server_args
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as cwd:
+        server = context.Process(target=run_server, args=(argv, cwd))
+        server.start()
+        try:
+            url = f"ws://localhost:{port}"
+            with context.Pool(processes) as pool:
+                results = [result for group in pool.starmap(
+                    run_files, [(url, group, args) for group in groups])
+                    for result in group]
+        finally:
+            server.terminate()
+            server.join(timeout=30)
+
+    sent = sum(result["sent"] for result in results)
+    received = sum(result["received"] for result in results)
+    expected = sum(len(client_ids) * (len(client_ids) - 1)
+                   for _, client_ids in files) * args.patches
+    elapsed = max(result["elapsed"] for result in results)
+    latencies = sorted(latency for result in results
+                       for latency in result["latencies"])
+    converged = sum(result["converged"] for result in results)
+    print(f"clients {args.clients}, files {args.files}, "
+          f"{args.patches} patches per client at "
+          f"{args.rate or 'max'} per second")
+    print(f"sent      {sent:>10} {sent / elapsed:>10.0f}/s")
+    print(f"delivered {received:>10} {received / elapsed:>10.0f}/s "
+          f"of {expected}")
+    for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999)):
+        print(f"{name:<9} {percentile(latencies, fraction) * 1000:>10.2f}ms")
+    print(f"converged {converged}/{args.files} files")
+    if converged < args.files or received < expected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,17 @@
 import asyncio
 import json
 import logging
-from functools import lru_cache
+import time
+from typing import Callable, Iterator, List
 
 from websockets import ConnectionClosedError, WebSocketServerProtocol
 
+import wire_protocol
+from auth_cache import AuthCache
 from file_service import FileService
+from metrics import Metrics
+from profiler import LoopProfiler
+from room_registry import RoomRegistry, Session
 from user_service import UserService
 
 
@@ -14,25 +20,289 @@ class ClientHandler:
     Handles all incoming requests from clients
     """
 
-    def __init__(self, user_service: UserService, file_service: FileService):
-        self.active_authors = []
+    RESYNC = "resync"
+    CLOSE = "close"
+    MAX_PROFILE_SECONDS = 120.0
+
+    def __init__(self, user_service: UserService, file_service: FileService,
+                 chunk_bytes=65536, queue_size=1024, slow_clients=RESYNC,
+                 auth_cache_users=4096, admins=(), profiler=None,
+                 max_message_size=None):
+        """
+        :param chunk_bytes: size limit of patches in a frame when a file
+        is streamed
+        :param queue_size: limit of frames queued to a connection
+        :param slow_clients: what to do with a connection whose send queue
+        overflows: RESYNC drops queued frames and streams a fresh snapshot
+        of its file, CLOSE drops queued frames and closes the connection
+        :param auth_cache_users: limit of users with cached authorization
+        of requests that carry username and password
+        :param admins: logins of users allowed to profile the server
+        :param profiler: profiler of the event loop, profile requests are
+        refused without one
+        :param max_message_size: size limit of frames from clients in
+        bytes, sent to clients on login so that they split patch batches
+        that do not fit a frame
+        :type chunk_bytes: int
+        :type queue_size: int
+        :type slow_clients: str
+        :type auth_cache_users: int
+        :type admins: Iterable[str]
+        :type profiler: LoopProfiler
+        :type max_message_size: int
+        """
+        self.rooms = RoomRegistry(queue_size)
         self.user_service = user_service
         self.file_service = file_service
-
-    async def handle_new_patch(self, file_id, content, raw_patch) -> None:
+        self.chunk_bytes = chunk_bytes
+        self.max_message_size = max_message_size
+        self.slow_clients = slow_clients
+        self.auth_cache = AuthCache(auth_cache_users)
+        # cluster relay exchanging patches with other nodes, if any
+        self.relay = None
+        # publishes logins of users whose files or shares changed to other
+        # processes serving the same users
+        self.publish_users: Callable[[List[str]], None] = lambda users: None
+        # frames dropped from queues of closed connections and overflows
+        self.dropped_frames = 0
+        self.overflows = 0
+        self.metrics = Metrics()
+        self.admins = set(admins)
+        self.profiler: LoopProfiler or None = profiler
+
+    async def handle_new_patch(self, file_id, content, raw_patch, ws) -> \
+            None:
         """
-        Handle new patch from client
+        Handle new patch from client. Connection may only patch the file it
+        is currently editing.
+        :param content: JSON encoded patch
+        :param raw_patch: received JSON frame, relayed as is
         :type file_id: str
         :type content: str
         :type raw_patch: bytes
+        :type ws: WebSocketServerProtocol
+        """
+        session = self.rooms.get_session(ws)
+        if session is None or session.current_file != file_id:
+            await self.send_unauthorized_response(ws)
+            return
+        if not self.file_service.register_patch(file_id, content):
+            return
+        self.relay_patches(file_id, [content])
+        frames = {wire_protocol.JSON: raw_patch} if raw_patch else {}
+        await self.broadcast(wire_protocol.PatchFrames(file_id, frames,
+                                                       content=content))
+
+    async def handle_binary_patch(self, file_id, frame, ws) -> None:
+        """
+        Handle new patch from client in binary PATCH frame. Connection
+        may only patch the file it is currently editing.
+        :type file_id: str
+        :type frame: bytes
+        :type ws: WebSocketServerProtocol
         """
-        self.file_service.register_patch(file_id, content)
-        filename_authors = [user for user in self.active_authors if
-                            user["current_file"] == file_id]
-        # asyncio wait doesn't accept an empty list
-        if filename_authors:
-            await asyncio.wait([user["connection"].send(raw_patch) for user in
-                                filename_authors])
+        session = self.rooms.get_session(ws)
+        if session is None or session.current_file != file_id:
+            await self.send_unauthorized_response(ws)
+            return
+        try:
+            patch = wire_protocol.decode_patch(
+                frame[wire_protocol.HEADER_SIZE:])
+        except ValueError:
+            logging.info(f"Failed to decode binary patch of {file_id}")
+            return
+        if not self.file_service.register_operation(file_id, patch):
+            return
+        self.relay_patches(file_id, [patch])
+        await self.broadcast(wire_protocol.PatchFrames(
+            file_id, {wire_protocol.BINARY: frame}, patch=patch))
+
+    async def handle_patch_batch(self, file_id, content, raw_message, ws) \
+            -> None:
+        """
+        Handle ordered batch of patches from client. Batch is registered
+        atomically and relayed to the room as a single frame, a batch
+        that was not registered is not relayed. Connection may only patch
+        the file it is currently editing.
+        :param content: JSON encoded patches
+        :param raw_message: received JSON frame, relayed as is
+        :type file_id: str
+        :type content: List[str]
+        :type raw_message: bytes
+        :type ws: WebSocketServerProtocol
+        """
+        session = self.rooms.get_session(ws)
+        if session is None or session.current_file != file_id:
+            await self.send_unauthorized_response(ws)
+            return
+        if not isinstance(content, list):
+            logging.info(f"Malformed patch batch of {file_id}")
+            return
+        if not self.file_service.register_patches(file_id, content):
+            return
+        self.relay_patches(file_id, content)
+        frames = {wire_protocol.JSON: raw_message} if raw_message else {}
+        await self.broadcast(wire_protocol.BatchFrames(file_id, frames,
+                                                       content=content))
+
+    async def handle_binary_batch(self, file_id, frame, ws) -> None:
+        """
+        Handle ordered batch of patches from client in binary PATCHES
+        frame. Connection may only patch the file it is currently editing.
+        :type file_id: str
+        :type frame: bytes
+        :type ws: WebSocketServerProtocol
+        """
+        session = self.rooms.get_session(ws)
+        if session is None or session.current_file != file_id:
+            await self.send_unauthorized_response(ws)
+            return
+        try:
+            patches = wire_protocol.decode_message(frame)["content"]
+        except (ValueError, KeyError):
+            logging.info(f"Failed to decode binary patch batch of {file_id}")
+            return
+        if not self.file_service.register_patches(file_id, patches):
+            return
+        self.relay_patches(file_id, patches)
+        await self.broadcast(wire_protocol.BatchFrames(
+            file_id, {wire_protocol.BINARY: frame}, patch=patches))
+
+    def relay_patches(self, file_id, patches) -> None:
+        """
+        Publish patches registered by clients of this node to the other
+        nodes of the cluster
+        :type file_id: str
+        :param patches: JSON encoded or decoded patches
+        :type patches: List[str or dict]
+        """
+        if self.relay is not None:
+            self.relay.publish(file_id, patches)
+
+    async def handle_remote_patches(self, file_id, patches) -> None:
+        """
+        Register patches received from another node of the cluster and
+        relay them to the room
+        :param patches: JSON encoded patches
+        :type file_id: str
+        :type patches: List[str]
+        """
+        if not self.file_service.register_patches(file_id, patches):
+            return
+        if len(patches) == 1:
+            frames = wire_protocol.PatchFrames(file_id, {},
+                                               content=patches[0])
+        else:
+            frames = wire_protocol.BatchFrames(file_id, {}, content=patches)
+        await self.broadcast(frames)
+
+    async def broadcast(self, frames) -> None:
+        """
+        Queue patch or batch of patches to every connection editing the
+        file, in the protocol of the connection. Broadcast never waits for
+        peers to receive it.
+        :type frames: wire_protocol.PatchFrames
+        """
+        start = time.perf_counter()
+        for session in list(self.rooms.get_room(frames.file_id)):
+            try:
+                frame = frames.get(session.protocol)
+            except (ValueError, KeyError, TypeError):
+                logging.info(f"Failed to encode patch for {session}")
+                continue
+            self.enqueue(session, frame)
+        self.metrics.broadcast.observe(time.perf_counter() - start)
+        if isinstance(frames, wire_protocol.BatchFrames):
+            patches = frames.content if frames.content is not None \
+                else frames.patch
+            self.metrics.count_patches(frames.file_id, len(patches))
+        else:
+            self.metrics.count_patches(frames.file_id, 1)
+
+    def enqueue(self, session, frame) -> None:
+        """
+        Queue frame to the connection of session, handle slow client if
+        its queue is full
+        :type session: Session
+        :type frame: bytes
+        """
+        if not session.queue.put(frame):
+            self.handle_slow_client(session)
+
+    def handle_slow_client(self, session) -> None:
+        """
+        Drop frames queued to the connection that does not keep up, then
+        resync it with a snapshot of its file or close it
+        :type session: Session
+        """
+        self.overflows += 1
+        dropped = session.queue.clear()
+        logging.info(f"Send queue of {session} overflowed, dropped "
+                     f"{dropped} frames")
+        snapshot = None
+        if self.slow_clients == self.RESYNC and session.current_file:
+            snapshot = self.file_service.iter_document(session.current_file,
+                                                       self.chunk_bytes)
+        if snapshot is None:
+            asyncio.ensure_future(session.connection.close())
+            return
+        version, chunks = snapshot
+        session.queue.put_stream(self.stream_frames(
+            session.current_file, version, chunks, session.protocol,
+            {"resync": True}))
+
+    def queue_stats(self) -> dict:
+        """
+        Depth of send queues of all connections and number of frames
+        dropped because connections did not keep up or went away
+        """
+        depths = [len(session.queue) for session in
+                  self.rooms.sessions.values()]
+        return {"connections": len(depths),
+                "queued": sum(depths),
+                "max_depth": max(depths, default=0),
+                "overflows": self.overflows,
+                "dropped": self.dropped_frames + sum(
+                    session.queue.dropped for session in
+                    self.rooms.sessions.values())}
+
+    def metrics_snapshot(self) -> dict:
+        """
+        Handling latency of messages by type, broadcast fan-out time,
+        connections, loaded documents with their patch rates, and stats of
+        send queues, file cache, authorization cache and password hashing
+        """
+        documents = self.file_service.document_stats()
+        self.metrics.forget_files(documents)
+        for file_id, stats in documents.items():
+            stats["connections"] = len(self.rooms.get_room(file_id))
+            stats["patches_per_sec"] = self.metrics.patch_rate(file_id)
+        snapshot = {**self.metrics.snapshot(),
+                    "connections": len(self.rooms),
+                    "rooms": len(self.rooms.rooms),
+                    "documents": documents,
+                    "queues": self.queue_stats(),
+                    "cache": self.file_service.cache_stats(),
+                    "auth_cache": self.auth_cache.stats(),
+                    "hashing": self.user_service.hash_pool.stats}
+        if self.relay is not None:
+            snapshot["cluster"] = {"published": self.relay.published,
+                                   "received": self.relay.received,
+                                   "syncs": self.relay.syncs}
+        return snapshot
+
+    async def load_file(self, username, filename) -> None:
+        """
+        Load file to memory, in cluster mode from a snapshot of the nodes
+        already editing it
+        :param username: file owner
+        :type username: str
+        :type filename: str
+        """
+        if self.relay is not None:
+            await self.relay.join(username, filename)
+        else:
+            await self.file_service.load_file_async(username, filename)
 
     async def handle_send_file(self, filename, username, ws) -> None:
         """
@@ -42,15 +312,75 @@ class ClientHandler:
         :type ws: WebSocketServerProtocol
         """
         response = {"type": "file_request_response"}
-        file_id, file_patches = self.file_service.get_patches(username,
-                                                              filename)
-        if file_patches is None:
+        await self.load_file(username, filename)
+        snapshot = self.file_service.get_snapshot(username, filename)
+        if snapshot is None:
             await self.msg_send({**response, "success": False}, ws)
+            return
 
+        file_id, version, file_patches = snapshot
         self.assign_file(file_id, ws)
-        logging.info(f"[{username}] Sending known patches history...")
+        await self.trim_files()
+        logging.info(f"[{username}] Sending snapshot of version {version}...")
         await self.msg_send({**response, "success": True, "file_id": file_id,
-                             "content": file_patches}, ws)
+                             "version": version, "content": file_patches},
+                            ws)
+
+    async def handle_stream_file(self, filename, username, ws) -> None:
+        """
+        Send requested file to the user as a stream of bounded frames:
+        file_request_response with stream begin marker, file_stream_chunk
+        frames and file_stream_end frame. Patches of other editors are
+        sent after the end frame.
+        :type filename: str
+        :type username: str
+        :type ws: WebSocketServerProtocol
+        """
+        response = {"type": "file_request_response"}
+        await self.load_file(username, filename)
+        snapshot = self.file_service.iter_snapshot(username, filename,
+                                                   self.chunk_bytes)
+        if snapshot is None:
+            await self.msg_send({**response, "success": False}, ws)
+            return
+
+        file_id, version, chunks = snapshot
+        session = self.assign_file(file_id, ws)
+        await self.trim_files()
+        logging.info(f"[{username}] Streaming snapshot of version "
+                     f"{version}...")
+        if session is None:
+            for frame in self.stream_frames(file_id, version, chunks,
+                                            wire_protocol.JSON):
+                await ws.send(frame)
+        elif not session.queue.put_stream(self.stream_frames(
+                file_id, version, chunks, session.protocol)):
+            self.handle_slow_client(session)
+
+    def stream_frames(self, file_id, version, chunks, protocol,
+                      extra=None) -> Iterator[bytes]:
+        """
+        Encode snapshot stream frames while they are sent
+        :param chunks: lists of snapshot patches
+        :param protocol: encoding of frames
+        :param extra: additional fields of the stream begin frame
+        :type file_id: str
+        :type version: int
+        :type chunks: Iterator[List[str]]
+        :type protocol: str
+        :type extra: dict
+        """
+        yield self.encode({"type": "file_request_response", "success": True,
+                           "file_id": file_id, "version": version,
+                           "stream": "begin", **(extra or {})}, protocol)
+        count = 0
+        for chunk in chunks:
+            yield self.encode({"type": "file_stream_chunk",
+                               "file_id": file_id, "content": chunk},
+                              protocol)
+            count += len(chunk)
+        yield self.encode({"type": "file_stream_end", "file_id": file_id,
+                           "version": version, "count": count}, protocol)
 
     async def handle_save_file(self, filename, username, ws) -> None:
         """
@@ -59,7 +389,8 @@ class ClientHandler:
         :type username: str
         :type ws: WebSocketServerProtocol
         """
-        success = self.file_service.save_file(username, filename)
+        success = await self.file_service.save_file_async(username,
+                                                          filename)
         await self.msg_send({"type": "save_file_response",
                              "success": success}, ws)
 
@@ -72,6 +403,10 @@ class ClientHandler:
         :type ws: WebSocketServerProtocol
         """
         res = self.user_service.try_grant_access(owner, share_user, filename)
+        if res:
+            self.rooms.invalidate_permissions(share_user, filename)
+            self.auth_cache.invalidate(share_user, filename)
+            self.publish_users([share_user])
         await self.msg_send({"type": "file_share_response",
                              "success": res}, ws)
 
@@ -87,6 +422,9 @@ class ClientHandler:
         logging.info(f"Creating file {filename}")
 
         if self.user_service.try_add_file(username, filename):
+            self.rooms.invalidate_permissions(username, filename)
+            self.auth_cache.invalidate(username, filename)
+            self.publish_users([username])
             message = {**response, "success": True,
                        "content": f"Successfully created {filename}"}
         else:
@@ -94,7 +432,6 @@ class ClientHandler:
                        "content": f"Failed to create {filename}"}
 
         await self.msg_send(message, ws)
-        self.is_authorized.cache_clear()
 
     async def handle_all_files(self, username, ws) -> None:
         """
@@ -109,34 +446,162 @@ class ClientHandler:
         await self.msg_send({"type": "all_files_response",
                              "content": all_files}, ws)
 
-    def assign_file(self, file_id, ws) -> None:
+    async def handle_profile(self, username, seconds, ws) -> None:
+        """
+        Profile the event loop on request of an admin and send the path
+        of the report when it is written. Other messages of the connection
+        are handled while the profile runs.
+        :param seconds: duration of the profile, the profiler default if
+        None
+        :type username: str
+        :type seconds: float
+        :type ws: WebSocketServerProtocol
+        """
+        response = {"type": "profile_response", "success": False}
+        if username not in self.admins:
+            content = "Profiling is allowed to admins only"
+        elif self.profiler is None:
+            content = "Profiling is disabled"
+        elif self.profiler.running:
+            content = "Profile is already running"
+        else:
+            seconds = self.__profile_seconds(seconds)
+            if seconds is not None:
+                logging.info(f"{username} requested a profile of "
+                             f"{seconds}s")
+                asyncio.ensure_future(self.__send_profile(seconds, ws))
+                return
+            content = "Profile duration must be a positive number"
+        await self.msg_send({**response, "content": content}, ws)
+
+    def __profile_seconds(self, seconds) -> float or None:
+        """
+        :param seconds: requested duration, the profiler default if None
+        :return: duration limited to MAX_PROFILE_SECONDS, None if it is
+        not a positive number
+        """
+        if seconds is None:
+            seconds = self.profiler.seconds
+        try:
+            seconds = float(seconds)
+        except (TypeError, ValueError):
+            return None
+        # NaN fails the comparison as well
+        if not 0 < seconds:
+            return None
+        return min(seconds, self.MAX_PROFILE_SECONDS)
+
+    async def __send_profile(self, seconds, ws) -> None:
+        """
+        Profile and send the path of the report, or a failure if another
+        profile started in the meantime
+        :type seconds: float
+        :type ws: WebSocketServerProtocol
+        """
+        path = await self.profiler.try_profile(seconds)
+        if path is None:
+            await self.msg_send({"type": "profile_response",
+                                 "success": False,
+                                 "content": "Profile is already running"},
+                                ws)
+            return
+        await self.msg_send({"type": "profile_response", "success": True,
+                             "content": str(path)}, ws)
+
+    def apply_user_changes(self, usernames) -> None:
+        """
+        Reload users changed by another process, drop their cached
+        permissions
+        :type usernames: List[str]
+        """
+        for username in usernames:
+            self.user_service.reload_user(username)
+            self.rooms.invalidate_permissions(username, None)
+            self.auth_cache.invalidate(username)
+
+    async def trim_files(self) -> None:
+        """
+        Evict idle files above memory budget, leave cluster topics of
+        evicted files
+        """
+        await self.file_service.trim()
+        if self.relay is not None:
+            await self.relay.prune()
+
+    async def index_users(self) -> List[str]:
+        """
+        Index users directory while serving clients, drop cached
+        permissions of users whose files changed
+        :return: logins of users whose files changed
+        """
+        changed = await self.user_service.index_async()
+        for username in changed:
+            self.rooms.invalidate_permissions(username, None)
+            self.auth_cache.invalidate(username)
+        return changed
+
+    def assign_file(self, file_id, ws) -> Session or None:
         """
         Set current working file id of specified
         websocket to the provided one. It means that websocket is currently
         editing file with specified file id.
         :type file_id: str
         :type ws: WebSocketServerProtocol
+        :return: session of websocket, None if it is not authorized
         """
-        author = next((element for element in self.active_authors if
-                       element["connection"] == ws), None)
+        session = self.rooms.get_session(ws)
+        previous = session.current_file if session else None
+        author = self.rooms.assign(ws, file_id)
         if author:
-            author["current_file"] = file_id
             logging.info(f"Assigned {file_id} to {author}")
+            if previous != file_id:
+                if previous is not None:
+                    self.file_service.release(previous)
+                self.file_service.acquire(file_id)
+        return author
 
-    def authorize_message(self, message: dict) -> bool:
+    async def authorize_message(self, message: dict, ws) -> bool:
         """
         Verify that message is authorized to request action that is
-        specified inside it.
+        specified inside it. Messages carrying a session token are
+        authorized by the session of the connection, otherwise by username
+        and password.
         :type message: dict
+        :type ws: WebSocketServerProtocol
         :return True if authorized, otherwise False
         """
+        if "token" in message:
+            return self.authorize_session(message, ws)
         username: str = message.get("username")
         password: str = message.get("password")
         filename: str = message.get("filename")
         req_type: str = message.get("type")
         owner_name: str = message.get("owner")
-        return self.is_authorized(username, password, filename, owner_name,
-                                  req_type)
+        return await self.is_authorized(username, password, filename,
+                                        owner_name, req_type)
+
+    def authorize_session(self, message: dict, ws) -> bool:
+        """
+        Verify message by session token issued to the connection on login.
+        Username of the session is written to the message, permission
+        checks are cached in the session.
+        :type message: dict
+        :type ws: WebSocketServerProtocol
+        :return True if authorized, otherwise False
+        """
+        session = self.rooms.get_session(ws)
+        if session is None or not session.check_token(message["token"]):
+            return False
+        message["username"] = session.username
+        req_type: str = message.get("type")
+        if req_type in ["create_file_request", "all_files_request",
+                        "profile_request"]:
+            return True
+        key = (message.get("owner"), message.get("filename"))
+        if key not in session.permissions:
+            session.permissions[key] = self.has_permission(
+                session.username, key[1], key[0], req_type)
+        return session.permissions[key]
 
     async def handle_new_client(self, auth_data, ws) -> None:
         """
@@ -148,24 +613,29 @@ class ClientHandler:
         logging.info(f"[register] New client joined: {ws}")
         action = None
         if auth_data["type"] == "user_register":
-            action = self.user_service.try_reg_user
+            action = self.user_service.try_reg_user_async
         elif auth_data["type"] == "user_login":
-            action = self.user_service.auth_user
-
-        if action and action(auth_data["username"], auth_data["password"]):
-            await self.send_authorized_response(ws)
-            self.is_authorized.cache_clear()
-            self.active_authors.append(
-                {"connection": ws, "current_file": None})
+            action = self.user_service.auth_user_async
+
+        if action and await action(auth_data["username"],
+                                   auth_data["password"]):
+            session = self.rooms.register(ws, auth_data["username"])
+            protocol = wire_protocol.BINARY if auth_data.get("protocol") == \
+                wire_protocol.BINARY else wire_protocol.JSON
+            await self.send_authorized_response(ws, session.token, protocol)
+            # auth response is in JSON, as the login was
+            session.protocol = protocol
+            if auth_data["type"] == "user_register":
+                self.publish_users([session.username])
             logging.info("[register] Main author procedure: Done")
         else:
             await self.send_unauthorized_response(ws)
 
-    @lru_cache(maxsize=128)
-    def is_authorized(self, username, password, filename, owner_name,
-                      req_type) -> bool:
+    async def is_authorized(self, username, password, filename, owner_name,
+                            req_type) -> bool:
         """
-        Check if specified credentials combination is legit.
+        Check if specified credentials combination is legit. Verified
+        credentials and permission checks are cached per user.
         :param username: user login
         :param password: user password (provided one)
         :param filename: filename to access
@@ -182,8 +652,37 @@ class ClientHandler:
         if not username or not password:
             return False
         # if failed to authorize user, reject
-        if not self.user_service.auth_user(username, password):
-            return False
+        if not self.auth_cache.check_credentials(username, password):
+            if not await self.user_service.auth_user_async(username,
+                                                           password):
+                return False
+            self.auth_cache.add_credentials(username, password)
+        if req_type in ["create_file_request", "all_files_request",
+                        "profile_request"]:
+            return True
+        allowed = self.auth_cache.get_permission(username, owner_name,
+                                                 filename)
+        if allowed is None:
+            allowed = self.has_permission(username, filename, owner_name,
+                                          req_type)
+            self.auth_cache.add_permission(username, owner_name, filename,
+                                           allowed)
+        return allowed
+
+    def has_permission(self, username, filename, owner_name, req_type) -> \
+            bool:
+        """
+        Check if authenticated user is allowed to perform the request.
+        :param username: user login
+        :param filename: filename to access
+        :param owner_name: owner user login (if shared doc)
+        :param req_type: type of the request
+        :type username: str
+        :type filename: str
+        :type owner_name: str
+        :type req_type: str
+        :return: True if allowed, otherwise False
+        """
         if owner_name and self.user_service.has_access(owner_name, username,
                                                        filename):
             return True
@@ -213,85 +712,162 @@ class ClientHandler:
         await self.msg_send({"type": "auth_response", "success": False,
                              "content": "Auth failure"}, ws)
 
-    async def send_authorized_response(self, ws) -> None:
+    async def send_authorized_response(self, ws, token=None,
+                                       protocol=wire_protocol.JSON) -> None:
         """
         Send "authorized" response to the client.
-        It indicates that provided credentials are legit.
+        It indicates that provided credentials are legit. Response carries
+        the frame size limit, if any, larger frames close the connection.
+        :param token: session token to authorize further messages with
+        :param protocol: encoding of further messages to the client
         :type ws: WebSocketServerProtocol
+        :type token: str
+        :type protocol: str
         """
         await self.msg_send({"type": "auth_response", "success": True,
-                             "content": "Auth success."}, ws)
+                             "content": "Auth success.", "token": token,
+                             "protocol": protocol,
+                             "max_message_size": self.max_message_size}, ws)
 
-    @staticmethod
-    async def msg_send(message, ws) -> None:
+    async def msg_send(self, message, ws) -> None:
         """
-        Encode and send message to the websocket
+        Encode message in the protocol of the websocket and queue it to
+        the connection. Connections without a session are sent to directly.
         :type message: dict
         :type ws: WebSocketServerProtocol
         """
-        encoded_message = json.dumps(message).encode("utf-8")
-        await ws.send(encoded_message)
+        session = self.rooms.get_session(ws)
+        if session is None:
+            await ws.send(self.encode(message, wire_protocol.JSON))
+        else:
+            self.enqueue(session, self.encode(message, session.protocol))
+
+    @staticmethod
+    def encode(message, protocol) -> bytes:
+        """
+        :type message: dict
+        :param protocol: JSON or BINARY
+        :type protocol: str
+        """
+        if protocol == wire_protocol.BINARY:
+            return wire_protocol.encode_message(message)
+        return json.dumps(message).encode("utf-8")
 
     async def handle_message(self, message, ws) -> None:
         """
-        Determine message type and provide it
-        to the corresponding handler method.
+        Handle message and record handling time of its type
         :type message: bytes
         :type ws: WebSocketServerProtocol
         """
-        data = json.loads(message.decode("utf-8"))
-        msg_type = data["type"]
-        owner_name = self.get_file_owner(data)
+        start = time.perf_counter()
+        msg_type = await self.route_message(message, ws)
+        self.metrics.observe_message(msg_type, time.perf_counter() - start)
+
+    async def route_message(self, message, ws) -> str:
+        """
+        Determine message type and provide it
+        to the corresponding handler method. Frames that can not be decoded
+        are dropped.
+        :type message: bytes
+        :type ws: WebSocketServerProtocol
+        :return: message type
+        """
+        if wire_protocol.is_binary(message):
+            try:
+                kind, file_id = wire_protocol.read_header(message)
+            except ValueError:
+                logging.info(f"Malformed frame header from {ws}")
+                return "malformed"
+            if kind == wire_protocol.PATCH:
+                await self.handle_binary_patch(file_id, message, ws)
+                return "patch"
+            if kind == wire_protocol.PATCHES:
+                await self.handle_binary_batch(file_id, message, ws)
+                return "patch_batch"
+            raw_message = None
+        else:
+            raw_message = message
+        try:
+            if raw_message is None:
+                data = wire_protocol.decode_message(message)
+            else:
+                data = json.loads(message.decode("utf-8"))
+            msg_type = data["type"]
+        except (ValueError, KeyError, TypeError):
+            logging.info(f"Malformed message from {ws}")
+            return "malformed"
 
         if msg_type in ["user_register", "user_login"]:
             await self.handle_new_client(data, ws)
 
-        elif not self.authorize_message(data):
+        elif not await self.authorize_message(data, ws):
             await self.send_unauthorized_response(ws)
+            return "unauthorized"
 
         elif msg_type == "all_files_request":
             await self.handle_all_files(data["username"], ws)
 
+        elif msg_type == "file_request" and data.get("stream"):
+            await self.handle_stream_file(data["filename"],
+                                          self.get_file_owner(data), ws)
+
         elif msg_type == "file_request":
-            await self.handle_send_file(data["filename"], owner_name,
-                                        ws)
+            await self.handle_send_file(data["filename"],
+                                        self.get_file_owner(data), ws)
 
         elif msg_type == "patch":
             await self.handle_new_patch(
-                data["file_id"], data["content"], message)
+                data["file_id"], data["content"], raw_message, ws)
+
+        elif msg_type == "patch_batch":
+            await self.handle_patch_batch(
+                data["file_id"], data["content"], raw_message, ws)
 
         elif msg_type == "create_file_request":
             await self.handle_create_file(
                 data["filename"], data["username"], ws)
 
         elif msg_type == "save_file_request":
-            await self.handle_save_file(data["filename"], owner_name,
-                                        ws)
+            await self.handle_save_file(data["filename"],
+                                        self.get_file_owner(data), ws)
 
         elif msg_type == "file_share_request":
-            await self.handle_share_file(owner_name,
+            await self.handle_share_file(self.get_file_owner(data),
                                          data["share_user"],
                                          data["filename"], ws)
+
+        elif msg_type == "profile_request":
+            await self.handle_profile(data["username"], data.get("seconds"),
+                                      ws)
         else:
             logging.info("unsupported event: {}", data)
+            return "unsupported"
+        return msg_type
 
     async def unregister(self, ws) -> None:
         """
-        Remove websocket from active authors list
+        Remove websocket from registered connections and its room, give
+        its send queue a moment to flush
         :type ws: WebSocketServerProtocol
         """
-        author = next((author for author in self.active_authors if author[
-            "connection"] == ws), None)
-        self.active_authors.remove(author)
+        session = self.rooms.get_session(ws)
+        file_id = session.current_file if session else None
+        self.rooms.unregister(ws)
+        if session is not None:
+            await session.queue.close()
+            self.dropped_frames += session.queue.dropped
+        if file_id is not None:
+            self.file_service.release(file_id)
+            await self.trim_files()
 
-    async def handle_client(self, ws, _) -> None:
+    async def handle_client(self, ws, _=None) -> None:
         """
         Websocket connection handler.
         :type ws: WebSocketServerProtocol
         :type _: Any
         """
         logging.info(f'New client {ws}')
-        logging.info(' ({} existing clients)'.format(len(self.active_authors)))
+        logging.info(' ({} existing clients)'.format(len(self.rooms)))
         try:
             async for message in ws:
                 await self.handle_message(message, ws)
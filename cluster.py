@@ -0,0 +1,413 @@
+"""
+Cluster mode: several server nodes serve the same files, so that clients
+of one document may be spread over nodes behind a load balancer. Nodes
+exchange patches of the files they have loaded over a publish/subscribe
+transport, one topic per file id. A node that loads a file other nodes
+already edit asks them for a snapshot, as their changes may not be saved
+yet. Changes of users' files and shares are published on the users topic.
+
+LocalBroker is a stand-in for a real message broker, serving nodes over
+TCP or a unix socket with the framing of the ipc module.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import secrets
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Set, Tuple
+
+import ipc
+from file_service import FileService
+
+SUBSCRIBE = 1
+SUBSCRIBED = 2
+UNSUBSCRIBE = 3
+PUBLISH = 4
+MESSAGE = 5
+
+
+def parse_address(address) -> Tuple[str, ...]:
+    """
+    :param address: host:port of a TCP socket or path of a unix socket
+    :type address: str
+    :return: ("tcp", host, port) or ("unix", path)
+    """
+    host, _, port = address.rpartition(":")
+    if host and port.isdigit() and "/" not in address:
+        return "tcp", host, int(port)
+    return "unix", address
+
+
+def encode_topic(topic, data=b"") -> bytes:
+    """
+    :type topic: str
+    :type data: bytes
+    :return: payload of a broker frame
+    """
+    return topic.encode("utf-8") + b"\0" + data
+
+
+def decode_topic(payload) -> Tuple[str, bytes]:
+    """
+    :type payload: bytes
+    :return: topic and data of a broker frame
+    """
+    topic, _, data = payload.partition(b"\0")
+    return topic.decode("utf-8"), data
+
+
+class PubSub(ABC):
+    """
+    Publish/subscribe transport between cluster nodes. Message published
+    by a node is delivered to every other node subscribed to its topic,
+    messages of a node are delivered in the order they were published.
+    """
+
+    def __init__(self) -> None:
+        # called with topic and data of every received message
+        self.on_message: Callable[[str, bytes], None] = \
+            lambda topic, data: None
+
+    @abstractmethod
+    async def connect(self) -> None:
+        """
+        Connect to the transport
+        """
+
+    @abstractmethod
+    async def subscribe(self, topic) -> int:
+        """
+        :type topic: str
+        :return: number of other nodes subscribed to the topic
+        """
+
+    @abstractmethod
+    async def unsubscribe(self, topic) -> None:
+        """
+        :type topic: str
+        """
+
+    @abstractmethod
+    def publish(self, topic, data) -> None:
+        """
+        Publish message without waiting for its delivery
+        :type topic: str
+        :type data: bytes
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class LocalBroker:
+    """
+    Message broker for nodes on one machine or in one network. Messages
+    are kept only in socket buffers, nothing is persisted.
+    """
+
+    def __init__(self) -> None:
+        self.subscribers: Dict[str, Set[asyncio.StreamWriter]] = {}
+        self.delivered = 0
+        self.__server: asyncio.AbstractServer or None = None
+
+    async def start(self, address) -> None:
+        """
+        Start serving nodes
+        :param address: host:port or unix socket path
+        :type address: str
+        """
+        kind, *where = parse_address(address)
+        if kind == "tcp":
+            self.__server = await asyncio.start_server(self.__serve, *where)
+        else:
+            self.__server = await asyncio.start_unix_server(self.__serve,
+                                                            *where)
+        logging.info(f"Broker listening on {address}")
+
+    def close(self) -> None:
+        if self.__server is not None:
+            self.__server.close()
+
+    async def __serve(self, reader, writer) -> None:
+        """
+        Serve frames of a node connection
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        """
+        topics = set()
+        try:
+            while True:
+                frame = await ipc.read_frame(reader)
+                if frame is None:
+                    break
+                kind, request_id, payload = frame
+                topic, data = decode_topic(payload)
+                subscribers = self.subscribers.get(topic, set())
+                if kind == SUBSCRIBE:
+                    others = len(subscribers - {writer})
+                    self.subscribers.setdefault(topic, set()).add(writer)
+                    topics.add(topic)
+                    writer.write(ipc.encode_frame(
+                        SUBSCRIBED, request_id, str(others).encode("ascii")))
+                elif kind == UNSUBSCRIBE:
+                    self.__leave(writer, topic)
+                    topics.discard(topic)
+                elif kind == PUBLISH:
+                    message = ipc.encode_frame(MESSAGE, 0, payload)
+                    for subscriber in subscribers:
+                        if subscriber is not writer:
+                            subscriber.write(message)
+                            self.delivered += 1
+        finally:
+            for topic in topics:
+                self.__leave(writer, topic)
+            writer.close()
+
+    def __leave(self, writer, topic) -> None:
+        subscribers = self.subscribers.get(topic)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.subscribers[topic]
+
+
+class BrokerClient(PubSub):
+    """
+    Transport connected to a LocalBroker
+    """
+
+    def __init__(self, address) -> None:
+        """
+        :param address: host:port or unix socket path of the broker
+        :type address: str
+        """
+        super().__init__()
+        self.address = address
+        self.__writer: asyncio.StreamWriter or None = None
+        self.__requests: Dict[int, asyncio.Future] = {}
+        self.__ids = itertools.count(1)
+
+    async def connect(self) -> None:
+        kind, *where = parse_address(self.address)
+        if kind == "tcp":
+            reader, self.__writer = await asyncio.open_connection(*where)
+        else:
+            reader, self.__writer = await asyncio.open_unix_connection(*where)
+        asyncio.ensure_future(self.__read(reader))
+
+    async def subscribe(self, topic) -> int:
+        request_id = next(self.__ids)
+        answer = asyncio.get_running_loop().create_future()
+        self.__requests[request_id] = answer
+        self.__writer.write(ipc.encode_frame(SUBSCRIBE, request_id,
+                                             encode_topic(topic)))
+        return await answer
+
+    async def unsubscribe(self, topic) -> None:
+        self.__writer.write(ipc.encode_frame(UNSUBSCRIBE, 0,
+                                             encode_topic(topic)))
+        await self.__writer.drain()
+
+    def publish(self, topic, data) -> None:
+        self.__writer.write(ipc.encode_frame(PUBLISH, 0,
+                                             encode_topic(topic, data)))
+
+    def close(self) -> None:
+        if self.__writer is not None:
+            self.__writer.close()
+
+    async def __read(self, reader) -> None:
+        """
+        Dispatch frames of the broker
+        :type reader: asyncio.StreamReader
+        """
+        while True:
+            frame = await ipc.read_frame(reader)
+            if frame is None:
+                logging.info(f"Broker {self.address} connection closed")
+                break
+            kind, request_id, payload = frame
+            if kind == MESSAGE:
+                self.on_message(*decode_topic(payload))
+            elif kind == SUBSCRIBED:
+                answer = self.__requests.pop(request_id, None)
+                if answer is not None and not answer.done():
+                    answer.set_result(int(payload))
+        for answer in self.__requests.values():
+            if not answer.done():
+                answer.set_exception(ConnectionError("Broker is gone"))
+        self.__requests.clear()
+
+
+class ClusterRelay:
+    """
+    Exchanges patches of loaded files with the other nodes of a cluster.
+    Node subscribes to the topic of a file when a client requests it and
+    leaves the topic when the file is evicted from memory.
+    """
+    USERS_TOPIC = "users"
+
+    def __init__(self, handler, transport, sync_timeout=2.0) -> None:
+        """
+        :param handler: client handler of this node
+        :param transport: publish/subscribe transport
+        :param sync_timeout: seconds to wait for a snapshot of a file from
+        other nodes, file is loaded from disk if none arrives
+        :type handler: ClientHandler
+        :type transport: PubSub
+        :type sync_timeout: float
+        """
+        self.handler = handler
+        self.file_service: FileService = handler.file_service
+        self.transport = transport
+        self.sync_timeout = sync_timeout
+        self.node_id = secrets.token_hex(8)
+        self.topics: Set[str] = set()
+        self.published = 0
+        self.received = 0
+        self.syncs = 0
+        # patches received while the file is being joined, by file id
+        self.__buffers: Dict[str, List[List[str]]] = {}
+        self.__snapshots: Dict[str, asyncio.Future] = {}
+        self.__joins: Dict[str, asyncio.Future] = {}
+        handler.relay = self
+        handler.publish_users = self.publish_users
+        transport.on_message = self.__on_message
+
+    async def start(self) -> None:
+        await self.transport.connect()
+        await self.transport.subscribe(self.USERS_TOPIC)
+
+    def close(self) -> None:
+        self.transport.close()
+
+    def publish(self, file_id, patches) -> None:
+        """
+        Publish patches registered on this node
+        :type file_id: str
+        :param patches: JSON encoded or decoded patches
+        :type patches: List[str or dict]
+        """
+        if file_id not in self.topics:
+            return
+        self.__send(file_id, "patches", patches=[
+            patch if isinstance(patch, str) else
+            json.dumps(patch, sort_keys=True) for patch in patches])
+        self.published += 1
+
+    def publish_users(self, usernames) -> None:
+        """
+        :param usernames: logins of users whose files or shares changed
+        :type usernames: List[str]
+        """
+        self.__send(self.USERS_TOPIC, "users", users=usernames)
+
+    async def join(self, username, filename) -> None:
+        """
+        Subscribe to the topic of a file and load it, from a snapshot of
+        another node if some node has it loaded
+        :param username: file owner
+        :type username: str
+        :type filename: str
+        """
+        file_id = FileService.get_file_id(username, filename)
+        if file_id in self.topics and file_id not in self.__joins:
+            return
+        if file_id in self.__joins:
+            await asyncio.shield(self.__joins[file_id])
+            return
+        done = asyncio.get_running_loop().create_future()
+        self.__joins[file_id] = done
+        self.__buffers[file_id] = []
+        self.topics.add(file_id)
+        try:
+            await self.__join(file_id, username, filename)
+        finally:
+            buffered = self.__buffers.pop(file_id)
+            del self.__joins[file_id]
+            done.set_result(None)
+        for patches in buffered:
+            await self.handler.handle_remote_patches(file_id, patches)
+
+    async def __join(self, file_id, username, filename) -> None:
+        snapshot = None
+        if await self.transport.subscribe(file_id):
+            snapshot = await self.__request_snapshot(file_id)
+        if await self.file_service.load_file_async(username,
+                                                   filename) is None:
+            self.topics.discard(file_id)
+            await self.transport.unsubscribe(file_id)
+            return
+        if snapshot is None:
+            return
+        # documents carry no tombstones, so unsaved changes of a document
+        # loaded outside the topic, e.g. recovered from the patch log,
+        # cannot be merged with deletes of the peer
+        if file_id in self.file_service.dirty:
+            logging.info(f"Dropping unsaved changes of {file_id} for the "
+                         f"snapshot of another node")
+        self.file_service.adopt_snapshot(file_id, snapshot)
+        self.syncs += 1
+
+    async def __request_snapshot(self, file_id) -> List[str] or None:
+        """
+        Ask nodes that have the file loaded for its snapshot
+        :type file_id: str
+        :return: insert patches of the document, None if no node answered
+        """
+        answer = asyncio.get_running_loop().create_future()
+        self.__snapshots[file_id] = answer
+        self.__send(file_id, "sync")
+        try:
+            return await asyncio.wait_for(answer, self.sync_timeout)
+        except asyncio.TimeoutError:
+            logging.info(f"No snapshot of {file_id} from other nodes")
+            return None
+        finally:
+            self.__snapshots.pop(file_id, None)
+
+    async def prune(self) -> None:
+        """
+        Leave topics of files that are no longer loaded
+        """
+        for file_id in list(self.topics):
+            if file_id not in self.file_service.documents and \
+                    file_id not in self.__joins:
+                self.topics.discard(file_id)
+                await self.transport.unsubscribe(file_id)
+
+    def __send(self, topic, kind, **fields) -> None:
+        self.transport.publish(topic, json.dumps(
+            {"node": self.node_id, "kind": kind, **fields}).encode("utf-8"))
+
+    def __on_message(self, topic, data) -> None:
+        """
+        Handle message of another node
+        :type topic: str
+        :type data: bytes
+        """
+        try:
+            message = json.loads(data.decode("utf-8"))
+            kind = message["kind"]
+        except (ValueError, KeyError, TypeError):
+            logging.info(f"Malformed cluster message on {topic}")
+            return
+        if kind == "users":
+            self.handler.apply_user_changes(message["users"])
+        elif kind == "patches":
+            self.received += 1
+            if topic in self.__buffers:
+                self.__buffers[topic].append(message["patches"])
+            else:
+                asyncio.ensure_future(self.handler.handle_remote_patches(
+                    topic, message["patches"]))
+        elif kind == "sync":
+            doc = self.file_service.documents.get(topic)
+            if doc is not None and topic not in self.__buffers:
+                self.__send(topic, "snapshot", to=message["node"],
+                            patches=doc.patches)
+        elif kind == "snapshot" and message.get("to") == self.node_id:
+            answer = self.__snapshots.get(topic)
+            if answer is not None and not answer.done():
+                answer.set_result(message["patches"])
@@ -0,0 +1,24 @@
+import pytest
+
+
+def pytest_addoption(parser) -> None:
+    parser.addoption("--run-benchmarks", action="store_true",
+                     help="run timing tests marked as benchmark")
+
+
+def pytest_configure(config) -> None:
+    config.addinivalue_line(
+        "markers", "benchmark: timing test against a recorded baseline, "
+                   "skipped unless --run-benchmarks is given")
+
+
+def pytest_collection_modifyitems(config, items) -> None:
+    """
+    Skip timing tests by default, they depend on the load of the machine
+    """
+    if config.getoption("--run-benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="timing test, run with --run-benchmarks")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
@@ -1,5 +1,5 @@
-from random import randint, getrandbits
-from typing import Dict
+from random import Random, randint
+from typing import Dict, List
 from .char_position import CharPosition
 
 
@@ -45,23 +45,82 @@ class Allocator:
         else:
             res = q.convert_to_int(depth) - alloc_step
 
-        sites_len = depth - len(p.sites)
-        sites = p.sites + [self._site] * sites_len
-        sites[-1] = self._site
+        return self.__create(res, depth, p, q)
 
-        return CharPosition.create_from_int(res, depth, sites,
-                                            base_bits=p.base_bits)
+    def allocate_many(self, p, q, count) -> List[CharPosition]:
+        """
+        Generate count evenly spaced positions between provided ones in a
+        single pass. Positions are allocated at the shallowest depth that
+        fits all of them, allocation is deterministic.
+        :param p: character pos
+        :param q: character pos
+        :param count: number of positions
+        :type p: CharPosition
+        :type q: CharPosition
+        :type count: int
+        :return: allocated positions in ascending order
+        """
+        if count < 1:
+            return []
+        if p.position == q.position and p.sites == q.sites:
+            raise Exception("Provided p and q are equal. Cannot allocate.")
+
+        depth = 0
+        interval = 0
+        while interval < count:
+            depth += 1
+            interval, _ = p.get_interval_between(q, depth)
+
+            if depth > self.MAX_DEPTH:
+                raise Exception("Max depth reached. Aborting.")
+
+        # leave equal gaps before, between and after new positions
+        step = (interval + 1) // (count + 1)
+        start = p.convert_to_int(depth)
+        return [self.__create(start + step * i, depth, p, q)
+                for i in range(1, count + 1)]
+
+    def __create(self, res, depth, p, q) -> CharPosition:
+        """
+        Create position from integer representation allocated between p
+        and q. Levels equal to p or q keep their site, so that the new
+        position is ordered between them, the last level gets the site of
+        the allocator, so that no other site allocates the same position.
+        :type res: int
+        :type depth: int
+        :type p: CharPosition
+        :type q: CharPosition
+        """
+        levels = CharPosition.int_to_levels(res, depth, p.base_bits)
+        sites = []
+        follows_p = follows_q = True
+        for index, pos in enumerate(levels[:-1]):
+            p_pos, p_site = p.level(index)
+            follows_p = follows_p and pos == p_pos
+            follows_q = follows_q and index < len(q.position) and \
+                pos == q.position[index]
+            if follows_p:
+                sites.append(p_site)
+            elif follows_q:
+                sites.append(q.sites[index])
+            else:
+                sites.append(self._site)
+        sites.append(self._site)
+        return CharPosition(levels, sites, base_bits=p.base_bits)
 
     def get_strategy(self, depth: int):
         """
         If it was not allocated before, picks random allocation strategy
-        (boundary+ or boundary-) for specified depth.
+        (boundary+ or boundary-) for specified depth. Strategy of a depth
+        is seeded by the depth, so that every site picks the same one and
+        sites typing at the same place do not fill gaps from both sides.
         :param depth: depth level
         :type depth: int
         :return True if boundary+, False if boundary-
         """
         if depth not in self.__strategy_history:
-            self.__strategy_history[depth] = bool(getrandbits(1))
+            self.__strategy_history[depth] = bool(
+                Random(depth).getrandbits(1))
 
         return self.__strategy_history[depth]
 
@@ -1,25 +1,59 @@
+import struct
 from typing import List, Tuple
 
+# tree level of a packed key: level marker, pos, site shifted to unsigned
+LEVEL = struct.Struct(">BIQ")
+LEVEL_MARKER = 1
+SITE_OFFSET = 1 << 63
+# site of the levels below the end of a position, ordered before every
+# site, as a position is ordered before all positions in its subtree
+MIN_SITE = -SITE_OFFSET
+
 
 class CharPosition:
     """
     Defines a character pos in CRDT document tree.
     Every element is part of the tree path.
+    Positions are immutable. Sort key is computed once on creation: every
+    (pos, site) level packed to bytes, so that keys compare the same way
+    as lists of (pos, site) pairs.
     """
     BASE_BITS = 5
+    __slots__ = ("position", "sites", "base_bits", "key")
 
     def __init__(self, position=None, sites=None, base_bits=0) -> None:
         """
         :param position: array of int specifying char pos
         :param sites: array of author ids for each tree level
         :param base_bits:
-        :type position: List[int]
-        :type sites: List[int]
+        :type position: Sequence[int]
+        :type sites: Sequence[int]
         :type base_bits: int
         """
-        self.position = position or []
-        self.sites = sites or []
-        self.base_bits = base_bits or self.BASE_BITS
+        position = tuple(position or ())
+        sites = tuple(sites or ())
+        init = object.__setattr__
+        init(self, "position", position)
+        init(self, "sites", sites)
+        init(self, "base_bits", base_bits or self.BASE_BITS)
+        init(self, "key", self.pack_levels(position, sites))
+
+    @staticmethod
+    def pack_levels(position, sites) -> bytes:
+        """
+        Pack position levels to a sort key. Sites beyond position depth
+        do not take part in ordering and are not packed.
+        :type position: Sequence[int]
+        :type sites: Sequence[int]
+        :return: packed levels
+        """
+        if len(position) > len(sites):
+            raise ValueError("Every position level must have a site")
+        try:
+            return b"".join([LEVEL.pack(LEVEL_MARKER, pos, site + SITE_OFFSET)
+                             for pos, site in zip(position, sites)])
+        except struct.error as e:
+            raise ValueError(f"Position out of range: {e}")
 
     @classmethod
     def create_from_int(cls, position, depth, sites, base_bits=0) -> \
@@ -36,13 +70,29 @@ class CharPosition:
         :type base_bits: int
         :return: generated CharPosition object
         """
-        result = cls(sites=sites, base_bits=base_bits)
+        base_bits = base_bits or cls.BASE_BITS
+        return cls(cls.int_to_levels(position, depth, base_bits), sites,
+                   base_bits=base_bits)
+
+    @staticmethod
+    def int_to_levels(position, depth, base_bits) -> List[int]:
+        """
+        Split integer representation of pos to tree levels
+        :param position: pos index
+        :param depth: pos depth
+        :param base_bits: pos base bits
+        :type position: int
+        :type depth: int
+        :type base_bits: int
+        :return: pos of every level
+        """
+        result = [0] * depth
 
         for curr_depth in range(depth, 0, -1):
             shift = base_bits + curr_depth - 1
 
             # ref to pdf algorithm
-            result.position.insert(0, position & (1 << shift) - 1)
+            result[curr_depth - 1] = position & (1 << shift) - 1
             position >>= shift
 
         return result
@@ -58,10 +108,11 @@ class CharPosition:
             else self.position
 
         result = 0
+        base_bits = self.base_bits
         for curr_depth, i in enumerate(pos_as_list):
 
             # Append '0' and place 'i'
-            result = (result << (self.base_bits + curr_depth)) | int(i)
+            result = (result << (base_bits + curr_depth)) | i
 
         return result
 
@@ -73,14 +124,48 @@ class CharPosition:
         :param depth: depth level
         :type other_pos: CharPosition
         :type depth: int
+        :return: interval and True if it is counted after current pos only,
+        as other pos is ordered after the whole subtree of current one
         """
-        if self.position == other_pos.position and self.sites[-1] \
-                != other_pos.sites[-1] and depth > len(self.position):
-            return self.interval_at(depth), True
+        level = self.__site_split(other_pos)
+        if level is not None and depth > level + 1:
+            # every position below current one at the level where sites
+            # differ is ordered before other pos
+            bits = sum(self.base_bits + curr_depth for curr_depth in
+                       range(level + 1, depth))
+            end = (self.convert_to_int(level + 1) + 1) << bits
+            return end - self.convert_to_int(depth) - 1, True
 
         return other_pos.convert_to_int(depth) - self.convert_to_int(
             depth) - 1, False
 
+    def __site_split(self, other_pos) -> int or None:
+        """
+        Find the first level where both positions differ, if they differ
+        by site only
+        :type other_pos: CharPosition
+        :return: level index, None if positions differ by pos
+        """
+        for level, (other, other_site) in enumerate(zip(other_pos.position,
+                                                        other_pos.sites)):
+            pos, site = self.level(level)
+            if pos != other:
+                return None
+            if site != other_site:
+                return level
+        return None
+
+    def level(self, index) -> Tuple[int, int]:
+        """
+        Get pos and site of a tree level, levels below the end of the
+        position have pos 0 and MIN_SITE
+        :param index: level index
+        :type index: int
+        """
+        if index < len(self.position):
+            return self.position[index], self.sites[index]
+        return 0, MIN_SITE
+
     def interval_at(self, depth) -> int:
         """
         Get interval at specified depth level
@@ -91,23 +176,16 @@ class CharPosition:
         return 2 ** (self.base_bits + depth - 1) - 1
 
     @staticmethod
-    def __cut_position(position, depth) -> List[int]:
+    def __cut_position(position, depth) -> Tuple[int]:
         """
         Cut pos to specified depth
         :param position: char pos
         :param depth: tree depth
-        :type position: List[int]
+        :type position: Tuple[int]
         :type depth: int
-        :return: resulting pos as List of int
+        :return: resulting pos as Tuple of int
         """
-        result = []
-        for curr_depth in range(depth):
-            if curr_depth < len(position):
-                result.append(position[curr_depth])
-            else:
-                result.append(0)
-
-        return result
+        return position[:depth] + (0,) * (depth - len(position))
 
     def __lt__(self, other):
         """
@@ -115,5 +193,13 @@ class CharPosition:
         """
         # order by pos
         # if equal positions, order by site id
-        return list(zip(self.position, self.sites)) < list(
-            zip(other.position, other.sites))
+        return self.key < other.key
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __repr__(self) -> str:
+        return f"CharPosition({list(self.position)}, {list(self.sites)})"
@@ -1,10 +1,21 @@
-from .char_position import CharPosition
+import struct
+
+from .char_position import CharPosition, LEVEL, LEVEL_MARKER, SITE_OFFSET
+
+# end of position levels followed by character clock
+CLOCK = struct.Struct(">BQ")
+SITE = struct.Struct(">Q")
 
 
 class Character:
     """
     Represents a character in CRDT document.
+    Characters are immutable and hold a single packed key: position levels,
+    clock and the sites beyond position depth. Key orders characters in
+    the document and is the unique identity of the character.
     """
+    __slots__ = ("char", "key", "clock")
+
     def __init__(self, char, position, clock) -> None:
         """
         :param char: character symbol
@@ -14,9 +25,67 @@ class Character:
         :param clock: document clock at the moment of char creation
         :type clock: int
         """
-        self.char = char
-        self.position = position
-        self.clock = clock
+        init = object.__setattr__
+        init(self, "char", char)
+        init(self, "clock", clock)
+        init(self, "key", position.key + self.__pack_tail(
+            position.position, position.sites, clock))
+
+    @classmethod
+    def from_key(cls, char, key, clock) -> 'Character':
+        """
+        Create character from already packed key
+        :type char: str
+        :type key: bytes
+        :type clock: int
+        """
+        result = cls.__new__(cls)
+        init = object.__setattr__
+        init(result, "char", char)
+        init(result, "clock", clock)
+        init(result, "key", key)
+        return result
+
+    @classmethod
+    def make_key(cls, position, sites, clock) -> bytes:
+        """
+        Get key of character without creating it
+        :type position: Sequence[int]
+        :type sites: Sequence[int]
+        :type clock: int
+        :return: packed character key
+        """
+        return CharPosition.pack_levels(position, sites) + cls.__pack_tail(
+            position, sites, clock)
+
+    @staticmethod
+    def __pack_tail(position, sites, clock) -> bytes:
+        """
+        Pack clock and sites that are beyond position depth
+        """
+        try:
+            return CLOCK.pack(0, clock) + b"".join(
+                [SITE.pack(site + SITE_OFFSET) for site in
+                 sites[len(position):]])
+        except struct.error as e:
+            raise ValueError(f"Character clock or site out of range: {e}")
+
+    @property
+    def position(self) -> CharPosition:
+        """
+        Unpack pos of char in document tree
+        """
+        key = self.key
+        position, sites = [], []
+        offset = 0
+        while key[offset] == LEVEL_MARKER:
+            _, pos, site = LEVEL.unpack_from(key, offset)
+            position.append(pos)
+            sites.append(site - SITE_OFFSET)
+            offset += LEVEL.size
+        sites.extend(site - SITE_OFFSET for site, in
+                     SITE.iter_unpack(key[offset + CLOCK.size:]))
+        return CharPosition(position, sites)
 
     @property
     def author(self) -> int:
@@ -27,4 +96,10 @@ class Character:
         return self.position.sites[-1]
 
     def __lt__(self, other) -> bool:
-        return self.position < other.position
+        return self.key < other.key
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"{type(self).__name__} is immutable")
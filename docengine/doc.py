@@ -1,7 +1,8 @@
 import json
-from typing import List
+from operator import attrgetter
+from typing import Dict, Iterator, List
 
-from sortedcontainers import SortedList
+from sortedcontainers import SortedKeyList
 
 from .allocator import Allocator
 from .character import Character
@@ -18,7 +19,12 @@ class Doc:
         self.__site: int = site
         self._alloc = Allocator(self.site)
         self.__clock: int = 0
-        self.__doc: SortedList[Character] = SortedList()
+        # ordered by packed character keys, compared without calling
+        # back into Python code
+        self.__doc: SortedKeyList[Character] = SortedKeyList(
+            key=attrgetter("key"))
+        # key of every non-boundary character, keys are identities
+        self.__index: Dict[bytes, Character] = {}
         self.__doc.add(Character("", CharPosition([0], [-1]), self.__clock))
         base_bits = CharPosition.BASE_BITS
         self.__doc.add(Character("", CharPosition([2 ** base_bits - 1], [-1]),
@@ -36,10 +42,50 @@ class Doc:
         self.__clock += 1
         p, q = self.__doc[position].position, self.__doc[position + 1].position
 
-        new_char = Character(char, self._alloc(p, q), self.__clock)
-        self.__doc.add(new_char)
+        new_position = self._alloc(p, q)
+        new_char = Character(char, new_position, self.__clock)
+        self.__add(new_char)
 
-        return self.__export("i", new_char)
+        return self.__export("i", new_char, new_position)
+
+    def insert_text(self, position, text) -> List[str]:
+        """
+        Insert text at specified document pos. Positions of all characters
+        are allocated in a single pass and added to the document in bulk.
+        :param position: flat pos index in document text
+        :param text: text to insert
+        :type position: int
+        :type text: str
+        :return: patches with insert operation of every character
+        """
+        return [self.__export("i", char) for char in
+                self.__insert_many(position, text)]
+
+    def load_text(self, text) -> None:
+        """
+        Load text to the beginning of the document without exporting
+        patches. Loading the same text to empty documents of the same site
+        always produces the same characters.
+        :param text: text to load
+        :type text: str
+        """
+        self.__insert_many(0, text)
+
+    def __insert_many(self, position, text) -> List[Character]:
+        """
+        Insert characters of text at specified document pos
+        :type position: int
+        :type text: str
+        :return: inserted characters
+        """
+        p, q = self.__doc[position].position, self.__doc[position + 1].position
+        positions = self._alloc.allocate_many(p, q, len(text))
+        clock = self.__clock
+        chars = [Character(char, pos, clock + i) for i, (char, pos) in
+                 enumerate(zip(text, positions), 1)]
+        self.__clock += len(chars)
+        self.__add_many(chars)
+        return chars
 
     def delete(self, position) -> str:
         """
@@ -50,55 +96,201 @@ class Doc:
         """
         self.__clock += 1
         old_char = self.__doc[position + 1]
-        self.__doc.remove(old_char)
+        self.__remove(old_char)
         return self.__export("d", old_char)
 
-    def apply_patch(self, raw_patch) -> None:
+    def apply_patch(self, raw_patch) -> bool:
         """
-        Apply existing patch to internal document
+        Apply existing patch to internal document. Applying an insert of
+        a character that is already present or a delete of a character
+        that is absent does nothing.
         :param raw_patch: raw patch
         :type raw_patch: str
+        :return: True if document was changed, otherwise False
         """
-        patch = json.loads(raw_patch)
+        return self.apply_operation(json.loads(raw_patch))
+
+    def apply_operation(self, patch, edits=None) -> bool:
+        """
+        Apply already decoded patch to internal document, same as
+        apply_patch.
+        :param patch: patch with op, char, pos, sites and clock
+        :param edits: list to append the change of the text to, as
+        [start, end, text] replacing text[start:end]
+        :type patch: dict
+        :type edits: List[list]
+        :return: True if document was changed, otherwise False
+        """
+        key = Character.make_key(patch["pos"], patch["sites"], patch["clock"])
         if patch["op"] == "i":
-            patch = Character(patch["char"], CharPosition(
-                patch["pos"], patch["sites"]), patch["clock"])
-            self.__doc.add(patch)
-        elif patch["op"] == "d":
-            patch = next(c for c in self.__doc if
-                         c.position.position == patch["pos"] and
-                         c.position.sites == patch["sites"] and
-                         c.clock == patch["clock"]
-                         )
-            self.__doc.remove(patch)
+            char = self.__check_char(patch["char"])
+            if key in self.__index:
+                return False
+            new_char = Character.from_key(char, key, patch["clock"])
+            self.__add(new_char)
+            if edits is not None:
+                index = self.__locate(new_char) - 1
+                edits.append([index, index, char])
+            return True
+        if patch["op"] == "d" and key in self.__index:
+            index = self.__remove(self.__index[key]) - 1
+            if edits is not None:
+                edits.append([index, index + 1, ""])
+            return True
+        return False
+
+    def apply_operations(self, patches, edits=None) -> int:
+        """
+        Apply decoded patches in order. Every patch is validated before the
+        document is changed, so a malformed batch changes nothing.
+        Consecutive inserts are added to the document in bulk.
+        :param patches: patches with op, char, pos, sites and clock
+        :param edits: list to append changes of the text to, same as in
+        apply_operation, adjacent inserted characters are a single change
+        :type patches: List[dict]
+        :type edits: List[list]
+        :return: number of patches that changed the document
+        """
+        keys = []
+        for patch in patches:
+            if patch["op"] == "i":
+                self.__check_char(patch["char"])
+            elif patch["op"] != "d":
+                raise ValueError(f"Unknown operation {patch['op']!r}")
+            keys.append(Character.make_key(patch["pos"], patch["sites"],
+                                           patch["clock"]))
+
+        changed = 0
+        inserts: Dict[bytes, Character] = {}
+        for patch, key in zip(patches, keys):
+            if patch["op"] == "i":
+                if key not in self.__index and key not in inserts:
+                    inserts[key] = Character.from_key(patch["char"], key,
+                                                      patch["clock"])
+                continue
+            if inserts:
+                changed += self.__add_inserts(list(inserts.values()), edits)
+                inserts = {}
+            if key in self.__index:
+                index = self.__remove(self.__index[key]) - 1
+                if edits is not None:
+                    edits.append([index, index + 1, ""])
+                changed += 1
+        if inserts:
+            changed += self.__add_inserts(list(inserts.values()), edits)
+        return changed
+
+    @staticmethod
+    def __check_char(char) -> str:
+        """
+        Validate character of an insert patch
+        :param char: decoded char of the patch
+        :raises TypeError: if char is not a string
+        :raises ValueError: if char is not a single character
+        :return: char
+        """
+        if not isinstance(char, str):
+            raise TypeError(f"Character must be a string, not {char!r}")
+        if len(char) != 1:
+            raise ValueError(f"Expected a single character, got {char!r}")
+        return char
+
+    def __add(self, char) -> None:
+        """
+        Add character to the document and to the identity index
+        :type char: Character
+        """
+        self.__doc.add(char)
+        self.__index[char.key] = char
+
+    def __add_many(self, chars) -> int:
+        """
+        Add characters to the document and to the identity index in bulk
+        :type chars: List[Character]
+        :return: number of added characters
+        """
+        self.__doc.update(chars)
+        self.__index.update((char.key, char) for char in chars)
+        return len(chars)
+
+    def __add_inserts(self, chars, edits) -> int:
+        """
+        Add inserted characters in bulk and append changes of the text to
+        edits, if not None. Runs of adjacent characters are a single
+        change, changes are in text order.
+        :type chars: List[Character]
+        :type edits: List[list]
+        :return: number of added characters
+        """
+        added = self.__add_many(chars)
+        if edits is None:
+            return added
+        start, run = 0, []
+        for index, char in sorted((self.__locate(char) - 1, char.char)
+                                  for char in chars):
+            if run and index != start + len(run):
+                edits.append([start, start, "".join(run)])
+                run = []
+            if not run:
+                start = index
+            run.append(char)
+        if run:
+            edits.append([start, start, "".join(run)])
+        return added
+
+    def __remove(self, char) -> int:
+        """
+        Remove character from the document and from the identity index
+        :type char: Character
+        :return: index the character had, including the begin boundary
+        """
+        index = self.__locate(char)
+        del self.__doc[index]
+        del self.__index[char.key]
+        return index
+
+    def __locate(self, char) -> int:
+        """
+        Find index of character in the document by bisection
+        :type char: Character
+        :return: index of character including the begin boundary
+        """
+        return self.__doc.bisect_key_left(char.key)
 
     @staticmethod
-    def __export(op, char) -> str:
+    def __export(op, char, position=None) -> str:
         """
         Export serialized operation on specified character.
         :param op: operation (insert/delete)
         :param char: character
+        :param position: pos of character if it is already unpacked
         :type op: str
         :type char: Character
+        :type position: CharPosition
         :return: operation serialized as json
         """
+        position = position or char.position
         patch = {
             "op": op,
             "char": char.char,
-            "pos": char.position.position,
-            "sites": char.position.sites,
+            "pos": position.position,
+            "sites": position.sites,
             "clock": char.clock,
         }
         return json.dumps(patch, sort_keys=True)
 
-    def get_real_position(self, patch):
+    def get_real_position(self, patch) -> int or None:
+        """
+        Get index of patch character in the document
+        :param patch: raw patch
+        :type patch: str
+        :return: index including the begin boundary, None if character
+        is not in the document
+        """
         json_char = json.loads(patch)
-        idx = next((i for i, c in enumerate(self.__doc) if
-                    c.position.position == json_char["pos"] and
-                    c.position.sites == json_char["sites"] and
-                    c.clock == json_char["clock"]
-                    ), None)
-        return idx
+        char = self.__index.get(Character.make_key(
+            json_char["pos"], json_char["sites"], json_char["clock"]))
+        return None if char is None else self.__locate(char)
 
     @property
     def site(self) -> int:
@@ -114,6 +306,12 @@ class Doc:
         self.__site = value
         self._alloc = Allocator(value)
 
+    def __len__(self) -> int:
+        """
+        Number of characters in the document
+        """
+        return len(self.__doc) - 2
+
     @property
     def text(self) -> str:
         return "".join([c.char for c in self.__doc])
@@ -125,3 +323,20 @@ class Doc:
     @property
     def patch_set(self) -> set:
         return {self.__export("i", c) for c in self.__doc[1:-1]}
+
+    def iter_patches(self) -> Iterator[str]:
+        """
+        Lazily export insert patches of the characters that are in the
+        document at the moment of the call, in document order. Document
+        may be changed while patches are iterated.
+        """
+        # references are copied now, patches are serialized on demand
+        chars = list(self.__doc.islice(1, len(self.__doc) - 1))
+        return (self.__export("i", char) for char in chars)
+
+    @property
+    def patches(self) -> List[str]:
+        """
+        Insert patches of all document characters in document order
+        """
+        return [self.__export("i", c) for c in self.__doc[1:-1]]
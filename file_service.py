@@ -1,112 +1,710 @@
+import asyncio
 import hashlib
+import json
 import logging
+import os
+import socket
+from collections import OrderedDict
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterator, List, Set, Tuple
 
 from docengine import Doc
+from patch_log import PatchLog
 
 
 class FileService:
     """
-    Performs all operations with files - loads, saves, applies patches
+    Performs all operations with files - loads, saves, applies patches.
+    Every loaded file is kept as a live document that is updated by
+    each registered patch. Version of a file is the number of patches
+    registered since it was loaded. With a patch log, changes of the text
+    made by registered patches are also written to disk until the file is
+    saved, and documents with unsaved changes are recovered from the log
+    on startup. Files changed since they were loaded or saved are dirty.
+    Loaded files are a cache limited by memory budget: files that no
+    connection has open are evicted in least recently used order, after
+    they are saved, and loaded again when they are requested.
     """
-    def __init__(self, users_dir):
+    # estimated memory of a document character, see
+    # benchmarks/bench_char_memory.py
+    CHAR_BYTES = 240
+
+    def __init__(self, users_dir, keep_history=False, patch_log=None,
+                 memory_budget=None):
+        """
+        :param users_dir: users files directory
+        :param keep_history: keep list of all registered patches of files
+        :param patch_log: on-disk log of unsaved changes
+        :param memory_budget: estimated memory of loaded files in bytes
+        to keep, unlimited if None
+        :type users_dir: Path
+        :type keep_history: bool
+        :type patch_log: PatchLog
+        :type memory_budget: int
+        """
         self.users_dir = users_dir
-        self.patch_history = {}
+        self.keep_history = keep_history
+        self.patch_log = patch_log
+        self.memory_budget = memory_budget
+        # least recently used files first
+        self.documents: Dict[str, Doc] = OrderedDict()
+        self.versions: Dict[str, int] = {}
+        self.patch_history: Dict[str, List[str]] = {}
+        self.paths: Dict[str, Path] = {}
+        self.dirty: Set[str] = set()
+        # hash of the text on disk of every loaded file, None if unknown
+        self.saved_hashes: Dict[str, str or None] = {}
+        self.writes = 0
+        self.unchanged_saves = 0
+        # number of connections that have file open
+        self.open_counts: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__history_bytes: Dict[str, int] = {}
+        self.__save_locks: Dict[str, asyncio.Lock] = {}
 
-    def register_patch(self, file_id, raw_patch) -> None:
+    def register_patch(self, file_id, raw_patch) -> bool:
         """
-        Register document patch in patch history of the file with
-        specified file id
+        Apply document patch to the live document of the file with
+        specified file id and register it in patch history
         :param file_id: unique id of the file
         :param raw_patch: encoded patch
         :type file_id: str
         :type raw_patch: str
+        :return: True if patch changed the document, otherwise False
+        """
+        if file_id not in self.documents:
+            return False
+        try:
+            patch = json.loads(raw_patch)
+        except (ValueError, TypeError):
+            logging.info(f"Failed to decode patch {raw_patch} of {file_id}")
+            return False
+        return self.register_operation(file_id, patch, raw_patch)
+
+    def register_operation(self, file_id, patch, raw_patch=None) -> bool:
+        """
+        Register already decoded document patch, same as register_patch
+        :param file_id: unique id of the file
+        :param patch: decoded patch
+        :param raw_patch: JSON encoded patch, if known
+        :type file_id: str
+        :type patch: dict
+        :type raw_patch: str
+        :return: True if patch changed the document, otherwise False
+        """
+        doc = self.documents.get(file_id)
+        if doc is None:
+            return False
+        edits = None if self.patch_log is None else []
+        try:
+            if not doc.apply_operation(patch, edits):
+                return False
+        except (ValueError, KeyError, TypeError):
+            logging.info(f"Failed to apply patch {patch} to {file_id}")
+            return False
+        self.versions[file_id] += 1
+        self.dirty.add(file_id)
+        if self.keep_history:
+            self.__add_history(file_id, [
+                raw_patch or json.dumps(patch, sort_keys=True)])
+        if edits:
+            self.patch_log.append(file_id, edits)
+        return True
+
+    def register_patches(self, file_id, patches) -> bool:
+        """
+        Register ordered batch of document patches atomically: either all
+        of them are applied and appended to patch history, or, if any of
+        them is malformed, none is.
+        :param file_id: unique id of the file
+        :param patches: JSON encoded or already decoded patches
+        :type file_id: str
+        :type patches: List[str or dict]
+        :return: True if batch was registered, otherwise False
+        """
+        doc = self.documents.get(file_id)
+        if doc is None:
+            return False
+        edits = None if self.patch_log is None else []
+        try:
+            decoded = [patch if isinstance(patch, dict) else json.loads(patch)
+                       for patch in patches]
+            changed = doc.apply_operations(decoded, edits)
+        except (ValueError, KeyError, TypeError):
+            logging.info(f"Failed to apply batch of {len(patches)} patches "
+                         f"to {file_id}")
+            return False
+        self.versions[file_id] += changed
+        if changed:
+            self.dirty.add(file_id)
+        if self.keep_history:
+            self.__add_history(file_id, [
+                patch if isinstance(patch, str) else
+                json.dumps(patch, sort_keys=True) for patch in patches])
+        if edits:
+            self.patch_log.append(file_id, edits)
+        return True
+
+    def __add_history(self, file_id, raw_patches) -> None:
+        """
+        Append registered patches to patch history
+        :type file_id: str
+        :type raw_patches: List[str]
+        """
+        self.patch_history[file_id].extend(raw_patches)
+        self.__history_bytes[file_id] += sum(map(len, raw_patches))
+
+    def recover(self) -> int:
+        """
+        Rebuild documents of files that have unsaved changes in the patch
+        log, replaying them on top of the text on disk. Log that does not
+        match the file on disk is discarded.
+        :return: number of recovered documents
+        """
+        if self.patch_log is None:
+            return 0
+        recovered = 0
+        for file_id, header, records in self.patch_log.replay():
+            path = self.users_dir / header["username"] / header["filename"]
+            text = self.try_read_file(path)
+            edits = None if text is None else PatchLog.edits_since(
+                header, records, PatchLog.text_hash(text))
+            doc = None if edits is None else self.__replay(text, edits)
+            if doc is None:
+                logging.info(f"Patch log of {file_id} does not match "
+                             f"{path}, discarding it")
+                self.patch_log.discard(file_id)
+                continue
+            self.documents[file_id] = doc
+            self.versions[file_id] = len(edits)
+            self.paths[file_id] = path
+            self.saved_hashes[file_id] = PatchLog.text_hash(text)
+            self.dirty.add(file_id)
+            if self.keep_history:
+                self.__set_history(file_id, doc.patches)
+            recovered += 1
+        return recovered
+
+    @classmethod
+    def __replay(cls, text, edits) -> Doc or None:
+        """
+        Create server document of the text with edits from patch log
+        :type text: str
+        :type edits: List[list]
+        :return: document, None if edits do not fit the text
         """
-        if file_id in self.patch_history:
-            self.patch_history[file_id].append(raw_patch)
+        doc = cls.make_document(text)
+        try:
+            for start, end, inserted in edits:
+                for _ in range(end - start):
+                    doc.delete(start)
+                if inserted:
+                    doc.insert_text(start, inserted)
+        except (ValueError, TypeError, IndexError):
+            return None
+        return doc
+
+    def adopt_snapshot(self, file_id, patches) -> bool:
+        """
+        Replace loaded document with a snapshot of the same file received
+        from another node of the cluster, that has changes not saved to
+        disk yet. The changed part of the text is appended to patch log.
+        :param file_id: unique id of the file
+        :param patches: JSON encoded insert patches of all characters
+        :type file_id: str
+        :type patches: List[str]
+        :return: True if document was replaced, False if it is not loaded
+        or snapshot is malformed
+        """
+        if file_id not in self.documents:
+            return False
+        doc = Doc()
+        try:
+            doc.apply_operations([json.loads(patch) for patch in patches])
+        except (ValueError, KeyError, TypeError):
+            logging.info(f"Failed to apply snapshot of {file_id}")
+            return False
+        previous = self.documents[file_id].text
+        self.documents[file_id] = doc
+        self.versions[file_id] += 1
+        self.dirty.add(file_id)
+        if self.keep_history:
+            self.__set_history(file_id, doc.patches)
+        if self.patch_log is not None:
+            self.patch_log.append(file_id, self.diff(previous, doc.text))
+        return True
+
+    @staticmethod
+    def diff(old, new) -> List[list]:
+        """
+        :type old: str
+        :type new: str
+        :return: single edit replacing the part of old text that differs
+        from new text, no edits if texts are equal
+        """
+        if old == new:
+            return []
+        start = 0
+        limit = min(len(old), len(new))
+        while start < limit and old[start] == new[start]:
+            start += 1
+        end = 0
+        while end < limit - start and old[-end - 1] == new[-end - 1]:
+            end += 1
+        return [[start, len(old) - end, new[start:len(new) - end]]]
 
     def get_patches(self, username, filename) -> Tuple[str, List[str]] or None:
         """
-        Load all patches for file of user from history. If no patches in
-        history, try to load from disk. If there still no
-        file patches available, return None.
+        Load all patches for file of user. If file is not loaded yet, try
+        to load it from disk. If there still no file available, return None.
+        Without patch history, insert patches of the current document
+        content are returned.
+        :param username: user login
+        :param filename: file name
+        :type username: str
+        :type filename: str
+        :return: unique file id and file patches
+        """
+        file_id = self.load_file(username, filename)
+        if file_id is None:
+            return None
+        if self.keep_history:
+            return file_id, self.patch_history[file_id]
+        return file_id, self.documents[file_id].patches
+
+    def get_snapshot(self, username, filename) -> \
+            Tuple[str, int, List[str]] or None:
+        """
+        Get compacted snapshot of the file: insert patches of characters
+        that are currently in the document, in document order. Applying
+        the snapshot gives the same document as applying the whole history.
         :param username: user login
         :param filename: file name
         :type username: str
         :type filename: str
-        :return: unique file id and file patch history
+        :return: unique file id, file version and snapshot patches,
+        None if file is not available
+        """
+        file_id = self.load_file(username, filename)
+        if file_id is None:
+            return None
+        return file_id, self.versions[file_id], \
+            self.documents[file_id].patches
+
+    def iter_snapshot(self, username, filename, chunk_bytes) -> \
+            Tuple[str, int, Iterator[List[str]]] or None:
+        """
+        Get snapshot of the file split to chunks. Snapshot is taken at the
+        moment of the call, patches are serialized while chunks are
+        consumed.
+        :param username: user login
+        :param filename: file name
+        :param chunk_bytes: size limit of patches in a chunk, a chunk
+        always holds at least one patch
+        :type username: str
+        :type filename: str
+        :type chunk_bytes: int
+        :return: unique file id, file version and iterator over lists of
+        snapshot patches, None if file is not available
+        """
+        file_id = self.load_file(username, filename)
+        if file_id is None:
+            return None
+        return (file_id,) + self.iter_document(file_id, chunk_bytes)
+
+    def iter_document(self, file_id, chunk_bytes) -> \
+            Tuple[int, Iterator[List[str]]] or None:
+        """
+        Get snapshot of already loaded file split to chunks, same as
+        iter_snapshot
+        :param file_id: unique id of the file
+        :param chunk_bytes: size limit of patches in a chunk
+        :type file_id: str
+        :type chunk_bytes: int
+        :return: file version and iterator over lists of snapshot patches,
+        None if file is not loaded
+        """
+        doc = self.documents.get(file_id)
+        if doc is None:
+            return None
+        return self.versions[file_id], self.__chunk(doc.iter_patches(),
+                                                    chunk_bytes)
+
+    @staticmethod
+    def __chunk(patches, chunk_bytes) -> Iterator[List[str]]:
+        """
+        Group patches to chunks of limited size
+        :type patches: Iterator[str]
+        :type chunk_bytes: int
+        """
+        chunk, size = [], 0
+        for patch in patches:
+            if chunk and size + len(patch) > chunk_bytes:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(patch)
+            size += len(patch)
+        if chunk:
+            yield chunk
+
+    def load_file(self, username, filename) -> str or None:
+        """
+        Load file of user from disk if it is not loaded yet
+        :param username: user login
+        :param filename: file name
+        :type username: str
+        :type filename: str
+        :return: unique file id, None if file is not available
         """
         file_id = self.get_file_id(username, filename)
-        if file_id not in self.patch_history:
-            file_path = self.users_dir / username / filename
-            file_patches = self.try_load_file(file_path)
-            if file_patches is not None:
-                self.patch_history[file_id] = file_patches
-            else:
-                return None
-        return file_id, self.patch_history[file_id]
+        if file_id in self.documents:
+            self.__touch(file_id)
+            return file_id
+        file_path = self.users_dir / username / filename
+        text = self.try_read_file(file_path)
+        if text is None:
+            return None
+        self.__add_document(file_id, username, filename, text)
+        return file_id
+
+    async def load_file_async(self, username, filename, executor=None) -> \
+            str or None:
+        """
+        Load file of user, same as load_file, reading it from disk in
+        executor
+        :param username: user login
+        :param filename: file name
+        :param executor: executor to read file in, default one if None
+        :type username: str
+        :type filename: str
+        :type executor: Executor
+        :return: unique file id, None if file is not available
+        """
+        file_id = self.get_file_id(username, filename)
+        if file_id in self.documents:
+            self.__touch(file_id)
+            return file_id
+        text = await asyncio.get_running_loop().run_in_executor(
+            executor, self.try_read_file, self.users_dir / username / filename)
+        if text is None:
+            return None
+        # file may have been loaded while it was read
+        if file_id not in self.documents:
+            self.__add_document(file_id, username, filename, text)
+        return file_id
+
+    def __add_document(self, file_id, username, filename, text) -> None:
+        """
+        Add live document of file loaded from text
+        :type file_id: str
+        :type username: str
+        :type filename: str
+        :type text: str
+        """
+        self.misses += 1
+        file_doc = self.make_document(text)
+        self.documents[file_id] = file_doc
+        self.versions[file_id] = 0
+        self.paths[file_id] = self.users_dir / username / filename
+        text_hash = PatchLog.text_hash(text)
+        self.saved_hashes[file_id] = text_hash
+        if self.keep_history:
+            self.__set_history(file_id, file_doc.patches)
+        if self.patch_log is not None:
+            self.patch_log.track(file_id, username, filename, text_hash)
+
+    def __set_history(self, file_id, patches) -> None:
+        """
+        :type file_id: str
+        :type patches: List[str]
+        """
+        self.patch_history[file_id] = patches
+        self.__history_bytes[file_id] = sum(map(len, patches))
+
+    def __touch(self, file_id) -> None:
+        """
+        Count cache hit and mark file as the most recently used
+        :type file_id: str
+        """
+        self.hits += 1
+        self.documents.move_to_end(file_id)
+
+    def acquire(self, file_id) -> None:
+        """
+        Mark file as open by a connection, open files are never evicted
+        :type file_id: str
+        """
+        self.open_counts[file_id] = self.open_counts.get(file_id, 0) + 1
+
+    def release(self, file_id) -> None:
+        """
+        Mark file as closed by a connection
+        :type file_id: str
+        """
+        count = self.open_counts.get(file_id, 0) - 1
+        if count > 0:
+            self.open_counts[file_id] = count
+        else:
+            self.open_counts.pop(file_id, None)
+            if file_id in self.documents:
+                self.documents.move_to_end(file_id)
+
+    def memory_usage(self) -> int:
+        """
+        :return: estimated memory of loaded files in bytes
+        """
+        return sum(self.__memory(file_id) for file_id in self.documents)
+
+    def __memory(self, file_id) -> int:
+        """
+        :type file_id: str
+        :return: estimated memory of loaded file in bytes
+        """
+        return len(self.documents[file_id]) * self.CHAR_BYTES + \
+            self.__history_bytes.get(file_id, 0)
+
+    async def trim(self, executor=None) -> int:
+        """
+        Evict files that no connection has open, least recently used
+        first, until loaded files fit in memory budget. Dirty files are
+        saved before eviction, files that fail to save are kept.
+        :param executor: executor to write files in, default one if None
+        :type executor: Executor
+        :return: number of evicted files
+        """
+        if self.memory_budget is None:
+            return 0
+        usage = self.memory_usage()
+        evicted = 0
+        for file_id in list(self.documents):
+            if usage <= self.memory_budget:
+                break
+            if file_id in self.open_counts:
+                continue
+            if file_id in self.dirty:
+                await self.save_document(file_id, executor)
+            # file may have been opened or changed while it was saved
+            if file_id in self.open_counts or file_id in self.dirty or \
+                    file_id not in self.documents:
+                continue
+            usage -= self.__memory(file_id)
+            self.__evict(file_id)
+            evicted += 1
+        return evicted
+
+    def __evict(self, file_id) -> None:
+        """
+        Drop saved file from memory. Its patch log is no longer needed, as
+        the file is loaded from disk next time.
+        :type file_id: str
+        """
+        for state in (self.documents, self.versions, self.patch_history,
+                      self.paths, self.saved_hashes, self.__history_bytes,
+                      self.__save_locks):
+            state.pop(file_id, None)
+        if self.patch_log is not None:
+            self.patch_log.discard(file_id)
+        self.evictions += 1
+        logging.info(f"Evicted {file_id} from memory")
+
+    def cache_stats(self) -> dict:
+        """
+        Loaded files, their estimated memory and cache counters
+        """
+        return {"files": len(self.documents),
+                "open": len(self.open_counts),
+                "memory": self.memory_usage(),
+                "budget": self.memory_budget,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+    def document_stats(self) -> Dict[str, dict]:
+        """
+        Estimated memory, length of patch history and version of every
+        loaded file by file id
+        """
+        return {file_id: {"memory": self.__memory(file_id),
+                          "history": len(self.patch_history.get(file_id, ())),
+                          "version": self.versions[file_id],
+                          "dirty": file_id in self.dirty}
+                for file_id in self.documents}
 
     def save_file(self, username, filename) -> bool:
         """
-        Save file of user to disk.
+        Save file of user to disk. Patch log of the file is truncated once
+        the file is written. File is not written if its content did not
+        change since it was loaded or saved.
         :type username: str
         :type filename: str
-        :return: True if success, if no file history loaded, or failed to save
+        :return: True if success, if file is not loaded, or failed to save
         on disk, return False.
         """
         file_id = self.get_file_id(username, filename)
-        file_path = self.users_dir / username / filename
-        return (file_id in self.patch_history) and self.try_save_file(
-            file_path, self.patch_history[file_id])
+        save = self.__prepare_save(file_id)
+        if save is None:
+            return False
+        if save[1] is None:
+            return True
+        if self.patch_log is not None:
+            self.patch_log.commit()
+        return self.__finish_save(file_id, save,
+                                  self.try_save_file(save[0], save[1]))
+
+    async def save_file_async(self, username, filename, executor=None) -> \
+            bool:
+        """
+        Save file of user to disk, same as save_file, writing it in
+        executor
+        :param executor: executor to write file in, default one if None
+        :type username: str
+        :type filename: str
+        :type executor: Executor
+        :return: True if success, otherwise False
+        """
+        return await self.save_document(self.get_file_id(username, filename),
+                                        executor)
+
+    async def save_document(self, file_id, executor=None) -> bool:
+        """
+        Save document of loaded file to disk, writing it in executor.
+        Saves of the same file never overlap.
+        :param file_id: unique id of the file
+        :param executor: executor to write file in, default one if None
+        :type file_id: str
+        :type executor: Executor
+        :return: True if success, otherwise False
+        """
+        lock = self.__save_locks.setdefault(file_id, asyncio.Lock())
+        async with lock:
+            save = self.__prepare_save(file_id)
+            if save is None:
+                return False
+            if save[1] is None:
+                return True
+            if self.patch_log is not None:
+                await self.patch_log.flush()
+            saved = await asyncio.get_running_loop().run_in_executor(
+                executor, self.try_save_file, save[0], save[1])
+            return self.__finish_save(file_id, save, saved)
+
+    def __prepare_save(self, file_id) -> \
+            Tuple[Path, str or None, str, int] or None:
+        """
+        Take text of the document to save. Unchanged text is not saved,
+        changed one is marked in patch log of the file.
+        :type file_id: str
+        :return: file path, text to save or None if it is unchanged, text
+        hash and file version, None if file is not loaded
+        """
+        doc = self.documents.get(file_id)
+        if doc is None:
+            return None
+        text = doc.text
+        text_hash = PatchLog.text_hash(text)
+        version = self.versions[file_id]
+        if text_hash == self.saved_hashes.get(file_id):
+            self.unchanged_saves += 1
+            self.__mark_clean(file_id, version)
+            return self.paths[file_id], None, text_hash, version
+        if self.patch_log is not None:
+            self.patch_log.mark_save(file_id, text_hash)
+        return self.paths[file_id], text, text_hash, version
+
+    def __finish_save(self, file_id, save, saved) -> bool:
+        """
+        :type file_id: str
+        :param save: prepared save
+        :param saved: whether text was written
+        :type save: Tuple[Path, str, str, int]
+        :type saved: bool
+        :return: saved
+        """
+        if saved:
+            self.writes += 1
+            self.saved_hashes[file_id] = save[2]
+            self.__mark_clean(file_id, save[3])
+            if self.patch_log is not None:
+                self.patch_log.checkpoint(file_id, save[2])
+        return saved
+
+    def __mark_clean(self, file_id, version) -> None:
+        """
+        Mark file clean unless it changed after the version was saved
+        :type file_id: str
+        :type version: int
+        """
+        if self.versions.get(file_id) == version:
+            self.dirty.discard(file_id)
 
     @staticmethod
-    def try_save_file(path, history) -> bool:
+    def try_save_file(path, text) -> bool:
         """
-        Try to save file of the user to the filesystem.
-        Creates a new document, applies all the patches, then saves
-        the resulting document's text to file.
+        Try to save text of the document to the filesystem. Text is
+        written to a temporary file that replaces the file, so a crash
+        never leaves a partially written file. Temporary file is named
+        after the host and process, so servers sharing the directory do
+        not write to the same one.
         :param path: path to save
-        :param history: patch history
+        :param text: document text
         :type path: Path
-        :type history: List[str]
+        :type text: str
         :return: True if successful, otherwise False
         """
-        file_doc = Doc()
-        file_doc.site = 0
-        for patch in history:
-            file_doc.apply_patch(patch)
+        temp_path = path.with_name(
+            f"{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
         try:
-            with open(path, 'w') as file:
-                file.write(file_doc.text)
+            with open(temp_path, 'w') as file:
+                file.write(text)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
             return True
         except (OSError, IOError, FileNotFoundError):
             logging.info(f"Requested [{path}] was not found!")
             return False
 
     @staticmethod
-    def try_load_file(path) -> List[str] or None:
+    def try_read_file(path) -> str or None:
         """
-        Try to load file and return it as list of encoded patches
+        Try to read text of the file
         :param path: path to file
         :type path: Path
-        :return: list of file patches encoded to string
+        :return: file content, None if file is not available
         """
         try:
             with open(path, 'r') as file:
-                file_doc = Doc()
-                file_doc.site = 0
-                pos = 0
-                result = []
-                for line in file:
-                    for char in line:
-                        result.append(file_doc.insert(pos, char))
-                        pos += 1
-            return result
+                return file.read()
         except (OSError, IOError, FileNotFoundError):
             logging.info(f"Requested [{path}] was not found!")
             return None
 
+    @classmethod
+    def try_load_file(cls, path) -> Doc or None:
+        """
+        Try to load file as a document
+        :param path: path to file
+        :type path: Path
+        :return: document with file content
+        """
+        text = cls.try_read_file(path)
+        return None if text is None else cls.make_document(text)
+
+    @staticmethod
+    def make_document(text) -> Doc:
+        """
+        Create server document of the file text. Documents of the same
+        text are always the same.
+        :type text: str
+        """
+        file_doc = Doc()
+        file_doc.site = 0
+        file_doc.load_text(text)
+        return file_doc
+
     @staticmethod
     def get_file_id(username, filename) -> str:
         """
@@ -0,0 +1,83 @@
+"""
+Framing of the channel between the router and shard workers of a sharded
+server. Every frame is a header with kind, connection id and payload
+length, followed by the payload. Connection id is assigned by the router
+to every client connection.
+
+Router to worker:
+ * ATTACH: start serving connection, payload is JSON session state
+   (username, token and protocol), empty object for a new connection.
+ * DATA: frame received from the client.
+ * DETACH: stop serving connection, client stays connected. Answered
+   with DETACHED once every frame sent to the connection is written.
+ * CLOSE: client disconnected.
+ * SLOW: router could not keep up with sending to the client.
+ * USERS: JSON list of users changed by another worker.
+Worker to router:
+ * DATA, TEXT: binary and text frame to send to the client.
+ * SESSION: JSON session state of a connection that logged in.
+ * DETACHED: answer to DETACH.
+ * CLOSE: close client connection.
+ * USERS: JSON list of users whose files or shares changed.
+"""
+import asyncio
+import json
+import struct
+from typing import Tuple
+
+ATTACH = 1
+DATA = 2
+TEXT = 3
+DETACH = 4
+DETACHED = 5
+CLOSE = 6
+SLOW = 7
+SESSION = 8
+USERS = 9
+
+HEADER = struct.Struct(">BQI")
+
+
+def encode_frame(kind, conn_id, payload=b"") -> bytes:
+    """
+    :type kind: int
+    :type conn_id: int
+    :type payload: bytes
+    """
+    return HEADER.pack(kind, conn_id, len(payload)) + payload
+
+
+def encode_json(kind, conn_id, value) -> bytes:
+    """
+    Encode frame with JSON payload
+    :type kind: int
+    :type conn_id: int
+    :type value: Any
+    """
+    return encode_frame(kind, conn_id, json.dumps(value).encode("utf-8"))
+
+
+async def read_frame(reader) -> Tuple[int, int, bytes] or None:
+    """
+    Read next frame from the channel
+    :type reader: asyncio.StreamReader
+    :return: kind, connection id and payload, None if channel is closed
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+        kind, conn_id, length = HEADER.unpack(header)
+        payload = await reader.readexactly(length) if length else b""
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    return kind, conn_id, payload
+
+
+def shard_of(file_id, workers) -> int:
+    """
+    Worker that owns the file
+    :param file_id: hex encoded file id
+    :param workers: number of workers
+    :type file_id: str
+    :type workers: int
+    """
+    return int(file_id[:8], 16) % workers
@@ -1,15 +1,31 @@
 #!/usr/bin/env python3
 import argparse
 import asyncio
+import functools
 import logging
+import multiprocessing
+import os
+import shutil
+import signal
 import socket
+import tempfile
+import time
 from pathlib import Path
+from typing import Tuple
 
 import websockets
 
+from autosave import AutosaveScheduler
+from cluster import BrokerClient, ClusterRelay, LocalBroker
 from file_service import FileService
+from metrics import MetricsServer
 from client_handler import ClientHandler
+from password_service import HashWorkerPool
+from patch_log import PatchLog
+from profiler import LoopProfiler
+from sharding import ShardRouter, WorkerHandler, run_worker
 from user_service import UserService
+from user_store import TinyDBStore, migrate, open_store
 
 logging.basicConfig(filename=".log", level=logging.DEBUG,
                     format='%(asctime)s %(message)s')
@@ -23,8 +39,25 @@ class ServerLauncher:
     listen_ip = "localhost"
     listen_port = 8080
     users_dir = "users"
+    user_db = "users.json"
+    max_message_size = 2 ** 20
+    chunk_bytes = 2 ** 16
+    send_queue_size = 1024
+    log_dir = "patch_log"
+    commit_window = 0.005
+    autosave_interval = 5.0
+    autosave_concurrency = 2
+    index_manifest = "index_manifest.json"
+    profile_dir = "profiles"
+    profile_seconds = 10.0
+    slow_callback = 0.05
 
-    def __init__(self):
+    def __init__(self, argv=None):
+        """
+        :param argv: command line arguments, sys.argv if None
+        :type argv: List[str]
+        """
+        self.start_time = time.perf_counter()
         parser = argparse.ArgumentParser(
             description='Multi text editor server launcher')
 
@@ -37,32 +70,363 @@ class ServerLauncher:
         parser.add_argument('-d', '--dir', type=str,
                             help='users files directory (relative path)',
                             required=False, default=self.users_dir)
+        parser.add_argument('--user-db', type=str,
+                            help='user database, TinyDB for .json files, '
+                                 'SQLite for others',
+                            required=False, default=self.user_db)
+        parser.add_argument('--migrate-users', type=str,
+                            help='TinyDB user database to migrate to empty '
+                                 'user database before start',
+                            required=False, default=None)
+        parser.add_argument('--index-manifest', type=str,
+                            help='manifest of user directory mtimes, '
+                                 'unchanged directories are not indexed',
+                            required=False, default=self.index_manifest)
+        parser.add_argument('--index-workers', type=int,
+                            help='number of threads indexing user '
+                                 'directories',
+                            required=False, default=None)
+        parser.add_argument('--background-index', action='store_true',
+                            help='index user directories after the server '
+                                 'starts listening, by the first worker of '
+                                 'a sharded server')
+        parser.add_argument('--max-message-size', type=int,
+                            help='size limit of incoming frames in bytes, '
+                                 'larger frames close the connection',
+                            required=False, default=self.max_message_size)
+        parser.add_argument('--chunk-size', type=int,
+                            help='size limit of streamed file frames in '
+                                 'bytes',
+                            required=False, default=self.chunk_bytes)
+        parser.add_argument('--keep-history', action='store_true',
+                            help='keep patch history of open files')
+        parser.add_argument('--memory-budget', type=int,
+                            help='memory for loaded files in MiB, idle '
+                                 'files are evicted above it',
+                            required=False, default=None)
+        parser.add_argument('--log-dir', type=str,
+                            help='directory of unsaved patch logs '
+                                 '(relative path)',
+                            required=False, default=self.log_dir)
+        parser.add_argument('--no-patch-log', action='store_true',
+                            help='keep unsaved patches only in memory')
+        parser.add_argument('--commit-window', type=float,
+                            help='seconds to group patch log writes for, '
+                                 '0 to fsync every patch',
+                            required=False, default=self.commit_window)
+        parser.add_argument('--autosave-interval', type=float,
+                            help='seconds between saves of changed files, '
+                                 '0 to save only on request',
+                            required=False, default=self.autosave_interval)
+        parser.add_argument('--autosave-concurrency', type=int,
+                            help='limit of files autosaved at once',
+                            required=False,
+                            default=self.autosave_concurrency)
+        parser.add_argument('--send-queue-size', type=int,
+                            help='limit of frames queued to a client',
+                            required=False, default=self.send_queue_size)
+        parser.add_argument('--slow-clients', type=str,
+                            choices=[ClientHandler.RESYNC,
+                                     ClientHandler.CLOSE],
+                            help='resync clients whose send queue '
+                                 'overflows with a fresh snapshot or close '
+                                 'their connections',
+                            required=False, default=ClientHandler.RESYNC)
+        parser.add_argument('--auth-cache-users', type=int,
+                            help='limit of users with cached authorization, '
+                                 'number of registered users by default',
+                            required=False, default=None)
+        parser.add_argument('--hash-workers', type=int,
+                            help='number of password hashing workers',
+                            required=False, default=None)
+        parser.add_argument('--hash-processes', action='store_true',
+                            help='hash passwords in processes instead of '
+                                 'threads')
+        parser.add_argument('--max-concurrent-hashes', type=int,
+                            help='limit of password hashes running at once',
+                            required=False, default=None)
 
-        args = parser.parse_args()
+        parser.add_argument('--workers', type=int,
+                            help='number of worker processes files are '
+                                 'sharded across, needs an SQLite user '
+                                 'database if more than 1',
+                            required=False, default=1)
+        parser.add_argument('--metrics-port', type=int,
+                            help='local HTTP port serving metrics at '
+                                 '/metrics, worker N of a sharded server '
+                                 'serves them on this port + N',
+                            required=False, default=None)
+        parser.add_argument('--admin-users', type=str, nargs='+',
+                            help='logins of users allowed to profile the '
+                                 'server with profile requests',
+                            required=False, default=[])
+        parser.add_argument('--profile-dir', type=str,
+                            help='directory of profile reports (relative '
+                                 'path), SIGUSR1 profiles the server or a '
+                                 'worker',
+                            required=False, default=self.profile_dir)
+        parser.add_argument('--profile-seconds', type=float,
+                            help='default duration of a profile',
+                            required=False, default=self.profile_seconds)
+        parser.add_argument('--slow-callback', type=float,
+                            help='seconds of an event loop callback '
+                                 'reported as slow while profiling',
+                            required=False, default=self.slow_callback)
+        parser.add_argument('--cluster', type=str,
+                            help='host:port or unix socket path of the '
+                                 'message broker of a cluster of nodes '
+                                 'serving the same files, needs an SQLite '
+                                 'user database, every node needs its own '
+                                 '--log-dir',
+                            required=False, default=None)
+        parser.add_argument('--broker', action='store_true',
+                            help='run the message broker of the cluster in '
+                                 'this node')
+
+        args = parser.parse_args(argv)
+        if args.workers > 1 and Path(args.user_db).suffix == ".json":
+            parser.error("--workers needs an SQLite --user-db")
+        if args.cluster is not None and args.workers > 1:
+            parser.error("--cluster needs a single worker")
+        if args.cluster is not None and \
+                Path(args.user_db).suffix == ".json":
+            parser.error("--cluster needs an SQLite --user-db")
+        if args.broker and args.cluster is None:
+            parser.error("--broker needs a --cluster address")
+        self.log_lock = None
+        if not args.no_patch_log:
+            # held while the server runs, workers log under the lock of
+            # the launcher
+            self.log_lock = PatchLog.lock(Path.cwd() / args.log_dir)
+            if self.log_lock is None:
+                parser.error(f"--log-dir {args.log_dir} is used by another "
+                             f"server, every cluster node needs its own")
+        self.args = args
         self.listen_ip = args.ip
         self.listen_port = args.port
         self.host = (self.listen_ip, self.listen_port)
         self.users_dir = args.dir
-        file_service = FileService(Path.cwd() / self.users_dir)
-        user_service = UserService(Path.cwd() / self.users_dir)
-        self.client_handler = ClientHandler(user_service, file_service)
+        self.max_message_size = args.max_message_size
+        self.background_index = args.background_index
+        self.client_handler, self.autosave, self.patch_log = None, None, None
+        if args.workers == 1:
+            self.client_handler, self.autosave, self.patch_log = \
+                build_server(args)
 
     def run(self) -> None:
         """
         Run a server
         """
+        if self.args.workers > 1:
+            self.run_sharded()
+            return
         try:
-            start_server = websockets.serve(self.client_handler.handle_client,
-                                            *self.host,
-                                            max_size=None, ping_timeout=100)
-            print(f"Launched on {self.listen_ip}:{self.listen_port}")
-            asyncio.get_event_loop().run_until_complete(start_server)
-            asyncio.get_event_loop().run_forever()
+            asyncio.run(self.serve())
         except socket.gaierror:
             print(f'Error launching on {self.listen_ip}:{self.listen_port}.\n'
                   f'Will exit now')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if self.patch_log is not None:
+                self.patch_log.close()
+
+    async def serve(self) -> None:
+        """
+        Serve clients in a single process until SIGTERM
+        """
+        broker, relay = None, None
+        metrics = MetricsServer(self.client_handler.metrics_snapshot)
+        if self.args.metrics_port is not None:
+            await metrics.start("localhost", self.args.metrics_port)
+        self.client_handler.profiler.profile_on_signal()
+        if self.args.broker:
+            broker = LocalBroker()
+            await broker.start(self.args.cluster)
+        if self.args.cluster is not None:
+            relay = ClusterRelay(self.client_handler,
+                                 BrokerClient(self.args.cluster))
+            await relay.start()
+        await websockets.serve(self.client_handler.handle_client, *self.host,
+                               max_size=self.max_message_size,
+                               ping_timeout=100)
+        print(f"Launched on {self.listen_ip}:{self.listen_port}")
+        logging.info(f"Listening after "
+                     f"{time.perf_counter() - self.start_time:.3f}s")
+        if self.background_index:
+            asyncio.ensure_future(self.client_handler.index_users())
+        if self.autosave is not None:
+            self.autosave.start()
+        try:
+            await wait_for_stop()
+        finally:
+            if self.autosave is not None:
+                await self.autosave.stop()
+            if relay is not None:
+                relay.close()
+            if broker is not None:
+                broker.close()
+            metrics.close()
+
+    def run_sharded(self) -> None:
+        """
+        Run a router and worker processes files are sharded across.
+        Unsaved patches are recovered and users are indexed before workers
+        start, so that workers share no startup work. Background index is
+        done by the first worker, which publishes changed users to the
+        others.
+        """
+        args = self.args
+        prepare_shards(args)
+        socket_dir = tempfile.mkdtemp(prefix="editor-shards-")
+        socket_paths = [str(Path(socket_dir) / f"worker{index}.sock")
+                        for index in range(args.workers)]
+        context = multiprocessing.get_context("spawn")
+        build = functools.partial(build_server, args, WorkerHandler,
+                                  args.workers, False)
+        processes = [context.Process(
+            target=run_worker, daemon=True,
+            args=(path, build, None if args.metrics_port is None
+                  else args.metrics_port + index,
+                  args.background_index and index == 0))
+            for index, path in enumerate(socket_paths)]
+        for process in processes:
+            process.start()
+        router = ShardRouter(socket_paths, args.send_queue_size)
+
+        def profile_workers() -> None:
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGUSR1)
+
+        async def serve() -> None:
+            await router.connect()
+            # workers handle SIGUSR1 once they accept the router
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1,
+                                                          profile_workers)
+            try:
+                await websockets.serve(router.handle_client, *self.host,
+                                       max_size=self.max_message_size,
+                                       ping_timeout=100)
+                print(f"Launched on {self.listen_ip}:{self.listen_port} "
+                      f"with {args.workers} workers")
+                logging.info(f"Listening after "
+                             f"{time.perf_counter() - self.start_time:.3f}s")
+                await wait_for_stop()
+            finally:
+                # workers stop when their channels close
+                router.close()
+
+        try:
+            asyncio.run(serve())
+        except socket.gaierror:
+            print(f'Error launching on {self.listen_ip}:{self.listen_port}.\n'
+                  f'Will exit now')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for process in processes:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+            shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+async def wait_for_stop() -> None:
+    """
+    Wait until the process receives SIGTERM
+    """
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+    await stop
+
+
+def build_server(args, handler_cls=ClientHandler, workers=1, prepare=True) \
+        -> Tuple[ClientHandler, AutosaveScheduler or None, PatchLog or None]:
+    """
+    Create services and client handler of a server process
+    :param args: parsed command line arguments
+    :param handler_cls: ClientHandler class
+    :param workers: number of processes sharing memory budget
+    :param prepare: recover patch logs, migrate and index users, otherwise
+    they are expected to be prepared by another process
+    :type args: argparse.Namespace
+    :type handler_cls: type
+    :type workers: int
+    :type prepare: bool
+    :return: client handler, autosave scheduler and patch log
+    """
+    patch_log = None
+    if not args.no_patch_log:
+        patch_log = PatchLog(Path.cwd() / args.log_dir, args.commit_window)
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = args.memory_budget * 2 ** 20 // workers
+    file_service = FileService(Path.cwd() / args.dir,
+                               keep_history=args.keep_history,
+                               patch_log=patch_log,
+                               memory_budget=memory_budget)
+    if prepare:
+        recovered = file_service.recover()
+        if recovered:
+            logging.info(f"Recovered {recovered} files from patch log")
+    autosave = None
+    if args.autosave_interval > 0:
+        autosave = AutosaveScheduler(file_service, args.autosave_interval,
+                                     args.autosave_concurrency)
+    hash_pool = HashWorkerPool(args.hash_workers, args.hash_processes,
+                               args.max_concurrent_hashes)
+    user_store = open_store(args.user_db)
+    if prepare and args.migrate_users:
+        migrate(TinyDBStore(args.migrate_users), user_store)
+    user_service = UserService(
+        Path.cwd() / args.dir, hash_pool=hash_pool, store=user_store,
+        manifest=Path.cwd() / args.index_manifest,
+        index_workers=args.index_workers,
+        index_on_start=prepare and not args.background_index)
+    client_handler = handler_cls(
+        user_service, file_service, chunk_bytes=args.chunk_size,
+        queue_size=args.send_queue_size, slow_clients=args.slow_clients,
+        auth_cache_users=args.auth_cache_users or
+        max(len(user_service.users), 1024), admins=args.admin_users,
+        max_message_size=args.max_message_size,
+        profiler=LoopProfiler(Path.cwd() / args.profile_dir,
+                              args.profile_seconds, args.slow_callback))
+    return client_handler, autosave, patch_log
+
+
+def prepare_shards(args) -> None:
+    """
+    Save files recovered from patch logs and drop their logs, migrate and
+    index users, before worker processes start. Users are not indexed with
+    background index.
+    :param args: parsed command line arguments
+    :type args: argparse.Namespace
+    """
+    if not args.no_patch_log:
+        patch_log = PatchLog(Path.cwd() / args.log_dir, 0)
+        file_service = FileService(Path.cwd() / args.dir,
+                                   patch_log=patch_log, memory_budget=0)
+        recovered = file_service.recover()
+        if recovered:
+            logging.info(f"Recovered {recovered} files from patch log")
+            # with no memory budget every recovered file is saved and
+            # evicted, which removes its log
+            asyncio.run(file_service.trim())
+        patch_log.close()
+    user_store = open_store(args.user_db)
+    if args.migrate_users:
+        migrate(TinyDBStore(args.migrate_users), user_store)
+    if not args.background_index:
+        UserService(Path.cwd() / args.dir, store=user_store,
+                    manifest=Path.cwd() / args.index_manifest,
+                    index_workers=args.index_workers)
+    user_store.close()
 
 
 if __name__ == "__main__":
+    # worker processes of a frozen executable start through this module
+    multiprocessing.freeze_support()
     launcher = ServerLauncher()
     launcher.run()
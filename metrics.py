@@ -0,0 +1,215 @@
+"""
+Server metrics cheap enough to stay on: latency histograms with fixed
+exponential buckets, patch rates of files and a local HTTP endpoint
+serving them as JSON.
+"""
+import asyncio
+import json
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict
+
+# upper bounds of histogram buckets in seconds, 1us to about 16s
+BOUNDS = tuple(1e-6 * 2 ** i for i in range(25))
+
+
+class Histogram:
+    """
+    Latency histogram. Observing a value is a bisect and two additions.
+    """
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self) -> None:
+        # last bucket counts values above the largest bound
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds) -> None:
+        """
+        :type seconds: float
+        """
+        self.counts[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction) -> float:
+        """
+        :param fraction: fraction of values, e.g. 0.99
+        :type fraction: float
+        :return: upper bound of the bucket the percentile falls in
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BOUNDS[index] if index < len(BOUNDS) else self.max
+        return 0.0
+
+    def snapshot(self) -> dict:
+        """
+        Count, sum, maximum and percentiles in seconds, counts of
+        non-empty buckets by their upper bound
+        """
+        return {"count": self.count, "sum": self.total, "max": self.max,
+                "p50": self.percentile(0.5), "p99": self.percentile(0.99),
+                "p999": self.percentile(0.999),
+                "buckets": {f"{BOUNDS[index]:.6g}" if index < len(BOUNDS)
+                            else "inf": count
+                            for index, count in enumerate(self.counts)
+                            if count}}
+
+
+class RateMeter:
+    """
+    Events per second over the last whole seconds
+    """
+    __slots__ = ("window", "counts", "second")
+
+    def __init__(self, window=10) -> None:
+        """
+        :param window: number of seconds the rate is averaged over
+        :type window: int
+        """
+        self.window = window
+        self.counts = [0] * window
+        self.second = int(time.monotonic())
+
+    def add(self, count=1) -> None:
+        """
+        :type count: int
+        """
+        self.__advance()
+        self.counts[self.second % self.window] += count
+
+    def rate(self) -> float:
+        """
+        :return: events per second in the window before current second
+        """
+        self.__advance()
+        current = self.second % self.window
+        return sum(count for index, count in enumerate(self.counts)
+                   if index != current) / (self.window - 1)
+
+    def __advance(self) -> None:
+        second = int(time.monotonic())
+        if second == self.second:
+            return
+        # clear seconds without events since the last one
+        for passed in range(self.second + 1,
+                            min(second, self.second + self.window) + 1):
+            self.counts[passed % self.window] = 0
+        self.second = second
+
+
+class Metrics:
+    """
+    Metrics of a client handler
+    """
+
+    def __init__(self) -> None:
+        self.messages: Dict[str, Histogram] = {}
+        self.broadcast = Histogram()
+        self.patch_rates: Dict[str, RateMeter] = {}
+
+    def observe_message(self, msg_type, seconds) -> None:
+        """
+        :param msg_type: type of handled message
+        :param seconds: time spent handling it
+        :type msg_type: str
+        :type seconds: float
+        """
+        histogram = self.messages.get(msg_type)
+        if histogram is None:
+            histogram = self.messages[msg_type] = Histogram()
+        histogram.observe(seconds)
+
+    def count_patches(self, file_id, count) -> None:
+        """
+        :type file_id: str
+        :type count: int
+        """
+        meter = self.patch_rates.get(file_id)
+        if meter is None:
+            meter = self.patch_rates[file_id] = RateMeter()
+        meter.add(count)
+
+    def patch_rate(self, file_id) -> float:
+        meter = self.patch_rates.get(file_id)
+        return meter.rate() if meter is not None else 0.0
+
+    def forget_files(self, loaded) -> None:
+        """
+        Drop patch rates of files that are no longer loaded
+        :param loaded: ids of loaded files
+        :type loaded: Container[str]
+        """
+        for file_id in [file_id for file_id in self.patch_rates
+                        if file_id not in loaded]:
+            del self.patch_rates[file_id]
+
+    def snapshot(self) -> dict:
+        return {"messages": {msg_type: histogram.snapshot() for
+                             msg_type, histogram in self.messages.items()},
+                "broadcast": self.broadcast.snapshot()}
+
+
+class MetricsServer:
+    """
+    Serves metrics as JSON to GET /metrics on a local HTTP port
+    """
+
+    def __init__(self, collect) -> None:
+        """
+        :param collect: returns current metrics
+        :type collect: Callable[[], dict]
+        """
+        self.collect: Callable[[], dict] = collect
+        self.__server: asyncio.AbstractServer or None = None
+
+    async def start(self, host, port) -> None:
+        """
+        :type host: str
+        :type port: int
+        """
+        self.__server = await asyncio.start_server(self.__serve, host, port)
+        logging.info(f"Metrics on http://{host}:{port}/metrics")
+
+    def close(self) -> None:
+        if self.__server is not None:
+            self.__server.close()
+
+    async def __serve(self, reader, writer) -> None:
+        """
+        Answer a single request and close the connection
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        """
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            method, path, *_ = request.decode("latin-1").split() + ["", ""]
+            status, body = "404 Not Found", b""
+            if method == "GET" and path.split("?")[0] == "/metrics":
+                try:
+                    body = json.dumps(self.collect()).encode("utf-8")
+                    status = "200 OK"
+                except Exception:
+                    logging.exception("Failed to collect metrics")
+                    status = "500 Internal Server Error"
+            writer.write(f"HTTP/1.1 {status}\r\n"
+                         f"Content-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("latin-1") +
+                         body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
@@ -1,6 +1,8 @@
+import asyncio
 import binascii
 import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 class PasswordService:
@@ -34,3 +36,80 @@ class PasswordService:
                                         salt.encode('ascii'), 100000)
         pass_hash = binascii.hexlify(pass_hash).decode('ascii')
         return pass_hash == hashed_password
+
+
+class HashWorkerPool:
+    """
+    Runs PasswordService hashing in a pool of worker threads or processes,
+    so that the event loop keeps relaying patches while passwords are
+    hashed. At most max_concurrent hashes are submitted to the pool at
+    once, the rest wait in a queue.
+    """
+
+    def __init__(self, workers=None, use_processes=False,
+                 max_concurrent=None) -> None:
+        """
+        :param workers: number of pool workers, CPU count by default
+        :param use_processes: use processes instead of threads
+        :param max_concurrent: cap on hashes running at once, equals
+        to workers by default
+        :type workers: int
+        :type use_processes: bool
+        :type max_concurrent: int
+        """
+        self.workers = workers or os.cpu_count() or 1
+        executor_cls = ProcessPoolExecutor if use_processes else \
+            ThreadPoolExecutor
+        self.executor = executor_cls(max_workers=self.workers)
+        self.max_concurrent = max_concurrent or self.workers
+        self.__semaphore = None
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.completed = 0
+
+    async def hash_password(self, password) -> str:
+        """
+        Hash provided password in the pool.
+        :type password: str
+        """
+        return await self.__run(PasswordService.hash_password, password)
+
+    async def verify_password(self, hashed_password, password) -> bool:
+        """
+        Verify password against the hash in the pool.
+        :type hashed_password: str
+        :type password: str
+        """
+        return await self.__run(PasswordService.verify_password,
+                                hashed_password, password)
+
+    @property
+    def stats(self) -> dict:
+        """
+        :return: number of queued, running and completed hashes
+        """
+        return {"queue_depth": self.queue_depth, "in_flight": self.in_flight,
+                "completed": self.completed}
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False)
+
+    async def __run(self, func, *args):
+        """
+        Wait for a free slot and run func in the pool
+        """
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.max_concurrent)
+        self.queue_depth += 1
+        try:
+            await self.__semaphore.acquire()
+        finally:
+            self.queue_depth -= 1
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self.__semaphore.release()
@@ -0,0 +1,363 @@
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, IO, Iterator, List, Tuple
+
+
+class PatchLog:
+    """
+    Append-only on-disk log of changes of unsaved files, one log per file
+    id. First line of a log is a JSON header with username, filename and
+    hash of the saved text the log is based on. Every next line is a
+    record: a list of edits made to the text by patches registered at
+    once, each edit is [start, end, text] replacing text[start:end], or
+    a save mark with hash of the text being saved. Once the save is
+    written, the log is truncated to the records appended after its mark.
+    Records are written by a single writer thread in groups: records
+    appended within the commit window share one write and one fsync.
+    """
+    SUFFIX = ".log"
+    LOCK = ".lock"
+    SAVE_MARK = '{"saved": '
+
+    def __init__(self, log_dir, commit_window=0.005) -> None:
+        """
+        :param log_dir: directory of logs
+        :param commit_window: seconds to collect records before they are
+        written, records are written and fsynced one by one if it is 0
+        :type log_dir: Path
+        :type commit_window: float
+        """
+        self.log_dir = log_dir
+        self.commit_window = commit_window
+        self.headers: Dict[str, dict] = {}
+        self.pending: Dict[str, List[str]] = {}
+        self.commits = 0
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        # open logs, used only by the writer thread
+        self.__files: Dict[str, IO] = {}
+        # hash of the text of the last save mark of a file and offset of
+        # the record after it, used only by the writer thread
+        self.__marks: Dict[str, Tuple[str, int]] = {}
+        self.__executor = ThreadPoolExecutor(max_workers=1)
+        self.__timer: asyncio.TimerHandle or None = None
+        self.__last_commit: asyncio.Future or None = None
+
+    def track(self, file_id, username, filename, base) -> None:
+        """
+        Start logging patches of a file loaded from text. Log is created
+        when the first record is written.
+        :param file_id: unique id of the file
+        :param username: owner login
+        :param filename: file name
+        :param base: hash of text the file was loaded from
+        :type file_id: str
+        :type username: str
+        :type filename: str
+        :type base: str
+        """
+        self.headers[file_id] = {"username": username, "filename": filename,
+                                 "base": base}
+
+    def append(self, file_id, edits) -> None:
+        """
+        Append edits of patches registered at once as a single record
+        :param file_id: unique id of the file
+        :param edits: edits of the text as [start, end, text]
+        :type file_id: str
+        :type edits: List[list]
+        """
+        if edits:
+            self.__append(file_id, json.dumps(edits))
+
+    def mark_save(self, file_id, text_hash) -> None:
+        """
+        Append save mark of the file, when its text is taken to be saved.
+        Mark must be on disk before the saved text replaces the file, so
+        the log can be replayed on top of either of them.
+        :param file_id: unique id of the file
+        :param text_hash: hash of the text being saved
+        :type file_id: str
+        :type text_hash: str
+        """
+        self.__append(file_id, json.dumps({"saved": text_hash}))
+
+    def checkpoint(self, file_id, text_hash) -> None:
+        """
+        Truncate log of the file to records appended after its last save
+        mark, once the text of the mark is saved. Log is based on the
+        saved text from now on.
+        :param file_id: unique id of the file
+        :param text_hash: hash of the saved text
+        :type file_id: str
+        :type text_hash: str
+        """
+        header = self.headers.get(file_id)
+        if header is None:
+            return
+        self.headers[file_id] = {**header, "base": text_hash}
+        self.__commit_pending()
+        self.__submit(self.__truncate, file_id, self.headers[file_id])
+
+    def discard(self, file_id) -> None:
+        """
+        Stop logging the file and remove its log
+        :type file_id: str
+        """
+        self.headers.pop(file_id, None)
+        self.pending.pop(file_id, None)
+        self.__submit(self.__remove, file_id)
+
+    async def flush(self) -> None:
+        """
+        Commit pending records without waiting for the commit window and
+        wait until everything appended so far is on disk
+        """
+        self.__commit_pending()
+        if self.__last_commit is not None:
+            await self.__last_commit
+
+    def commit(self) -> None:
+        """
+        Commit pending records and block until everything appended so far
+        is on disk
+        """
+        self.__commit_pending()
+        self.__executor.submit(lambda: None).result()
+
+    def close(self) -> None:
+        """
+        Commit pending records and close all logs
+        """
+        self.__commit_pending()
+        self.__executor.submit(self.__close_files).result()
+        self.__executor.shutdown()
+
+    def replay(self) -> Iterator[Tuple[str, dict, List[list or dict]]]:
+        """
+        Read all logs. Torn record at the end of a log, left by a crash
+        in the middle of a write, is cut off.
+        :return: file id, log header and records as lists of edits or save
+        marks, for every log
+        """
+        for path in sorted(self.log_dir.glob("*" + self.SUFFIX)):
+            header, records = self.__read(path)
+            if header is None:
+                logging.info(f"Patch log {path} has no header, skipping")
+                continue
+            self.headers[path.stem] = header
+            yield path.stem, header, records
+
+    @classmethod
+    def lock(cls, log_dir) -> IO or None:
+        """
+        Take an exclusive lock of the log directory, held until the lock
+        file is closed or the process exits. Only one server may log to a
+        directory, as logs of the same file would have the same path.
+        :type log_dir: Path
+        :return: open lock file, None if another process holds the lock
+        """
+        log_dir.mkdir(parents=True, exist_ok=True)
+        lock = open(log_dir / cls.LOCK, "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return None
+        return lock
+
+    @staticmethod
+    def edits_since(header, records, text_hash) -> List[list] or None:
+        """
+        Find edits to replay on top of the text on disk: all of them if
+        the log is based on that text, otherwise the ones after the last
+        save mark of that text
+        :param header: log header
+        :param records: log records
+        :param text_hash: hash of the text on disk
+        :type header: dict
+        :type records: List[list or dict]
+        :type text_hash: str
+        :return: edits in order, None if the log does not match the text
+        """
+        start = 0
+        if header.get("base") != text_hash:
+            marks = [index for index, record in enumerate(records)
+                     if isinstance(record, dict) and
+                     record.get("saved") == text_hash]
+            if not marks:
+                return None
+            start = marks[-1] + 1
+        return [edit for record in records[start:]
+                if isinstance(record, list) for edit in record]
+
+    @staticmethod
+    def text_hash(text) -> str:
+        """
+        :type text: str
+        :return: hash of text, the base of a log
+        """
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def __append(self, file_id, record) -> None:
+        """
+        :type file_id: str
+        :param record: JSON encoded record
+        :type record: str
+        """
+        if file_id not in self.headers:
+            return
+        self.pending.setdefault(file_id, []).append(record)
+        loop = self.__running_loop()
+        if loop is None or self.commit_window <= 0:
+            self.__commit_pending()
+        elif self.__timer is None:
+            self.__timer = loop.call_later(self.commit_window,
+                                           self.__on_timer)
+
+    def __on_timer(self) -> None:
+        self.__timer = None
+        self.__commit_pending()
+
+    def __commit_pending(self) -> None:
+        """
+        Hand all pending records to the writer thread
+        """
+        if self.__timer is not None:
+            self.__timer.cancel()
+            self.__timer = None
+        if not self.pending:
+            return
+        batch = {file_id: (self.headers[file_id], records)
+                 for file_id, records in self.pending.items()}
+        self.pending = {}
+        self.__submit(self.__write, batch)
+
+    def __submit(self, func, *args) -> None:
+        """
+        Run func in the writer thread, after everything submitted before.
+        Without running event loop or commit window, wait for it.
+        """
+        loop = self.__running_loop()
+        if loop is None or self.commit_window <= 0:
+            self.__executor.submit(func, *args).result()
+        else:
+            self.__last_commit = loop.run_in_executor(self.__executor, func,
+                                                      *args)
+
+    @staticmethod
+    def __running_loop() -> asyncio.AbstractEventLoop or None:
+        try:
+            return asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+
+    def __write(self, batch) -> None:
+        """
+        Write records of every file and fsync them
+        :type batch: Dict[str, Tuple[dict, List[str]]]
+        """
+        files = []
+        for file_id, (header, records) in batch.items():
+            file = self.__open(file_id, header)
+            for record in records:
+                file.write((record + "\n").encode("utf-8"))
+                if record.startswith(self.SAVE_MARK):
+                    self.__marks[file_id] = (json.loads(record)["saved"],
+                                             file.tell())
+            file.flush()
+            files.append(file)
+        for file in files:
+            os.fsync(file.fileno())
+        self.commits += 1
+
+    def __truncate(self, file_id, header) -> None:
+        """
+        Atomically replace log with the new header and records after the
+        save mark of the text the header is based on. Log without such a
+        mark is kept as it is, it still matches the saved text.
+        :type file_id: str
+        :type header: dict
+        """
+        mark = self.__marks.pop(file_id, None)
+        self.__close_file(file_id)
+        path = self.__path(file_id)
+        if mark is None or mark[0] != header["base"] or not path.exists():
+            return
+        with open(path, "rb") as file:
+            file.seek(mark[1])
+            records = file.read()
+        temp_path = path.with_suffix(".tmp")
+        with open(temp_path, "wb") as file:
+            file.write((json.dumps(header) + "\n").encode("utf-8") + records)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+        self.commits += 1
+
+    def __open(self, file_id, header) -> IO:
+        """
+        Open log for appending, write header to a new log
+        :type file_id: str
+        :type header: dict
+        """
+        file = self.__files.get(file_id)
+        if file is None:
+            file = open(self.__path(file_id), "ab")
+            if file.tell() == 0:
+                file.write((json.dumps(header) + "\n").encode("utf-8"))
+            self.__files[file_id] = file
+        return file
+
+    def __remove(self, file_id) -> None:
+        self.__marks.pop(file_id, None)
+        self.__close_file(file_id)
+        try:
+            self.__path(file_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def __close_file(self, file_id) -> None:
+        file = self.__files.pop(file_id, None)
+        if file is not None:
+            file.close()
+
+    def __close_files(self) -> None:
+        for file_id in list(self.__files):
+            self.__close_file(file_id)
+
+    def __path(self, file_id) -> Path:
+        return self.log_dir / (file_id + self.SUFFIX)
+
+    @staticmethod
+    def __read(path) -> Tuple[dict or None, List[list or dict]]:
+        """
+        Read log, cut off torn record at its end
+        :type path: Path
+        :return: header and records of the log
+        """
+        with open(path, "rb") as file:
+            data = file.read()
+        header, records, offset = None, [], 0
+        while offset < len(data):
+            end = data.find(b"\n", offset)
+            if end < 0:
+                break
+            try:
+                value = json.loads(data[offset:end].decode("utf-8"))
+            except ValueError:
+                break
+            if header is None:
+                header = value
+            else:
+                records.append(value)
+            offset = end + 1
+        if offset < len(data):
+            logging.info(f"Cutting torn record off patch log {path}")
+            os.truncate(path, offset)
+        return header, records
@@ -0,0 +1,258 @@
+"""
+On-demand profiling of a running server: cProfile of the event loop
+thread for a fixed time together with slow callback detection of asyncio
+debug mode, written to a report that groups results by message handler.
+Work done in other threads or processes, such as password hashing, shows
+up as time the handlers wait, not as time they run.
+"""
+import asyncio
+import cProfile
+import logging
+import os
+import pstats
+import re
+import signal
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# coroutines dispatching messages to handlers, not handlers themselves
+DISPATCHERS = {"handle_client", "handle_message", "route_message"}
+OTHER = "other"
+SLOW_CALLBACK = re.compile(r"Executing (.*) took ([\d.]+) seconds")
+TASK_NAME = re.compile(r"name='([^']*)'")
+CALLBACK_NAME = re.compile(r"(?:coro=<|<\w+ )([\w.]+)\(")
+
+
+def is_handler(name) -> bool:
+    """
+    :param name: function name
+    :type name: str
+    """
+    return name.startswith("handle_") and name not in DISPATCHERS
+
+
+def coroutine_chain(task) -> List[str]:
+    """
+    :type task: asyncio.Task
+    :return: names of coroutines the task is suspended in, outermost first
+    """
+    names = []
+    awaited = task.get_coro()
+    while awaited is not None:
+        code = getattr(awaited, "cr_code", None) or \
+            getattr(awaited, "gi_code", None)
+        if code is None:
+            break
+        names.append(code.co_name)
+        awaited = getattr(awaited, "cr_await", None) or \
+            getattr(awaited, "gi_yieldfrom", None)
+    return names
+
+
+class SlowCallbacks(logging.Handler):
+    """
+    Collects slow callbacks reported by the event loop in debug mode. A
+    callback of a task is attributed to the innermost handler the task is
+    suspended in right after it, as a task step ends where it awaits.
+    """
+
+    def __init__(self, loop) -> None:
+        """
+        :type loop: asyncio.AbstractEventLoop
+        """
+        super().__init__(logging.WARNING)
+        self.loop = loop
+        # handler, seconds and description of every slow callback
+        self.callbacks: List[Tuple[str, float, str]] = []
+
+    def emit(self, record) -> None:
+        """
+        :type record: logging.LogRecord
+        """
+        match = SLOW_CALLBACK.match(record.getMessage())
+        if match is None:
+            return
+        description, seconds = match.group(1), float(match.group(2))
+        self.callbacks.append((self.find_handler(description), seconds,
+                               description))
+
+    def find_handler(self, description) -> str:
+        """
+        :param description: callback as formatted by the event loop
+        :type description: str
+        :return: name of the handler that ran the callback
+        """
+        names = []
+        task_name = TASK_NAME.search(description)
+        if task_name is not None:
+            for task in asyncio.all_tasks(self.loop):
+                if task.get_name() == task_name.group(1):
+                    names = coroutine_chain(task)
+                    break
+        if not names:
+            # finished tasks and plain callbacks are named by description
+            names = [name.rsplit(".", 1)[-1]
+                     for name in CALLBACK_NAME.findall(description)]
+        handlers = [name for name in names if is_handler(name)]
+        if handlers:
+            return handlers[-1]
+        return names[0] if names else OTHER
+
+
+class LoopProfiler:
+    """
+    Profiles the event loop it runs in for a fixed time and writes the
+    report and raw cProfile stats to a directory
+    """
+    CALLEES = 15
+    TOP_FUNCTIONS = 30
+
+    def __init__(self, directory, seconds=10.0, slow_callback=0.05) -> None:
+        """
+        :param directory: directory of reports
+        :param seconds: default duration of a profile
+        :param slow_callback: seconds of a callback reported as slow
+        :type directory: Path or str
+        :type seconds: float
+        :type slow_callback: float
+        """
+        self.directory = Path(directory)
+        self.seconds = seconds
+        self.slow_callback = slow_callback
+        self.running = False
+
+    async def profile(self, seconds=None) -> Path:
+        """
+        Profile the running event loop, one profile at a time
+        :param seconds: duration of the profile, the default one if None
+        :type seconds: float
+        :return: path of the report
+        """
+        seconds = seconds or self.seconds
+        if self.running:
+            raise RuntimeError("Profile is already running")
+        self.running = True
+        loop = asyncio.get_running_loop()
+        slow_callbacks = SlowCallbacks(loop)
+        asyncio_logger = logging.getLogger("asyncio")
+        debug, slow_duration = loop.get_debug(), loop.slow_callback_duration
+        profile = cProfile.Profile()
+        logging.info(f"Profiling for {seconds}s")
+        asyncio_logger.addHandler(slow_callbacks)
+        loop.slow_callback_duration = self.slow_callback
+        loop.set_debug(True)
+        try:
+            profile.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profile.disable()
+                loop.set_debug(debug)
+                loop.slow_callback_duration = slow_duration
+                asyncio_logger.removeHandler(slow_callbacks)
+            # stats of a busy server take a while to format, they are
+            # written off the event loop
+            path = await loop.run_in_executor(
+                None, self.write, profile, slow_callbacks, seconds)
+        finally:
+            self.running = False
+        logging.info(f"Wrote profile to {path}")
+        return path
+
+    def write(self, profile, slow_callbacks, seconds) -> Path:
+        """
+        Write raw stats and report of a finished profile
+        :type profile: cProfile.Profile
+        :type slow_callbacks: SlowCallbacks
+        :type seconds: float
+        :return: path of the report
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / \
+            f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.txt"
+        profile.dump_stats(str(path.with_suffix(".prof")))
+        path.write_text(self.report(pstats.Stats(profile), slow_callbacks,
+                                    seconds))
+        return path
+
+    async def try_profile(self, seconds=None) -> Path or None:
+        """
+        Profile unless a profile is already running
+        :type seconds: float
+        :return: path of the report, None if not profiled
+        """
+        if self.running:
+            logging.info("Profile is already running")
+            return None
+        return await self.profile(seconds)
+
+    def profile_on_signal(self, signum=signal.SIGUSR1) -> None:
+        """
+        Profile the running event loop for the default duration whenever
+        the process receives signal
+        :type signum: int
+        """
+        asyncio.get_running_loop().add_signal_handler(
+            signum, lambda: asyncio.ensure_future(self.try_profile()))
+
+    def report(self, stats, slow_callbacks, seconds) -> str:
+        """
+        :type stats: pstats.Stats
+        :type slow_callbacks: SlowCallbacks
+        :type seconds: float
+        :return: text report
+        """
+        handlers: Dict[str, List[tuple]] = {}
+        for func in stats.stats:
+            if is_handler(func[2]):
+                handlers.setdefault(func[2], []).append(func)
+        slow: Dict[str, List[Tuple[float, str]]] = {}
+        for handler, duration, description in slow_callbacks.callbacks:
+            slow.setdefault(handler, []).append((duration, description))
+
+        lines = [f"Profile of pid {os.getpid()} for {seconds}s, "
+                 f"{stats.total_tt:.3f}s on the event loop thread",
+                 "Calls of coroutines count every resume, their time is "
+                 "time running, not waiting", "",
+                 f"{'handler':<28} {'calls':>8} {'own s':>9} "
+                 f"{'total s':>9} {'slow':>5}"]
+        totals = {name: [stats.stats[func] for func in funcs]
+                  for name, funcs in handlers.items()}
+        for name in sorted(set(totals) | set(slow), key=lambda name: -sum(
+                entry[3] for entry in totals.get(name, []))):
+            entries = totals.get(name, [])
+            lines.append(f"{name:<28} {sum(e[1] for e in entries):>8} "
+                         f"{sum(e[2] for e in entries):>9.4f} "
+                         f"{sum(e[3] for e in entries):>9.4f} "
+                         f"{len(slow.get(name, [])):>5}")
+
+        for name, funcs in sorted(handlers.items()):
+            for func in funcs:
+                lines += ["", f"{name} ({func[0]}:{func[1]})",
+                          f"  {'calls':>8} {'own s':>9} {'total s':>9}  "
+                          f"callee"]
+                callees = sorted(
+                    ((callers[func], callee) for callee, (*_, callers)
+                     in stats.stats.items() if func in callers),
+                    key=lambda item: -item[0][3])
+                for (_, calls, own, total), callee in \
+                        callees[:self.CALLEES]:
+                    lines.append(f"  {calls:>8} {own:>9.4f} {total:>9.4f}  "
+                                 f"{pstats.func_std_string(callee)}")
+
+        lines += ["", f"Slow callbacks over {self.slow_callback}s"]
+        for name, durations in sorted(slow.items(),
+                                      key=lambda item: -len(item[1])):
+            durations.sort(reverse=True)
+            lines.append(f"{name}: {len(durations)}, "
+                         f"max {durations[0][0]:.3f}s")
+            lines += [f"  {duration:.3f}s {description}"
+                      for duration, description in durations[:self.CALLEES]]
+
+        lines += ["", "Top functions by total time"]
+        top = sorted(stats.stats.items(), key=lambda item: -item[1][3])
+        for func, (_, calls, own, total, _) in top[:self.TOP_FUNCTIONS]:
+            lines.append(f"{calls:>8} {own:>9.4f} {total:>9.4f}  "
+                         f"{pstats.func_std_string(func)}")
+        return "\n".join(lines) + "\n"
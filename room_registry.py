@@ -0,0 +1,164 @@
+import logging
+import secrets
+from typing import Dict, Set
+
+from websockets import WebSocketServerProtocol
+
+from send_queue import SendQueue
+from wire_protocol import JSON
+
+
+class Session:
+    """
+    State of an authorized client connection. Session token is bound
+    to the connection and is valid only until it is closed. Permissions
+    maps (owner, filename) pairs to cached permission check results.
+    Every frame to the connection goes through its bounded send queue.
+    Protocol is the encoding of frames sent to the connection.
+    """
+    __slots__ = ("connection", "current_file", "username", "token",
+                 "permissions", "queue", "protocol")
+
+    def __init__(self, connection, username=None, queue_size=1024) -> None:
+        """
+        :param connection: client websocket
+        :param username: login of authorized user
+        :param queue_size: limit of frames queued to the connection
+        :type connection: WebSocketServerProtocol
+        :type username: str
+        :type queue_size: int
+        """
+        self.connection = connection
+        self.current_file = None
+        self.username = username
+        self.token = secrets.token_urlsafe(32)
+        self.permissions: Dict[tuple, bool] = {}
+        self.queue = SendQueue(connection, queue_size)
+        self.protocol = JSON
+
+    def check_token(self, token) -> bool:
+        """
+        Compare provided token with session token in constant time
+        :type token: str
+        """
+        return isinstance(token, str) and secrets.compare_digest(
+            self.token, token)
+
+    def __repr__(self) -> str:
+        return f"Session({self.username}, {self.connection}, " \
+               f"file={self.current_file})"
+
+
+class RoomRegistry:
+    """
+    Keeps authorized connections and the rooms (files) they are editing.
+    Every file id maps to the set of sessions currently editing it and
+    every connection maps to its session, so broadcast, assignment and
+    disconnect never scan all connections.
+    """
+
+    def __init__(self, queue_size=1024) -> None:
+        """
+        :param queue_size: limit of frames queued to every connection
+        :type queue_size: int
+        """
+        self.queue_size = queue_size
+        self.sessions: Dict[WebSocketServerProtocol, Session] = {}
+        self.rooms: Dict[str, Set[Session]] = {}
+        self.users: Dict[str, Set[Session]] = {}
+
+    def register(self, ws, username=None) -> Session:
+        """
+        Register connection of the user. If connection is already registered
+        for another user, the old session is replaced with a new one.
+        :type ws: WebSocketServerProtocol
+        :type username: str
+        :return: session of the connection
+        """
+        session = self.sessions.get(ws)
+        if session is not None and session.username == username:
+            return session
+        if session is not None:
+            self.unregister(ws)
+        session = Session(ws, username, self.queue_size)
+        self.sessions[ws] = session
+        self.users.setdefault(username, set()).add(session)
+        return session
+
+    def assign(self, ws, file_id) -> Session or None:
+        """
+        Move connection to the room of specified file.
+        :type ws: WebSocketServerProtocol
+        :type file_id: str
+        :return: session of the connection, None if it is not registered
+        """
+        session = self.sessions.get(ws)
+        if session is None:
+            return None
+        self.__leave(session)
+        session.current_file = file_id
+        if file_id is not None:
+            self.rooms.setdefault(file_id, set()).add(session)
+        return session
+
+    def unregister(self, ws) -> Session or None:
+        """
+        Remove connection and its room membership.
+        :type ws: WebSocketServerProtocol
+        :return: removed session, None if it was not registered
+        """
+        session = self.sessions.pop(ws, None)
+        if session is not None:
+            self.__leave(session)
+            user_sessions = self.users.get(session.username)
+            if user_sessions is not None:
+                user_sessions.discard(session)
+                if not user_sessions:
+                    del self.users[session.username]
+            logging.info(f"Unregistered {session}")
+        return session
+
+    def get_session(self, ws) -> Session or None:
+        """
+        :type ws: WebSocketServerProtocol
+        :return: session of the connection or None
+        """
+        return self.sessions.get(ws)
+
+    def get_room(self, file_id) -> Set[Session]:
+        """
+        Get sessions that are currently editing specified file.
+        Returned set must not be modified.
+        :type file_id: str
+        """
+        return self.rooms.get(file_id, frozenset())
+
+    def invalidate_permissions(self, username, filename) -> None:
+        """
+        Drop cached permission checks of user sessions for specified
+        filename, for all files if it is None.
+        :type username: str
+        :type filename: str
+        """
+        for session in self.users.get(username, ()):
+            for key in [key for key in session.permissions if
+                        filename is None or key[1] == filename]:
+                del session.permissions[key]
+
+    def __leave(self, session) -> None:
+        """
+        Remove session from its current room, drop the room if it is empty
+        :type session: Session
+        """
+        room = self.rooms.get(session.current_file)
+        if room is not None:
+            room.discard(session)
+            if not room:
+                del self.rooms[session.current_file]
+        session.current_file = None
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def __contains__(self, ws) -> bool:
+        return ws in self.sessions
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Deque, Iterator
+
+from websockets import ConnectionClosed, WebSocketServerProtocol
+
+
+class SendQueue:
+    """
+    Bounded outbound queue of a client connection. Frames are sent by
+    a writer task, so code that puts a frame never waits for the client
+    to receive it. Writer task runs only while the queue is not empty.
+    Item of the queue is either a single frame, bytes or text, or a
+    stream: iterator over frames that are produced while the stream is
+    being sent.
+    """
+
+    def __init__(self, connection, max_size=1024) -> None:
+        """
+        :param connection: client websocket
+        :param max_size: limit of queued items
+        :type connection: WebSocketServerProtocol
+        :type max_size: int
+        """
+        self.connection = connection
+        self.max_size = max_size
+        self.items: Deque[bytes or str or Iterator[bytes]] = deque()
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.__generation = 0
+        self.__writer: asyncio.Task or None = None
+
+    def put(self, frame) -> bool:
+        """
+        Queue frame to be sent
+        :type frame: bytes or str
+        :return: False if queue is full and frame was not queued
+        """
+        return self.__put(frame)
+
+    def put_stream(self, frames) -> bool:
+        """
+        Queue stream of frames to be sent, stream takes a single item
+        of the queue
+        :type frames: Iterator[bytes]
+        :return: False if queue is full and stream was not queued
+        """
+        return self.__put(frames)
+
+    def clear(self) -> int:
+        """
+        Drop all queued items and stop sending the current stream
+        :return: number of dropped items
+        """
+        dropped = len(self.items)
+        self.items.clear()
+        self.dropped += dropped
+        self.__generation += 1
+        return dropped
+
+    async def join(self) -> None:
+        """
+        Wait until all queued items are sent
+        """
+        while self.__writer is not None and not self.__writer.done():
+            await asyncio.shield(self.__writer)
+
+    async def close(self, timeout=1.0) -> None:
+        """
+        Stop accepting items and give the writer a limited time to send
+        the queued ones
+        :type timeout: float
+        """
+        self.closed = True
+        if self.__writer is None or self.__writer.done():
+            return
+        try:
+            await asyncio.wait_for(self.__writer, timeout)
+        except asyncio.TimeoutError:
+            logging.info(f"Dropped {len(self.items)} frames to "
+                         f"{self.connection} on close")
+            self.clear()
+
+    def __put(self, item) -> bool:
+        """
+        :type item: bytes or str or Iterator[bytes]
+        """
+        if self.closed:
+            return True
+        if len(self.items) >= self.max_size:
+            return False
+        self.items.append(item)
+        if self.__writer is None or self.__writer.done():
+            self.__writer = asyncio.ensure_future(self.__write())
+        return True
+
+    async def __write(self) -> None:
+        """
+        Send queued items until the queue is empty
+        """
+        try:
+            while self.items:
+                item = self.items.popleft()
+                if isinstance(item, (bytes, str)):
+                    await self.connection.send(item)
+                    self.sent += 1
+                    continue
+                generation = self.__generation
+                while True:
+                    try:
+                        frame = next(item)
+                    except StopIteration:
+                        break
+                    except Exception:
+                        logging.info(f"Stream to {self.connection} failed",
+                                     exc_info=True)
+                        break
+                    await self.connection.send(frame)
+                    self.sent += 1
+                    # let other connections progress between frames
+                    await asyncio.sleep(0)
+                    if generation != self.__generation:
+                        break
+        except (ConnectionClosed, ConnectionResetError):
+            logging.info(f"Client {self.connection} seems to gone away")
+            self.closed = True
+            self.clear()
+
+    def __len__(self) -> int:
+        return len(self.items)
@@ -0,0 +1,465 @@
+"""
+Sharded server mode: documents are sharded by file id across worker
+processes, each running its own ClientHandler. The router accepts client
+connections and forwards the traffic of every connection to the worker
+that owns the file the connection is editing. When a connection requests
+a file of another worker, its session moves to that worker. Saves of
+files of other workers are handled by their owners without moving the
+connection. Clients see the same protocol as with a single process.
+"""
+import asyncio
+import itertools
+import json
+import logging
+from typing import Callable, Dict, List, Tuple
+
+from websockets import ConnectionClosedError
+
+import ipc
+import wire_protocol
+from client_handler import ClientHandler
+from file_service import FileService
+from metrics import MetricsServer
+from room_registry import Session
+from send_queue import SendQueue
+
+
+class WorkerConnection:
+    """
+    Client connection as seen by a worker: messages are fed by the router
+    and frames are sent back through the router channel
+    """
+
+    def __init__(self, conn_id, writer) -> None:
+        """
+        :param conn_id: connection id assigned by the router
+        :param writer: router channel
+        :type conn_id: int
+        :type writer: asyncio.StreamWriter
+        """
+        self.conn_id = conn_id
+        self.detached = False
+        self.__writer = writer
+        self.__messages: asyncio.Queue = asyncio.Queue()
+
+    def feed(self, message) -> None:
+        """
+        Queue message received from the client, None ends the connection
+        :type message: bytes or None
+        """
+        self.__messages.put_nowait(message)
+
+    def __aiter__(self) -> "WorkerConnection":
+        return self
+
+    async def __anext__(self) -> bytes:
+        message = await self.__messages.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def send(self, frame) -> None:
+        """
+        :type frame: bytes or str
+        """
+        if isinstance(frame, str):
+            self.write(ipc.TEXT, frame.encode("utf-8"))
+        else:
+            self.write(ipc.DATA, frame)
+        await self.__writer.drain()
+
+    async def close(self) -> None:
+        if not self.detached:
+            self.write(ipc.CLOSE)
+
+    def write(self, kind, payload=b"") -> None:
+        """
+        Write frame of the connection to the router channel
+        :type kind: int
+        :type payload: bytes
+        """
+        self.__writer.write(ipc.encode_frame(kind, self.conn_id, payload))
+
+    def __repr__(self) -> str:
+        return f"WorkerConnection({self.conn_id})"
+
+
+class WorkerHandler(ClientHandler):
+    """
+    ClientHandler of a shard worker. Reports logins to the router, so that
+    sessions can move between workers.
+    """
+
+    async def handle_new_client(self, auth_data, ws) -> None:
+        await super().handle_new_client(auth_data, ws)
+        session = self.rooms.get_session(ws)
+        if session is None or session.username != auth_data["username"]:
+            return
+        if isinstance(ws, WorkerConnection):
+            ws.write(ipc.SESSION, json.dumps(
+                self.session_state(session)).encode("utf-8"))
+
+    def attach(self, ws, state) -> Session or None:
+        """
+        Register connection with the session state it had on another
+        worker
+        :type ws: WorkerConnection
+        :param state: session state, empty if connection did not log in
+        :type state: dict
+        :return: session of the connection
+        """
+        if not state:
+            return None
+        session = self.rooms.register(ws, state["username"])
+        session.token = state["token"]
+        session.protocol = state["protocol"]
+        return session
+
+    @staticmethod
+    def session_state(session) -> dict:
+        """
+        :type session: Session
+        :return: state needed to restore the session on another worker
+        """
+        return {"username": session.username, "token": session.token,
+                "protocol": session.protocol}
+
+
+class ShardWorker:
+    """
+    Serves connections forwarded by the router over a unix socket channel
+    """
+
+    def __init__(self, handler, socket_path, background_index=False) -> \
+            None:
+        """
+        :type handler: WorkerHandler
+        :param socket_path: path of the channel socket
+        :param background_index: index users directory once the router
+        connects and publish changed users to the other workers
+        :type socket_path: str
+        :type background_index: bool
+        """
+        self.handler = handler
+        self.socket_path = socket_path
+        self.background_index = background_index
+        self.connections: Dict[int, WorkerConnection] = {}
+        self.__writer: asyncio.StreamWriter or None = None
+        self.__done: asyncio.Future or None = None
+
+    async def serve(self) -> None:
+        """
+        Serve the router until it disconnects
+        """
+        self.__done = asyncio.get_running_loop().create_future()
+        server = await asyncio.start_unix_server(self.__serve_router,
+                                                 self.socket_path)
+        async with server:
+            await self.__done
+
+    async def __serve_router(self, reader, writer) -> None:
+        """
+        Dispatch frames of the router channel
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        """
+        self.__writer = writer
+        self.handler.publish_users = self.__publish_users
+        if self.background_index:
+            asyncio.ensure_future(self.__index_users())
+        try:
+            while True:
+                frame = await ipc.read_frame(reader)
+                if frame is None:
+                    break
+                self.__dispatch(*frame)
+        finally:
+            for conn in self.connections.values():
+                conn.feed(None)
+            writer.close()
+            if not self.__done.done():
+                self.__done.set_result(None)
+
+    def __dispatch(self, kind, conn_id, payload) -> None:
+        conn = self.connections.get(conn_id)
+        if kind == ipc.ATTACH:
+            conn = WorkerConnection(conn_id, self.__writer)
+            self.connections[conn_id] = conn
+            self.handler.attach(conn, json.loads(payload.decode("utf-8")))
+            asyncio.ensure_future(self.__run(conn))
+        elif kind == ipc.USERS:
+            self.handler.apply_user_changes(
+                json.loads(payload.decode("utf-8")))
+        elif conn is None:
+            return
+        elif kind == ipc.DATA:
+            conn.feed(payload)
+        elif kind == ipc.DETACH:
+            conn.detached = True
+            conn.feed(None)
+        elif kind == ipc.CLOSE:
+            conn.feed(None)
+        elif kind == ipc.SLOW:
+            session = self.handler.rooms.get_session(conn)
+            if session is not None:
+                self.handler.handle_slow_client(session)
+
+    async def __run(self, conn) -> None:
+        """
+        Handle connection until it is closed or detached, answer detach
+        once all frames of the connection are written
+        :type conn: WorkerConnection
+        """
+        await self.handler.handle_client(conn, None)
+        if self.connections.get(conn.conn_id) is conn:
+            del self.connections[conn.conn_id]
+        if conn.detached:
+            conn.write(ipc.DETACHED)
+
+    def __publish_users(self, usernames) -> None:
+        self.__writer.write(ipc.encode_json(ipc.USERS, 0, usernames))
+
+    async def __index_users(self) -> None:
+        changed = await self.handler.index_users()
+        if changed:
+            self.__publish_users(changed)
+
+
+def run_worker(socket_path, build, metrics_port=None,
+               background_index=False) -> None:
+    """
+    Entry point of a worker process
+    :param socket_path: path of the channel socket
+    :param build: builds handler, autosave scheduler and patch log of
+    the worker
+    :param metrics_port: local port to serve metrics of the worker on
+    :param background_index: index users directory after the router
+    connects
+    :type socket_path: str
+    :type build: Callable[[], Tuple[WorkerHandler, AutosaveScheduler,
+    PatchLog]]
+    :type metrics_port: int
+    :type background_index: bool
+    """
+    handler, autosave, patch_log = build()
+
+    async def serve() -> None:
+        metrics = MetricsServer(handler.metrics_snapshot)
+        if metrics_port is not None:
+            await metrics.start("localhost", metrics_port)
+        if handler.profiler is not None:
+            handler.profiler.profile_on_signal()
+        if autosave is not None:
+            autosave.start()
+        try:
+            await ShardWorker(handler, socket_path, background_index).serve()
+        finally:
+            if autosave is not None:
+                await autosave.stop()
+            metrics.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if patch_log is not None:
+            patch_log.close()
+
+
+class RoutedClient:
+    """
+    Client connection as seen by the router
+    """
+    __slots__ = ("ws", "conn_id", "home", "session", "queue", "detaching")
+
+    def __init__(self, ws, conn_id, home, queue_size) -> None:
+        """
+        :param home: worker currently serving the connection
+        :type home: int
+        """
+        self.ws = ws
+        self.conn_id = conn_id
+        self.home = home
+        self.session: dict = {}
+        self.queue = SendQueue(ws, queue_size)
+        self.detaching: Dict[int, asyncio.Future] = {}
+
+
+class ShardRouter:
+    """
+    Accepts client connections and forwards them to shard workers
+    """
+
+    def __init__(self, socket_paths, queue_size=1024) -> None:
+        """
+        :param socket_paths: channel sockets of workers
+        :param queue_size: limit of frames queued to a client
+        :type socket_paths: List[str]
+        :type queue_size: int
+        """
+        self.socket_paths = socket_paths
+        self.queue_size = queue_size
+        self.clients: Dict[int, RoutedClient] = {}
+        self.moves = 0
+        self.overflows = 0
+        self.__workers: List[asyncio.StreamWriter] = []
+        self.__ids = itertools.count(1)
+
+    @property
+    def workers(self) -> int:
+        return len(self.socket_paths)
+
+    async def connect(self, retries=100, delay=0.05) -> None:
+        """
+        Connect to channels of all workers, waiting for workers to start
+        """
+        for index, path in enumerate(self.socket_paths):
+            for attempt in range(retries):
+                try:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if attempt == retries - 1:
+                        raise
+                    await asyncio.sleep(delay)
+            self.__workers.append(writer)
+            asyncio.ensure_future(self.__read_worker(index, reader))
+
+    def close(self) -> None:
+        for writer in self.__workers:
+            writer.close()
+
+    async def handle_client(self, ws, _=None) -> None:
+        """
+        Websocket connection handler.
+        :type ws: WebSocketServerProtocol
+        :type _: Any
+        """
+        conn_id = next(self.__ids)
+        client = RoutedClient(ws, conn_id, conn_id % self.workers,
+                              self.queue_size)
+        self.clients[conn_id] = client
+        self.__send(client.home, ipc.ATTACH, conn_id, b"{}")
+        try:
+            async for message in ws:
+                await self.route(client, message)
+        except (ConnectionResetError, ConnectionClosedError):
+            logging.info(f"Client {ws} seems to gone away")
+        finally:
+            self.__send(client.home, ipc.CLOSE, conn_id)
+            del self.clients[conn_id]
+            await client.queue.close()
+
+    async def route(self, client, message) -> None:
+        """
+        Forward client message to the worker that owns its file
+        :type client: RoutedClient
+        :type message: bytes or str
+        """
+        if isinstance(message, str):
+            message = message.encode("utf-8")
+        target, move = self.target(client, message)
+        if target is None or target == client.home:
+            self.__send(client.home, ipc.DATA, client.conn_id, message)
+        elif move:
+            await self.__detach(client, client.home)
+            client.home = target
+            self.moves += 1
+            self.__attach(client, target)
+            self.__send(target, ipc.DATA, client.conn_id, message)
+        else:
+            # served by the owner of the file for this message only
+            self.__attach(client, target)
+            self.__send(target, ipc.DATA, client.conn_id, message)
+            await self.__detach(client, target)
+
+    def target(self, client, message) -> Tuple[int or None, bool]:
+        """
+        Find worker that has to handle a file or save request. Other
+        messages are handled by the current worker of the connection.
+        :type client: RoutedClient
+        :type message: bytes
+        :return: worker, None for the current one, and whether connection
+        moves to the worker
+        """
+        try:
+            if wire_protocol.is_binary(message):
+                if message[0] != wire_protocol.MESSAGE:
+                    return None, False
+                data = wire_protocol.decode_message(message)
+            elif b"file_request" in message:
+                data = json.loads(message.decode("utf-8"))
+            else:
+                return None, False
+        except ValueError:
+            return None, False
+        if not isinstance(data, dict) or data.get("type") not in \
+                ("file_request", "save_file_request"):
+            return None, False
+        username = client.session.get("username") if "token" in data else \
+            data.get("username")
+        owner = data.get("owner") or username
+        filename = data.get("filename")
+        if not isinstance(owner, str) or not isinstance(filename, str):
+            return None, False
+        file_id = FileService.get_file_id(owner, filename)
+        return ipc.shard_of(file_id, self.workers), \
+            data["type"] == "file_request"
+
+    def __attach(self, client, worker) -> None:
+        self.__send(worker, ipc.ATTACH, client.conn_id,
+                    json.dumps(client.session).encode("utf-8"))
+
+    async def __detach(self, client, worker) -> None:
+        """
+        Detach connection from worker and wait until frames it sent to
+        the connection are received
+        """
+        done = asyncio.get_running_loop().create_future()
+        client.detaching[worker] = done
+        self.__send(worker, ipc.DETACH, client.conn_id)
+        await done
+
+    def __send(self, worker, kind, conn_id, payload=b"") -> None:
+        self.__workers[worker].write(ipc.encode_frame(kind, conn_id, payload))
+
+    async def __read_worker(self, index, reader) -> None:
+        """
+        Dispatch frames sent by worker
+        :type index: int
+        :type reader: asyncio.StreamReader
+        """
+        while True:
+            frame = await ipc.read_frame(reader)
+            if frame is None:
+                logging.info(f"Worker {index} channel closed")
+                for client in self.clients.values():
+                    done = client.detaching.pop(index, None)
+                    if done is not None and not done.done():
+                        done.set_result(None)
+                return
+            kind, conn_id, payload = frame
+            if kind == ipc.USERS:
+                for worker in range(self.workers):
+                    if worker != index:
+                        self.__send(worker, ipc.USERS, 0, payload)
+                continue
+            client = self.clients.get(conn_id)
+            if client is None:
+                continue
+            if kind in (ipc.DATA, ipc.TEXT):
+                frame = payload if kind == ipc.DATA else \
+                    payload.decode("utf-8")
+                if not client.queue.put(frame):
+                    self.overflows += 1
+                    client.queue.clear()
+                    self.__send(index, ipc.SLOW, conn_id)
+            elif kind == ipc.SESSION:
+                client.session = json.loads(payload.decode("utf-8"))
+            elif kind == ipc.DETACHED:
+                done = client.detaching.pop(index, None)
+                if done is not None and not done.done():
+                    done.set_result(None)
+            elif kind == ipc.CLOSE:
+                asyncio.ensure_future(client.ws.close())
@@ -0,0 +1,27 @@
+from auth_cache import AuthCache
+
+
+def test_auth_cache_invalidates_only_affected_entries():
+    cache = AuthCache(max_users=2)
+    assert not cache.check_credentials("alice", "secret")
+    cache.add_credentials("alice", "secret")
+    assert cache.check_credentials("alice", "secret")
+    assert not cache.check_credentials("alice", "wrong")
+
+    cache.add_permission("alice", None, "notes", False)
+    cache.add_permission("alice", None, "draft", True)
+    cache.add_permission("bob", "alice", "notes", True)
+    cache.invalidate("alice", "notes")
+    assert cache.get_permission("alice", None, "notes") is None
+    assert cache.get_permission("alice", None, "draft") is True
+    assert cache.get_permission("bob", "alice", "notes") is True
+    assert cache.check_credentials("alice", "secret")
+
+    # alice was used last, bob is evicted
+    cache.add_permission("carol", None, "notes", True)
+    assert cache.get_permission("bob", "alice", "notes") is None
+    assert cache.stats()["users"] == 2
+    assert cache.evictions == 1
+    assert cache.hits == 4
+    assert cache.misses == 4
+    assert cache.hit_rate == 0.5
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from autosave import AutosaveScheduler
+from docengine import Doc
+from file_service import FileService
+from patch_log import PatchLog
+
+
+@pytest.mark.asyncio
+async def test_autosave_coalesces_and_skips_unchanged(tmp_path):
+    (tmp_path / "admin").mkdir()
+    (tmp_path / "admin" / "doc").write_text("abc")
+    file_service = FileService(tmp_path)
+    file_id, patches = file_service.get_patches("admin", "doc")
+    client = Doc(site=1)
+    for patch in patches:
+        client.apply_patch(patch)
+    for i in range(5):
+        file_service.register_patch(file_id, client.insert(3 + i, "!"))
+
+    autosave = AutosaveScheduler(file_service, interval=0.01)
+    autosave.start()
+    await asyncio.sleep(0.1)
+    assert (tmp_path / "admin" / "doc").read_text() == "abc!!!!!"
+    assert file_service.writes == 1
+    assert not file_service.dirty
+
+    file_service.register_patch(file_id, client.insert(0, "x"))
+    file_service.register_patch(file_id, client.delete(0))
+    await autosave.stop()
+    assert file_service.writes == 1
+    assert file_service.unchanged_saves == 1
+    assert not file_service.dirty
+
+
+@pytest.mark.asyncio
+async def test_autosave_truncates_patch_log(tmp_path):
+    (tmp_path / "admin").mkdir()
+    (tmp_path / "admin" / "doc").write_text("a" * 20000)
+    patch_log = PatchLog(tmp_path / "log")
+    file_service = FileService(tmp_path, patch_log=patch_log)
+    file_id, patches = file_service.get_patches("admin", "doc")
+    client = Doc(site=1)
+    for patch in patches:
+        client.apply_patch(patch)
+    log_path = tmp_path / "log" / (file_id + PatchLog.SUFFIX)
+
+    autosave = AutosaveScheduler(file_service, interval=0.01)
+    autosave.start()
+    for i in range(3):
+        file_service.register_patch(file_id, client.insert(i, "!"))
+        while file_service.dirty:
+            await asyncio.sleep(0.01)
+        await patch_log.flush()
+        # the log is cut to its header, the document is not written to it
+        assert len(log_path.read_text().splitlines()) == 1
+    await autosave.stop()
+    patch_log.close()
+    assert (tmp_path / "admin" / "doc").read_text() == client.text
+
+
+@pytest.mark.asyncio
+async def test_autosave_survives_failing_document(tmp_path):
+    (tmp_path / "admin").mkdir()
+    file_ids = []
+    file_service = FileService(tmp_path)
+    for name in ("bad", "good"):
+        (tmp_path / "admin" / name).write_text(name)
+        file_id, _ = file_service.get_patches("admin", name)
+        file_service.register_patch(file_id, Doc(site=1).insert(0, "!"))
+        file_ids.append(file_id)
+    save_document = file_service.save_document
+
+    async def failing_save(file_id, executor=None) -> bool:
+        if file_id == file_ids[0]:
+            raise RuntimeError("disk on fire")
+        return await save_document(file_id, executor)
+    file_service.save_document = failing_save
+
+    autosave = AutosaveScheduler(file_service, interval=0.01)
+    autosave.start()
+    await asyncio.sleep(0.1)
+    texts = [file_service.documents[file_id].text for file_id in file_ids]
+    assert (tmp_path / "admin" / "good").read_text() == texts[1]
+    assert autosave.failed >= 2
+    assert file_service.dirty == {file_ids[0]}
+    file_service.save_document = save_document
+    await autosave.stop()
+    assert (tmp_path / "admin" / "bad").read_text() == texts[0]
@@ -1,13 +1,14 @@
 import asyncio
 import json
 import unittest
-from asyncio import Future, coroutine
+from asyncio import Future
 from unittest import mock
-from unittest.mock import MagicMock, Mock
+from unittest.mock import AsyncMock, MagicMock, Mock
 
 import pytest
 from websockets import ConnectionClosedError
 
+import wire_protocol
 from client_handler import ClientHandler
 from docengine import Doc
 from file_service import FileService
@@ -17,6 +18,11 @@ async def async_magic():
     pass
 
 
+async def flush(client_handler, *connections):
+    for ws in connections:
+        await client_handler.rooms.get_session(ws).queue.join()
+
+
 @unittest.mock.patch('client_handler.FileService')
 @unittest.mock.patch('client_handler.UserService')
 @pytest.mark.asyncio
@@ -32,6 +38,7 @@ async def test_client_handler_register(user_svc, file_svc):
     MagicMock.__await__ = lambda x: async_magic().__await__()
 
     user_svc_instance = user_svc.return_value()
+    user_svc_instance.try_reg_user_async = AsyncMock(return_value=True)
     file_svc_instance = file_svc.return_value()
     client_handler = ClientHandler(user_svc_instance, file_svc_instance)
 
@@ -55,11 +62,10 @@ async def test_client_handler_unauthorized(user_svc, file_svc):
     MagicMock.__await__ = lambda x: async_magic().__await__()
 
     user_svc_instance = user_svc.return_value()
-    user_svc_instance.auth_user.return_value = False
+    user_svc_instance.auth_user_async = AsyncMock(return_value=False)
     file_svc_instance = file_svc.return_value()
     client_handler = ClientHandler(user_svc_instance, file_svc_instance)
-    client_handler.active_authors.append(
-        {"connection": mock_client, "current_file": None})
+    client_handler.rooms.register(mock_client)
 
     await client_handler.handle_client(mock_client, None)
     response = mock_client.send.call_args.args[0]
@@ -85,15 +91,336 @@ async def test_client_handler_new_patch(user_svc, file_svc):
     MagicMock.__await__ = lambda x: async_magic().__await__()
 
     user_svc_instance = user_svc.return_value()
-    user_svc_instance.auth_user.return_value = True
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
     user_svc_instance.has_access.return_value = True
     file_svc_instance = file_svc.return_value()
-    file_svc_instance.register_patch.return_value = None
+    file_svc_instance.register_patch.return_value = True
     client_handler = ClientHandler(user_svc_instance, file_svc_instance)
-    client_handler.active_authors.append(
-        {"connection": mock_client, "current_file": file_id})
+    client_handler.rooms.register(mock_client)
+    client_handler.rooms.assign(mock_client, file_id)
 
     await client_handler.handle_client(mock_client, None)
     response = mock_client.send.call_args.args[0]
 
     assert json.loads(response)["content"] == patch
+    assert user_svc_instance.auth_user_async.await_count == 1
+    assert not user_svc_instance.auth_user.called
+
+
+@unittest.mock.patch('client_handler.FileService')
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_session_token(user_svc, file_svc):
+    mock_client = MagicMock()
+    MagicMock.__await__ = lambda x: async_magic().__await__()
+
+    user_svc_instance = user_svc.return_value()
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    user_svc_instance.check_is_author.return_value = True
+    file_svc_instance = file_svc.return_value()
+    file_svc_instance.save_file_async = AsyncMock(return_value=True)
+    client_handler = ClientHandler(user_svc_instance, file_svc_instance,
+                                   max_message_size=4096)
+
+    login = {"username": "r", "password": "r", "type": "user_login"}
+    await client_handler.handle_message(json.dumps(login).encode("utf-8"),
+                                        mock_client)
+    await flush(client_handler, mock_client)
+    response = json.loads(mock_client.send.call_args.args[0])
+    assert response["max_message_size"] == 4096
+    token = response["token"]
+
+    request = {"token": token, "filename": "test", "type": "save_file_request"}
+    for _ in range(3):
+        await client_handler.handle_message(
+            json.dumps(request).encode("utf-8"), mock_client)
+    await flush(client_handler, mock_client)
+    response = json.loads(mock_client.send.call_args.args[0])
+
+    assert response["type"] == "save_file_response"
+    assert response["success"] is True
+    assert user_svc_instance.auth_user_async.await_count == 1
+    assert not user_svc_instance.auth_user.called
+    assert user_svc_instance.check_is_author.call_count == 1
+
+    bad_request = {**request, "token": "forged"}
+    await client_handler.handle_message(
+        json.dumps(bad_request).encode("utf-8"), mock_client)
+    await flush(client_handler, mock_client)
+    response = json.loads(mock_client.send.call_args.args[0])
+    assert response["type"] == "auth_response"
+    assert response["success"] is False
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_stream_file(user_svc, tmp_path):
+    (tmp_path / "r").mkdir()
+    (tmp_path / "r" / "test").write_text("streamed document\n" * 200)
+    file_service = FileService(tmp_path)
+    client_handler = ClientHandler(user_svc.return_value, file_service,
+                                   chunk_bytes=4096)
+    file_id = FileService.get_file_id("r", "test")
+    peer_patch = Doc(site=5).insert(0, "#")
+    frames = []
+    peer_ws = MagicMock()
+    peer_ws.send = AsyncMock()
+
+    async def send(frame):
+        frames.append(frame)
+        if len(frames) == 2:
+            # a peer edits the file while it is being streamed
+            client_handler.assign_file(file_id, peer_ws)
+            asyncio.ensure_future(client_handler.handle_new_patch(
+                file_id, peer_patch, peer_patch.encode("utf-8"), peer_ws))
+
+    ws = MagicMock()
+    ws.send = AsyncMock(side_effect=send)
+    client_handler.rooms.register(ws, "r")
+    client_handler.rooms.register(peer_ws, "r")
+    await client_handler.handle_stream_file("test", "r", ws)
+    await flush(client_handler, ws)
+
+    messages = [json.loads(frame) for frame in frames]
+    assert messages[0]["stream"] == "begin"
+    assert messages[-2]["type"] == "file_stream_end"
+    assert messages[-1]["char"] == "#"
+    chunks = [m for m in messages if m.get("type") == "file_stream_chunk"]
+    assert len(chunks) > 1
+    assert all(len(json.dumps(m["content"])) < 2 * 4096 for m in chunks)
+
+    doc = Doc(site=1)
+    for patch in [p for m in chunks for p in m["content"]] + [peer_patch]:
+        doc.apply_patch(patch)
+    assert sum(len(m["content"]) for m in chunks) == messages[-2]["count"]
+    assert doc.text == file_service.documents[file_id].text
+    assert doc.text.replace("#", "") == "streamed document\n" * 200
+    assert client_handler.queue_stats()["queued"] == 0
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_binary_relay(user_svc, tmp_path):
+    (tmp_path / "r").mkdir()
+    (tmp_path / "r" / "test").write_text("relay")
+    file_service = FileService(tmp_path)
+    user_svc_instance = user_svc.return_value
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    user_svc_instance.check_is_author.return_value = True
+    client_handler = ClientHandler(user_svc_instance, file_service)
+
+    binary_ws, json_ws = MagicMock(), MagicMock()
+    binary_ws.send, json_ws.send = AsyncMock(), AsyncMock()
+    for ws, protocol in [(binary_ws, "binary"), (json_ws, "json")]:
+        login = {"username": "r", "password": "r", "type": "user_login",
+                 "protocol": protocol}
+        await client_handler.handle_message(
+            json.dumps(login).encode("utf-8"), ws)
+        await flush(client_handler, ws)
+        token = json.loads(ws.send.call_args.args[0])["token"]
+        request = {"token": token, "filename": "test", "type": "file_request"}
+        await client_handler.handle_message(
+            json.dumps(request).encode("utf-8"), ws)
+        await flush(client_handler, ws)
+
+    snapshot = wire_protocol.decode_message(binary_ws.send.call_args.args[0])
+    doc = Doc(site=1)
+    for patch in snapshot["content"]:
+        doc.apply_operation(patch)
+    frame = wire_protocol.encode_patch_frame(
+        snapshot["file_id"], json.loads(doc.insert(5, "!")))
+    await client_handler.handle_message(frame, binary_ws)
+    await flush(client_handler, binary_ws, json_ws)
+
+    assert binary_ws.send.call_args.args[0] == frame
+    relayed = json.loads(json_ws.send.call_args.args[0])
+    assert relayed["type"] == "patch"
+    assert json.loads(relayed["content"])["char"] == "!"
+    assert file_service.documents[snapshot["file_id"]].text == "relay!"
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_patch_batch(user_svc, tmp_path):
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "test").write_text("batch")
+    file_service = FileService(tmp_path)
+    user_svc_instance = user_svc.return_value
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    user_svc_instance.check_is_author.return_value = True
+    client_handler = ClientHandler(user_svc_instance, file_service)
+
+    binary_ws, json_ws = MagicMock(), MagicMock()
+    binary_ws.send, json_ws.send = AsyncMock(), AsyncMock()
+    tokens = {}
+    for ws, protocol in [(binary_ws, "binary"), (json_ws, "json")]:
+        login = {"username": "b", "password": "b", "type": "user_login",
+                 "protocol": protocol}
+        await client_handler.handle_message(
+            json.dumps(login).encode("utf-8"), ws)
+        await flush(client_handler, ws)
+        tokens[ws] = json.loads(ws.send.call_args.args[0])["token"]
+        request = {"token": tokens[ws], "filename": "test",
+                   "type": "file_request"}
+        await client_handler.handle_message(
+            json.dumps(request).encode("utf-8"), ws)
+        await flush(client_handler, ws)
+
+    snapshot = json.loads(json_ws.send.call_args.args[0])
+    doc = Doc(site=1)
+    for patch in snapshot["content"]:
+        doc.apply_patch(patch)
+    batch = {"token": tokens[json_ws], "filename": "test",
+             "type": "patch_batch", "file_id": snapshot["file_id"],
+             "content": doc.insert_text(5, " and paste")}
+    binary_ws.send.reset_mock()
+    await client_handler.handle_message(json.dumps(batch).encode("utf-8"),
+                                        json_ws)
+    await flush(client_handler, binary_ws, json_ws)
+
+    assert binary_ws.send.call_count == 1
+    relayed = wire_protocol.decode_message(binary_ws.send.call_args.args[0])
+    assert relayed["type"] == "patch_batch"
+    assert len(relayed["content"]) == 10
+    server_doc = file_service.documents[snapshot["file_id"]]
+    assert server_doc.text == "batch and paste"
+
+    frame = wire_protocol.encode_message({
+        "type": "patch_batch", "file_id": snapshot["file_id"],
+        "content": [doc.delete(0), doc.delete(0)]})
+    await client_handler.handle_message(frame, binary_ws)
+    await flush(client_handler, binary_ws, json_ws)
+    relayed = json.loads(json_ws.send.call_args.args[0])
+    assert relayed["type"] == "patch_batch"
+    assert server_doc.text == doc.text == "tch and paste"
+
+    # a batch that is not registered is not relayed
+    charless = json.loads(doc.insert(0, "x"))
+    del charless["char"]
+    json_ws.send.reset_mock()
+    batch = {**batch, "token": tokens[binary_ws],
+             "content": [doc.delete(0), json.dumps(charless)]}
+    await client_handler.handle_message(json.dumps(batch).encode("utf-8"),
+                                        binary_ws)
+    await flush(client_handler, binary_ws, json_ws)
+    assert json_ws.send.call_count == 0
+    assert server_doc.text == "tch and paste"
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_patch_other_file(user_svc, tmp_path):
+    for owner in ("a", "o"):
+        (tmp_path / owner).mkdir()
+        (tmp_path / owner / "test").write_text(owner)
+    file_service = FileService(tmp_path)
+    user_svc_instance = user_svc.return_value
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    user_svc_instance.check_is_author.return_value = True
+    client_handler = ClientHandler(user_svc_instance, file_service)
+    other_id = file_service.load_file("o", "test")
+    other_doc = file_service.documents[other_id]
+
+    ws = MagicMock()
+    ws.send = AsyncMock()
+    login = {"username": "a", "password": "a", "type": "user_login"}
+    await client_handler.handle_message(json.dumps(login).encode("utf-8"), ws)
+    await flush(client_handler, ws)
+    token = json.loads(ws.send.call_args.args[0])["token"]
+    request = {"token": token, "filename": "test", "type": "file_request"}
+    await client_handler.handle_message(json.dumps(request).encode("utf-8"),
+                                        ws)
+    await flush(client_handler, ws)
+
+    # authorized for its own file, the connection targets another one
+    doc = Doc(site=1)
+    doc.load_text("o")
+    patch = {"token": token, "filename": "test", "type": "patch",
+             "file_id": other_id, "content": doc.insert(1, "!")}
+    batch = {**patch, "type": "patch_batch",
+             "content": doc.insert_text(1, "??")}
+    for message in (patch, batch):
+        ws.send.reset_mock()
+        await client_handler.handle_message(
+            json.dumps(message).encode("utf-8"), ws)
+        await flush(client_handler, ws)
+        response = json.loads(ws.send.call_args.args[0])
+        assert response["type"] == "auth_response"
+        assert response["success"] is False
+    assert other_doc.text == "o"
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_malformed_frames(user_svc, tmp_path):
+    user_svc_instance = user_svc.return_value
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    client_handler = ClientHandler(user_svc_instance, FileService(tmp_path))
+    ws = MagicMock()
+    ws.send = AsyncMock()
+    frames = [bytes([wire_protocol.PATCH]) + b"short",
+              bytes([wire_protocol.PATCHES]),
+              bytes([wire_protocol.MESSAGE]) + b"{not json",
+              bytes([wire_protocol.MESSAGE]) + b"[]",
+              b"\xff\xfe", b"{}"]
+    for frame in frames:
+        assert await client_handler.route_message(frame, ws) == "malformed"
+        await client_handler.handle_message(frame, ws)
+    assert client_handler.metrics.messages["malformed"].count == len(frames)
+
+    # connection is still served
+    login = {"username": "m", "password": "m", "type": "user_login"}
+    await client_handler.handle_message(json.dumps(login).encode("utf-8"), ws)
+    await flush(client_handler, ws)
+    assert json.loads(ws.send.call_args.args[0])["success"] is True
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_slow_client_resync(user_svc, tmp_path):
+    (tmp_path / "r").mkdir()
+    (tmp_path / "r" / "test").write_text("slow")
+    file_service = FileService(tmp_path)
+    client_handler = ClientHandler(user_svc.return_value, file_service,
+                                   queue_size=4)
+    file_id = file_service.load_file("r", "test")
+    stalled = asyncio.Event()
+
+    async def stalled_send(frame):
+        await stalled.wait()
+
+    slow_ws, fast_ws = MagicMock(), MagicMock()
+    slow_ws.send = AsyncMock(side_effect=stalled_send)
+    fast_ws.send = AsyncMock()
+    for ws in (slow_ws, fast_ws):
+        client_handler.rooms.register(ws, "r")
+        client_handler.assign_file(file_id, ws)
+
+    writer = Doc(site=3)
+    writer.load_text("slow")
+    for i in range(10):
+        patch = writer.insert(4 + i, "!")
+        await asyncio.wait_for(client_handler.handle_new_patch(
+            file_id, patch, None, fast_ws), 1)
+    await flush(client_handler, fast_ws)
+
+    assert fast_ws.send.call_count == 10
+    stats = client_handler.queue_stats()
+    assert stats["overflows"] >= 1
+    assert stats["dropped"] >= 4
+
+    stalled.set()
+    await flush(client_handler, slow_ws)
+    messages = [json.loads(call.args[0]) for call in
+                slow_ws.send.call_args_list]
+    begin = next(m for m in messages if m.get("stream") == "begin")
+    assert begin["resync"] is True
+    doc = Doc(site=1)
+    for message in messages[messages.index(begin):]:
+        if message.get("type") == "file_stream_chunk":
+            for patch in message["content"]:
+                doc.apply_patch(patch)
+        elif "content" in message and message.get("type") is None:
+            doc.apply_patch(message["content"])
+    assert doc.text == file_service.documents[file_id].text
+    assert doc.text == "slow" + "!" * 10
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import random
+
+import pytest
+
+from client_handler import ClientHandler
+from cluster import BrokerClient, ClusterRelay, LocalBroker, PubSub
+from docengine import Doc
+from file_service import FileService
+from password_service import HashWorkerPool
+from user_service import UserService
+from user_store import SQLiteStore
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.incoming = asyncio.Queue()
+        self.sent = []
+
+    async def send(self, frame) -> None:
+        self.sent.append(frame)
+
+    async def close(self) -> None:
+        self.incoming.put_nowait(None)
+
+    def __aiter__(self) -> "FakeClient":
+        return self
+
+    async def __anext__(self) -> bytes:
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
+async def request(client, message) -> dict:
+    """
+    Send message and wait for the next response
+    """
+    count = len(client.sent)
+    client.incoming.put_nowait(json.dumps(message).encode("utf-8"))
+    for _ in range(500):
+        if len(client.sent) > count:
+            return json.loads(client.sent[count])
+        await asyncio.sleep(0.01)
+    raise TimeoutError(message)
+
+
+async def start_node(tmp_path, hash_pool) -> ClusterRelay:
+    user_service = UserService(tmp_path / "users", hash_pool=hash_pool,
+                               store=SQLiteStore(tmp_path / "users.db"))
+    handler = ClientHandler(user_service, FileService(tmp_path / "users"))
+    relay = ClusterRelay(handler, BrokerClient(str(tmp_path / "broker.sock")))
+    await relay.start()
+    return relay
+
+
+async def wait_for(condition) -> None:
+    for _ in range(500):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError
+
+
+@pytest.mark.asyncio
+async def test_cluster_nodes_converge(tmp_path):
+    broker = LocalBroker()
+    await broker.start(str(tmp_path / "broker.sock"))
+    hash_pool = HashWorkerPool(workers=2)
+    nodes = [await start_node(tmp_path, hash_pool) for _ in range(3)]
+    clients = [FakeClient() for _ in nodes]
+    tasks = [asyncio.ensure_future(node.handler.handle_client(client))
+             for node, client in zip(nodes, clients)]
+
+    response = await request(clients[0], {"type": "user_register",
+                                          "username": "alice",
+                                          "password": "a"})
+    tokens = [response["token"]]
+    response = await request(clients[0], {"type": "create_file_request",
+                                          "token": tokens[0],
+                                          "filename": "notes"})
+    assert response["success"]
+    # registration is published to the other nodes
+    for client in clients[1:]:
+        response = await request(client, {"type": "user_login",
+                                          "username": "alice",
+                                          "password": "a"})
+        assert response["success"]
+        tokens.append(response["token"])
+    for client, token in zip(clients, tokens):
+        response = await request(client, {"type": "file_request",
+                                          "token": token,
+                                          "filename": "notes"})
+        assert response["success"]
+    file_id = response["file_id"]
+    assert len(broker.subscribers[file_id]) == 3
+
+    rand = random.Random(21)
+    docs = [Doc(site=index + 1) for index in range(len(clients))]
+    for _ in range(60):
+        index = rand.randrange(len(clients))
+        doc = docs[index]
+        if doc.text and rand.random() < 0.3:
+            patch = doc.delete(rand.randrange(len(doc.text)))
+        else:
+            patch = doc.insert(rand.randint(0, len(doc.text)),
+                               rand.choice("abc"))
+        clients[index].incoming.put_nowait(json.dumps({
+            "type": "patch", "token": tokens[index], "filename": "notes",
+            "file_id": file_id, "content": patch}).encode("utf-8"))
+
+    def texts() -> list:
+        return [node.file_service.documents[file_id].text for node in nodes]
+
+    length = sum(len(doc.text) for doc in docs)
+    await wait_for(lambda: len(set(texts())) == 1 and
+                   len(texts()[0]) == length)
+    assert sorted(texts()[0]) == sorted("".join(doc.text for doc in docs))
+
+    # unsaved changes reach a node joining later through a snapshot
+    late = await start_node(tmp_path, hash_pool)
+    late_client = FakeClient()
+    tasks.append(asyncio.ensure_future(
+        late.handler.handle_client(late_client)))
+    response = await request(late_client, {"type": "user_login",
+                                           "username": "alice",
+                                           "password": "a"})
+    response = await request(late_client, {"type": "file_request",
+                                           "token": response["token"],
+                                           "filename": "notes"})
+    assert response["success"]
+    assert late.syncs == 1
+    assert late.file_service.documents[file_id].text == texts()[0]
+
+    for client in clients + [late_client]:
+        await client.close()
+    await asyncio.gather(*tasks)
+    for node in nodes + [late]:
+        node.close()
+    broker.close()
+    hash_pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_cluster_join_adopts_snapshot_of_loaded_file(tmp_path):
+    broker = LocalBroker()
+    await broker.start(str(tmp_path / "broker.sock"))
+    hash_pool = HashWorkerPool(workers=1)
+    nodes = [await start_node(tmp_path, hash_pool) for _ in range(2)]
+    clients = [FakeClient() for _ in nodes]
+    tasks = [asyncio.ensure_future(node.handler.handle_client(client))
+             for node, client in zip(nodes, clients)]
+
+    response = await request(clients[0], {"type": "user_register",
+                                          "username": "bob",
+                                          "password": "b"})
+    token = response["token"]
+    await request(clients[0], {"type": "create_file_request",
+                               "token": token, "filename": "notes"})
+    response = await request(clients[0], {"type": "file_request",
+                                          "token": token,
+                                          "filename": "notes"})
+    file_id = response["file_id"]
+    doc = Doc(site=1)
+    for char in "abc":
+        clients[0].incoming.put_nowait(json.dumps({
+            "type": "patch", "token": token, "file_id": file_id,
+            "filename": "notes",
+            "content": doc.insert(len(doc.text), char)}).encode("utf-8"))
+    count = len(clients[0].sent)
+    clients[0].incoming.put_nowait(json.dumps({
+        "type": "save_file_request", "token": token,
+        "filename": "notes"}).encode("utf-8"))
+    await wait_for(lambda: any(
+        json.loads(frame)["type"] == "save_file_response"
+        for frame in clients[0].sent[count:]))
+    assert (tmp_path / "users" / "bob" / "notes").read_text() == "abc"
+
+    # second node loads the saved file without joining its topic, then
+    # a character is deleted on the first node
+    assert nodes[1].file_service.load_file("bob", "notes") == file_id
+    clients[0].incoming.put_nowait(json.dumps({
+        "type": "patch", "token": token, "file_id": file_id,
+        "filename": "notes", "content": doc.delete(1)}).encode("utf-8"))
+    first = nodes[0].file_service.documents[file_id]
+    await wait_for(lambda: first.text == "ac")
+
+    response = await request(clients[1], {"type": "user_login",
+                                          "username": "bob",
+                                          "password": "b"})
+    response = await request(clients[1], {"type": "file_request",
+                                          "token": response["token"],
+                                          "filename": "notes"})
+    assert response["success"]
+    assert nodes[1].syncs == 1
+    assert nodes[1].file_service.documents[file_id].text == "ac"
+
+    for client in clients:
+        await client.close()
+    await asyncio.gather(*tasks)
+    for node in nodes:
+        node.close()
+    broker.close()
+    hash_pool.shutdown()
+
+
+def test_cluster_transport_is_abstract():
+    with pytest.raises(TypeError):
+        PubSub()
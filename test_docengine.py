@@ -1,3 +1,8 @@
+import json
+import random
+
+import pytest
+
 from docengine import Doc
 from docengine.allocator import Allocator
 from docengine.char_position import CharPosition
@@ -26,6 +31,20 @@ def test_docengine_allocator():
             res_pos[-1] < interval_at_depth)
 
 
+def test_docengine_allocator_strategy_per_depth():
+    """
+    Allocation strategy of a depth is seeded by the depth alone, so every
+    site and every run picks the same one
+    """
+    strategies = [False, True, False, False, True, True, False, False,
+                  False, True]
+    for site in range(3):
+        random.seed(site)
+        allocator = Allocator(site)
+        assert [allocator.get_strategy(depth) for depth in
+                range(1, len(strategies) + 1)] == strategies
+
+
 def test_docengine_insert():
     """
     test Doc line insertion
@@ -82,3 +101,189 @@ def test_docengine_comparator():
                                   base_bits=base_bits)
 
     assert left_char_pos < right_char_pos
+
+
+def test_docengine_apply_remote_delete():
+    """
+    Remote deletes are resolved through the identity index
+    """
+    local, remote = Doc(site=1), Doc(site=2)
+    patches = [local.insert(i, c) for i, c in enumerate("remote")]
+    for patch in patches:
+        remote.apply_patch(patch)
+
+    assert remote.get_real_position(patches[2]) == 3
+    assert remote.apply_patch(local.delete(2))
+    assert remote.text == "reote"
+    assert remote.get_real_position(patches[2]) is None
+
+
+def test_docengine_apply_patch_idempotent():
+    """
+    Duplicate inserts and deletes of absent characters are ignored
+    """
+    local, remote = Doc(site=1), Doc(site=2)
+    insert = local.insert(0, "a")
+    delete = local.delete(0)
+
+    assert remote.apply_patch(insert)
+    assert not remote.apply_patch(insert)
+    assert remote.apply_patch(delete)
+    assert not remote.apply_patch(delete)
+    assert remote.text == ""
+
+
+def test_docengine_rejects_non_character_inserts():
+    """
+    Inserts of anything but a single character string change nothing
+    """
+    local, remote = Doc(site=1), Doc(site=2)
+    for char in (5, None, "", "ab"):
+        patch = json.loads(local.insert(0, "a"))
+        patch["char"] = char
+        with pytest.raises((TypeError, ValueError)):
+            remote.apply_patch(json.dumps(patch))
+    assert remote.text == ""
+
+
+def test_docengine_concurrent_inserts_converge():
+    """
+    Sites editing the same places concurrently allocate distinct,
+    correctly ordered positions and end with the same text
+    """
+    rand = random.Random(3)
+    docs = [Doc(site=site) for site in (1, 2, 3)]
+    pending = [[] for _ in docs]
+    for _ in range(400):
+        index = rand.randrange(len(docs))
+        doc = docs[index]
+        if doc.text and rand.random() < 0.25:
+            patch = doc.delete(rand.randrange(len(doc.text)))
+        else:
+            patch = doc.insert(rand.randint(0, len(doc.text)), "x")
+        for other in range(len(docs)):
+            if other != index:
+                pending[other].append(patch)
+        # peers receive patches of others in random batches
+        for other, peer in enumerate(docs):
+            if rand.random() < 0.5:
+                for patch in pending[other]:
+                    peer.apply_patch(patch)
+                pending[other].clear()
+    for other, peer in enumerate(docs):
+        for patch in pending[other]:
+            peer.apply_patch(patch)
+
+    assert len({doc.text for doc in docs}) == 1
+    assert len(docs[0].patches) == len(docs[0].text)
+
+
+def test_docengine_inserts_land_where_typed():
+    """
+    Character inserted by any site is at the index it was inserted at,
+    also between characters of other sites
+    """
+    rand = random.Random(5)
+    docs = [Doc(site=site) for site in (1, 2, 3)]
+    for i in range(300):
+        author = rand.choice(docs)
+        index = rand.randint(0, len(author))
+        char = chr(0x100 + i)
+        patch = author.insert(index, char)
+        assert author.text[index] == char
+        for doc in docs:
+            if doc is not author:
+                doc.apply_patch(patch)
+
+    assert len({doc.text for doc in docs}) == 1
+
+
+def test_docengine_allocate_after_site_split():
+    """
+    Position differing from the next one only by a site on its path has
+    room below it
+    """
+    left = CharPosition([26, 5], [1, 1])
+    right = CharPosition([26], [2])
+    result = Allocator(3)(left, right)
+
+    assert left.key < result.key < right.key
+
+
+def test_docengine_interleaved_typing_stays_shallow():
+    """
+    Sites typing at the same place in turn allocate from the same side,
+    so that positions do not deepen on every insert
+    """
+    rand = random.Random(0)
+    docs = [Doc() for _ in range(3)]
+    for site, doc in enumerate(docs, 1):
+        doc.load_text("x" * 100)
+        doc.site = site
+    for i in range(600):
+        author = docs[i % len(docs)]
+        patch = author.insert(50 + rand.randint(0, 4), "a")
+        for doc in docs:
+            if doc is not author:
+                doc.apply_patch(patch)
+
+    assert len({doc.text for doc in docs}) == 1
+    assert max(len(json.loads(patch)["pos"]) for patch in
+               docs[0].patches) < 12
+
+
+def test_docengine_reports_text_edits():
+    """
+    Edits reported for applied patches turn the previous text into the
+    current one
+    """
+    rand = random.Random(1)
+    author = Doc(site=1)
+    doc = Doc(site=2)
+    text = ""
+    for _ in range(100):
+        batch = []
+        for _ in range(rand.randint(1, 4)):
+            if len(author) and rand.random() < 0.4:
+                batch.append(author.delete(rand.randrange(len(author))))
+            else:
+                batch += author.insert_text(rand.randint(0, len(author)),
+                                            "xyz"[:rand.randint(1, 3)])
+        edits = []
+        if rand.random() < 0.5:
+            for patch in batch:
+                doc.apply_operation(json.loads(patch), edits)
+        else:
+            doc.apply_operations([json.loads(patch) for patch in batch],
+                                 edits)
+        for start, end, inserted in edits:
+            text = text[:start] + inserted + text[end:]
+        assert text == doc.text == author.text
+
+
+def test_docengine_insert_text():
+    """
+    Bulk inserted text is replicated by its patches and stays shallow
+    """
+    local, remote = Doc(site=1), Doc(site=2)
+    for patch in local.insert_text(0, "bulk"):
+        remote.apply_patch(patch)
+    for patch in local.insert_text(2, "--") + [local.insert(0, ">")]:
+        remote.apply_patch(patch)
+
+    assert local.text == remote.text == ">bu--lk"
+
+
+def test_docengine_load_text_deterministic():
+    """
+    Loading the same text always produces the same shallow characters
+    """
+    text = "x" * 20000
+    first, second = Doc(), Doc()
+    first.load_text(text)
+    second.load_text(text)
+
+    assert first.text == text
+    assert first.patches == second.patches
+    assert max(len(json.loads(patch)["pos"]) for patch in
+               first.patches) == 3
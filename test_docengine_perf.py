@@ -0,0 +1,13 @@
+import pytest
+
+from benchmarks.bench_docengine import find_regressions, load_baseline
+
+
+@pytest.mark.benchmark
+def test_docengine_hot_paths_do_not_regress():
+    """
+    Hot paths of docengine are not slower than the recorded baseline by
+    more than its threshold. Record a new baseline with
+    python -m benchmarks.bench_docengine --update
+    """
+    assert find_regressions(load_baseline()) == []
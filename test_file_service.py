@@ -0,0 +1,205 @@
+import json
+
+import pytest
+
+from docengine import Doc
+from file_service import FileService
+from patch_log import PatchLog
+
+
+def make_file(users_dir, username, filename, text):
+    (users_dir / username).mkdir(parents=True, exist_ok=True)
+    (users_dir / username / filename).write_text(text)
+
+
+def test_file_service_save_live_doc(tmp_path):
+    make_file(tmp_path, "admin", "doc", "abc")
+    file_service = FileService(tmp_path, keep_history=True)
+    file_id, patches = file_service.get_patches("admin", "doc")
+
+    client = Doc(site=1)
+    for patch in patches:
+        client.apply_patch(patch)
+    for patch in [client.insert(3, "d"), client.delete(0)]:
+        assert file_service.register_patch(file_id, patch)
+
+    assert file_service.save_file("admin", "doc")
+    assert (tmp_path / "admin" / "doc").read_text() == "bcd"
+    assert len(file_service.patch_history[file_id]) == 5
+
+
+def test_file_service_without_history(tmp_path):
+    make_file(tmp_path, "admin", "doc", "abc")
+    file_service = FileService(tmp_path)
+    file_id, patches = file_service.get_patches("admin", "doc")
+
+    client = Doc(site=1)
+    for patch in patches:
+        client.apply_patch(patch)
+    file_service.register_patch(file_id, client.delete(1))
+
+    _, patches = file_service.get_patches("admin", "doc")
+    assert len(patches) == 2
+    assert file_id not in file_service.patch_history
+    assert not file_service.register_patch(file_id, "not a patch")
+
+
+def test_file_service_snapshot_converges(tmp_path):
+    make_file(tmp_path, "admin", "doc", "snapshot")
+    file_service = FileService(tmp_path, keep_history=True)
+    file_id, history = file_service.get_patches("admin", "doc")
+    writers = [Doc(site=1), Doc(site=2)]
+    for writer in writers:
+        for patch in history:
+            writer.apply_patch(patch)
+
+    edits = [writers[0].insert(0, ">"), writers[1].delete(3),
+             writers[0].insert_text(3, "--"), writers[1].insert(6, "!"),
+             writers[0].delete(1)]
+    for edit in edits:
+        for patch in edit if isinstance(edit, list) else [edit]:
+            file_service.register_patch(file_id, patch)
+
+    _, version, snapshot = file_service.get_snapshot("admin", "doc")
+    _, history = file_service.get_patches("admin", "doc")
+    from_snapshot, from_history = Doc(site=3), Doc(site=4)
+    for patch in snapshot:
+        from_snapshot.apply_patch(patch)
+    for patch in history:
+        from_history.apply_patch(patch)
+    late_patch = writers[1].insert(0, "#")
+    for doc in [from_snapshot, from_history]:
+        doc.apply_patch(late_patch)
+
+    assert version == 6
+    assert len(snapshot) < len(history)
+    assert from_snapshot.text == from_history.text
+    assert from_snapshot.patches == from_history.patches
+    assert "#" in from_snapshot.text
+
+
+def test_file_service_patch_batch_is_atomic(tmp_path):
+    make_file(tmp_path, "admin", "doc", "ab")
+    file_service = FileService(tmp_path, keep_history=True)
+    file_id, patches = file_service.get_patches("admin", "doc")
+    client = Doc(site=1)
+    for patch in patches:
+        client.apply_patch(patch)
+
+    batch = client.insert_text(2, "cd") + [client.delete(0)]
+    assert not file_service.register_patches(file_id, batch + ["{}"])
+    peer = Doc(site=2)
+    for patch in patches:
+        peer.apply_patch(patch)
+    charless = json.loads(peer.insert(0, "x"))
+    del charless["char"]
+    assert not file_service.register_patches(file_id, [peer.delete(1),
+                                                       charless])
+    assert file_service.documents[file_id].text == "ab"
+    assert len(file_service.patch_history[file_id]) == 2
+
+    assert file_service.register_patches(file_id, batch)
+    assert file_service.documents[file_id].text == client.text == "bcd"
+    assert file_service.versions[file_id] == 3
+    assert len(file_service.patch_history[file_id]) == 5
+
+
+def test_file_service_recovers_from_patch_log(tmp_path):
+    make_file(tmp_path, "admin", "doc", "abc")
+    log_dir = tmp_path / "log"
+    file_service = FileService(tmp_path, patch_log=PatchLog(log_dir))
+    file_id, patches = file_service.get_patches("admin", "doc")
+    client = Doc(site=1)
+    for patch in patches:
+        client.apply_patch(patch)
+    file_service.register_patch(file_id, client.insert(3, "d"))
+    file_service.register_patches(file_id, client.insert_text(0, "xy"))
+
+    # crash: a new service replays the log on top of the saved text
+    recovered = FileService(tmp_path, patch_log=PatchLog(log_dir))
+    assert recovered.recover() == 1
+    assert recovered.documents[file_id].text == "xyabcd"
+
+    # clients fetch the recovered document again
+    client = Doc(site=1)
+    for patch in recovered.get_patches("admin", "doc")[1]:
+        client.apply_patch(patch)
+    assert recovered.save_file("admin", "doc")
+    log_path = log_dir / (file_id + PatchLog.SUFFIX)
+    header, = log_path.read_text().splitlines()
+    assert json.loads(header)["base"] == PatchLog.text_hash("xyabcd")
+    recovered.register_patch(file_id, client.delete(0))
+    restarted = FileService(tmp_path, patch_log=PatchLog(log_dir))
+    assert restarted.recover() == 1
+    assert restarted.documents[file_id].text == client.text == "yabcd"
+    assert (tmp_path / "admin" / "doc").read_text() == "xyabcd"
+
+
+def test_file_service_recovers_multiline_patches(tmp_path):
+    make_file(tmp_path, "admin", "doc", "abc")
+    log_dir = tmp_path / "log"
+    file_service = FileService(tmp_path, patch_log=PatchLog(log_dir))
+    file_id, patches = file_service.get_patches("admin", "doc")
+    client = Doc(site=1)
+    for patch in patches:
+        client.apply_patch(patch)
+    indented = json.dumps(json.loads(client.insert(3, "d")), indent=1)
+    assert file_service.register_patch(file_id, indented)
+    file_service.register_patches(file_id, [
+        json.dumps(json.loads(client.insert(4, "e")), indent=1)])
+    file_service.register_patch(file_id, client.insert(5, "f"))
+
+    recovered = FileService(tmp_path, patch_log=PatchLog(log_dir))
+    assert recovered.recover() == 1
+    assert recovered.documents[file_id].text == "abcdef"
+
+
+def test_file_service_logs_adopted_snapshot(tmp_path):
+    make_file(tmp_path, "admin", "doc", "abcdef")
+    log_dir = tmp_path / "log"
+    file_service = FileService(tmp_path, patch_log=PatchLog(log_dir))
+    file_id, patches = file_service.get_patches("admin", "doc")
+    peer = Doc(site=2)
+    for patch in patches:
+        peer.apply_patch(patch)
+    peer.delete(1)
+    peer.insert(2, "X")
+
+    assert file_service.adopt_snapshot(file_id, peer.patches)
+    # only the changed part of the text is logged
+    (_, _, records), = PatchLog(log_dir).replay()
+    assert records == [[[1, 3, "cX"]]]
+    recovered = FileService(tmp_path, patch_log=PatchLog(log_dir))
+    assert recovered.recover() == 1
+    assert recovered.documents[file_id].text == "acXdef"
+
+
+@pytest.mark.asyncio
+async def test_file_service_evicts_idle_files(tmp_path):
+    for name in ("a", "b", "c"):
+        make_file(tmp_path, "admin", name, name * 100)
+    log_dir = tmp_path / "log"
+    file_service = FileService(tmp_path, patch_log=PatchLog(log_dir),
+                               memory_budget=250 * FileService.CHAR_BYTES)
+    file_a = file_service.load_file("admin", "a")
+    file_service.acquire(file_a)
+    file_b = file_service.load_file("admin", "b")
+    client = Doc(site=1)
+    for patch in file_service.get_snapshot("admin", "b")[2]:
+        client.apply_patch(patch)
+    file_service.register_patch(file_b, client.insert(0, "+"))
+    file_service.load_file("admin", "c")
+
+    # a is open, b is the least recently used idle file
+    assert await file_service.trim() == 1
+    assert file_b not in file_service.documents
+    assert (tmp_path / "admin" / "b").read_text() == "+" + "b" * 100
+
+    file_id, patches = file_service.get_patches("admin", "b")
+    assert file_id == file_b and len(patches) == 101
+    file_service.release(file_a)
+    assert await file_service.trim() == 1
+    assert file_service.cache_stats()["evictions"] == 2
+    assert file_service.cache_stats()["misses"] == 4
+    assert file_service.cache_stats()["hits"] == 1
+    assert file_service.memory_usage() <= file_service.memory_budget
@@ -0,0 +1,106 @@
+import asyncio
+import json
+import unittest
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+import metrics
+from client_handler import ClientHandler
+from docengine import Doc
+from file_service import FileService
+from metrics import Histogram, MetricsServer, RateMeter
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for _ in range(98):
+        histogram.observe(0.0001)
+    histogram.observe(0.01)
+    histogram.observe(5.0)
+
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 100
+    assert 0.0001 <= snapshot["p50"] < 0.0002
+    assert 0.01 <= snapshot["p99"] < 0.02
+    assert snapshot["max"] == 5.0
+    assert sum(snapshot["buckets"].values()) == 100
+
+
+def test_rate_meter_window(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(metrics.time, "monotonic", lambda: now[0])
+    meter = RateMeter(window=5)
+    for second in range(4):
+        meter.add(10)
+        now[0] += 1
+    # current second does not count until it is over
+    meter.add(100)
+    assert meter.rate() == 10
+    now[0] += 10
+    assert meter.rate() == 0
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_client_handler_metrics(user_svc, tmp_path):
+    (tmp_path / "r").mkdir()
+    (tmp_path / "r" / "test").write_text("metrics")
+    file_service = FileService(tmp_path, keep_history=True)
+    user_svc_instance = user_svc.return_value
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    user_svc_instance.check_is_author.return_value = True
+    user_svc_instance.hash_pool.stats = {}
+    client_handler = ClientHandler(user_svc_instance, file_service)
+
+    ws = MagicMock()
+    ws.send = AsyncMock()
+    login = {"username": "r", "password": "r", "type": "user_login"}
+    await client_handler.handle_message(json.dumps(login).encode("utf-8"),
+                                        ws)
+    await client_handler.rooms.get_session(ws).queue.join()
+    token = json.loads(ws.send.call_args.args[0])["token"]
+    request = {"token": token, "filename": "test", "type": "file_request"}
+    await client_handler.handle_message(json.dumps(request).encode("utf-8"),
+                                        ws)
+    file_id = FileService.get_file_id("r", "test")
+    patch = Doc(site=1).insert(0, ">")
+    message = {"token": token, "type": "patch", "file_id": file_id,
+               "content": patch}
+    await client_handler.handle_message(json.dumps(message).encode("utf-8"),
+                                        ws)
+    await client_handler.handle_message(
+        json.dumps({**message, "token": "forged"}).encode("utf-8"), ws)
+
+    snapshot = client_handler.metrics_snapshot()
+    assert set(snapshot["messages"]) == {"user_login", "file_request",
+                                         "patch", "unauthorized"}
+    assert snapshot["broadcast"]["count"] == 1
+    assert snapshot["connections"] == 1
+    assert snapshot["rooms"] == 1
+    document = snapshot["documents"][file_id]
+    assert document["connections"] == 1
+    assert document["history"] == len("metrics") + 1
+    assert document["memory"] > 0
+    assert snapshot["auth_cache"]["hit_rate"] == 0
+    assert client_handler.metrics.patch_rates[file_id].counts != [0] * 10
+
+
+@pytest.mark.asyncio
+async def test_metrics_server():
+    server = MetricsServer(lambda: {"connections": 3})
+    await server.start("localhost", 0)
+    port = server._MetricsServer__server.sockets[0].getsockname()[1]
+
+    async def get(path) -> bytes:
+        reader, writer = await asyncio.open_connection("localhost", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        return response
+
+    head, _, body = (await get("/metrics")).partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 200")
+    assert json.loads(body) == {"connections": 3}
+    assert (await get("/")).startswith(b"HTTP/1.1 404")
+    server.close()
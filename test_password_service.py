@@ -1,4 +1,8 @@
-from password_service import PasswordService
+import asyncio
+
+import pytest
+
+from password_service import HashWorkerPool, PasswordService
 
 
 def test_password_diff_hash():
@@ -20,3 +24,18 @@ def test_password_verify_ok():
     good_pass = "123"
     good_pass_hash = PasswordService.hash_password(good_pass)
     assert PasswordService.verify_password(good_pass_hash, good_pass)
+
+
+@pytest.mark.asyncio
+async def test_hash_pool_queue_depth():
+    pool = HashWorkerPool(workers=1, max_concurrent=1)
+    hashes = [asyncio.ensure_future(pool.hash_password(str(i)))
+              for i in range(3)]
+    await asyncio.sleep(0)
+    assert pool.stats["in_flight"] == 1
+    assert pool.stats["queue_depth"] == 2
+
+    results = await asyncio.gather(*hashes)
+    assert pool.stats == {"queue_depth": 0, "in_flight": 0, "completed": 3}
+    assert await pool.verify_password(results[1], "1")
+    pool.shutdown()
@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+import pytest
+
+from patch_log import PatchLog
+
+
+@pytest.mark.asyncio
+async def test_patch_log_group_commit(tmp_path):
+    patch_log = PatchLog(tmp_path, commit_window=0.01)
+    patch_log.track("f", "admin", "doc", PatchLog.text_hash(""))
+    for i in range(100):
+        patch_log.append("f", [[i, i, "a"]])
+        if i % 10 == 0:
+            await asyncio.sleep(0)
+    await patch_log.flush()
+    patch_log.close()
+
+    assert patch_log.commits < 10
+    (_, header, records), = PatchLog(tmp_path).replay()
+    assert header["username"] == "admin"
+    assert len(records) == 100
+
+
+def test_patch_log_cuts_torn_record(tmp_path):
+    patch_log = PatchLog(tmp_path)
+    patch_log.track("f", "admin", "doc", PatchLog.text_hash(""))
+    patch_log.append("f", [[0, 0, "a"]])
+    patch_log.append("f", [[1, 1, "b"], [2, 2, "c"]])
+    patch_log.close()
+    with open(tmp_path / "f.log", "a") as file:
+        file.write(json.dumps([[3, 3, "x"]])[:5])
+
+    patch_log = PatchLog(tmp_path)
+    (_, _, records), = patch_log.replay()
+    assert [len(record) for record in records] == [1, 2]
+    patch_log.append("f", [[3, 3, "d"]])
+    patch_log.close()
+
+    (_, header, records), = PatchLog(tmp_path).replay()
+    assert PatchLog.edits_since(header, records, PatchLog.text_hash("")) == \
+        [[0, 0, "a"], [1, 1, "b"], [2, 2, "c"], [3, 3, "d"]]
+
+
+def test_patch_log_truncates_on_checkpoint(tmp_path):
+    patch_log = PatchLog(tmp_path)
+    patch_log.track("f", "admin", "doc", PatchLog.text_hash(""))
+    patch_log.append("f", [[0, 0, "ab"]])
+    patch_log.mark_save("f", PatchLog.text_hash("ab"))
+    # registered while the save is written
+    patch_log.append("f", [[2, 2, "c"]])
+
+    # crash before the log is truncated: replay fits either text on disk
+    (_, header, records), = PatchLog(tmp_path).replay()
+    assert PatchLog.edits_since(header, records, PatchLog.text_hash("")) == \
+        [[0, 0, "ab"], [2, 2, "c"]]
+    assert PatchLog.edits_since(header, records,
+                                PatchLog.text_hash("ab")) == [[2, 2, "c"]]
+    assert PatchLog.edits_since(header, records,
+                                PatchLog.text_hash("x")) is None
+
+    patch_log.checkpoint("f", PatchLog.text_hash("ab"))
+    patch_log.close()
+    assert len((tmp_path / "f.log").read_text().splitlines()) == 2
+    (_, header, records), = PatchLog(tmp_path).replay()
+    assert header["base"] == PatchLog.text_hash("ab")
+    assert records == [[[2, 2, "c"]]]
+
+
+def test_patch_log_directory_is_locked(tmp_path):
+    lock = PatchLog.lock(tmp_path)
+    assert lock is not None
+    # another server logging to the same directory is refused
+    assert PatchLog.lock(tmp_path) is None
+    lock.close()
+    lock = PatchLog.lock(tmp_path)
+    assert lock is not None
+    lock.close()
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from client_handler import ClientHandler
+from file_service import FileService
+from profiler import LoopProfiler
+
+
+async def handle_blocking_request(rounds) -> None:
+    for _ in range(rounds):
+        time.sleep(0.03)
+        await asyncio.sleep(0.01)
+
+
+async def handle_client(rounds) -> None:
+    await handle_blocking_request(rounds)
+
+
+@pytest.mark.asyncio
+async def test_profile_groups_by_handler(tmp_path):
+    profiler = LoopProfiler(tmp_path, seconds=0.3, slow_callback=0.02)
+    busy = asyncio.ensure_future(handle_client(5))
+    path = await profiler.profile()
+    await busy
+
+    report = path.read_text()
+    assert path.with_suffix(".prof").exists()
+    assert not asyncio.get_running_loop().get_debug()
+    handler_row = next(line for line in report.splitlines()
+                       if line.startswith("handle_blocking_request "))
+    # every blocking round is a slow callback of the handler
+    assert int(handler_row.split()[-1]) >= 4
+    assert "handle_client " not in report.split("Slow callbacks")[0]
+    assert "{built-in method time.sleep}" in report
+
+
+@pytest.mark.asyncio
+async def test_profile_runs_once_at_a_time(tmp_path):
+    profiler = LoopProfiler(tmp_path, seconds=0.1)
+    first = asyncio.ensure_future(profiler.profile())
+    await asyncio.sleep(0)
+    assert await profiler.try_profile() is None
+    with pytest.raises(RuntimeError):
+        await profiler.profile()
+    assert (await first).exists()
+
+
+@pytest.mark.asyncio
+async def test_profile_written_off_event_loop(tmp_path):
+    profiler = LoopProfiler(tmp_path, seconds=0.05)
+    threads = []
+    write = profiler.write
+
+    def record_thread(*args) -> Path:
+        threads.append(threading.get_ident())
+        # another profile waits until the report is written
+        assert profiler.running
+        return write(*args)
+
+    profiler.write = record_thread
+    path = await profiler.profile()
+    assert path.exists() and path.with_suffix(".prof").exists()
+    assert threads and threads[0] != threading.get_ident()
+    assert not profiler.running
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_profile_request_needs_admin(user_svc, tmp_path):
+    user_svc_instance = user_svc.return_value
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    client_handler = ClientHandler(
+        user_svc_instance, FileService(tmp_path), admins=["admin"],
+        profiler=LoopProfiler(tmp_path / "profiles", seconds=0.05))
+
+    async def request_profile(username) -> dict:
+        ws = MagicMock()
+        ws.send = AsyncMock()
+        login = {"username": username, "password": "p", "type": "user_login"}
+        await client_handler.handle_message(
+            json.dumps(login).encode("utf-8"), ws)
+        await client_handler.rooms.get_session(ws).queue.join()
+        token = json.loads(ws.send.call_args.args[0])["token"]
+        request = {"token": token, "type": "profile_request"}
+        await client_handler.handle_message(
+            json.dumps(request).encode("utf-8"), ws)
+        while ws.send.call_count < 2:
+            await asyncio.sleep(0.01)
+        return json.loads(ws.send.call_args.args[0])
+
+    response = await request_profile("user")
+    assert response["type"] == "profile_response"
+    assert not response["success"]
+    assert not (tmp_path / "profiles").exists()
+
+    response = await request_profile("admin")
+    assert response["success"]
+    assert Path(response["content"]).exists()
+
+
+@unittest.mock.patch('client_handler.UserService')
+@pytest.mark.asyncio
+async def test_profile_request_validation(user_svc, tmp_path):
+    user_svc_instance = user_svc.return_value
+    user_svc_instance.auth_user_async = AsyncMock(return_value=True)
+    client_handler = ClientHandler(
+        user_svc_instance, FileService(tmp_path), admins=["admin"],
+        profiler=LoopProfiler(tmp_path / "profiles", seconds=0.05))
+    ws = MagicMock()
+    ws.send = AsyncMock()
+    login = {"username": "admin", "password": "p", "type": "user_login"}
+    await client_handler.handle_message(json.dumps(login).encode("utf-8"), ws)
+    session = client_handler.rooms.get_session(ws)
+    await session.queue.join()
+    token = json.loads(ws.send.call_args.args[0])["token"]
+
+    async def request(*durations) -> list:
+        ws.send.reset_mock()
+        for seconds in durations:
+            message = {"token": token, "type": "profile_request",
+                       "seconds": seconds}
+            await client_handler.handle_message(
+                json.dumps(message).encode("utf-8"), ws)
+        while ws.send.call_count < len(durations):
+            await asyncio.sleep(0.01)
+        return [json.loads(call.args[0]) for call in ws.send.call_args_list]
+
+    for seconds in ("soon", -1, 0, "nan", [1]):
+        response, = await request(seconds)
+        assert not response["success"]
+    assert client_handler.profiler.running is False
+
+    # the second request is handled before the first profile starts
+    responses = await request(0.05, 0.05)
+    assert sorted(response["success"] for response in responses) == \
+        [False, True]
@@ -0,0 +1,27 @@
+from room_registry import RoomRegistry
+
+
+def test_room_registry_assign():
+    registry = RoomRegistry()
+    first, second = object(), object()
+    registry.register(first)
+    registry.register(second)
+    registry.assign(first, "file_a")
+    registry.assign(second, "file_a")
+    registry.assign(second, "file_b")
+
+    assert {s.connection for s in registry.get_room("file_a")} == {first}
+    assert {s.connection for s in registry.get_room("file_b")} == {second}
+
+
+def test_room_registry_unregister():
+    registry = RoomRegistry()
+    ws = object()
+    registry.register(ws)
+    registry.assign(ws, "file_a")
+    registry.unregister(ws)
+
+    assert ws not in registry
+    assert not registry.get_room("file_a")
+    assert "file_a" not in registry.rooms
+    assert registry.unregister(ws) is None
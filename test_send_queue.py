@@ -0,0 +1,53 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from send_queue import SendQueue
+
+
+@pytest.mark.asyncio
+async def test_send_queue_order_and_clear():
+    ws = MagicMock()
+    sent = []
+    ws.send = AsyncMock(side_effect=sent.append)
+    queue = SendQueue(ws, max_size=3)
+
+    assert queue.put(b"a")
+    assert queue.put_stream(iter([b"s1", b"s2"]))
+    assert queue.put(b"b")
+    assert not queue.put(b"c")
+    await queue.join()
+    assert sent == [b"a", b"s1", b"s2", b"b"]
+
+    def endless():
+        while True:
+            yield b"s"
+
+    assert queue.put_stream(endless())
+    assert queue.put(b"dropped")
+    await asyncio.sleep(0)
+    assert queue.clear() == 1
+    assert queue.put(b"after")
+    await queue.join()
+    assert sent[-1] == b"after"
+    assert queue.dropped == 1
+    assert len(queue) == 0
+
+
+@pytest.mark.asyncio
+async def test_send_queue_text_frames_and_failing_streams():
+    ws = MagicMock()
+    sent = []
+    ws.send = AsyncMock(side_effect=sent.append)
+    queue = SendQueue(ws)
+
+    def failing():
+        yield b"s1"
+        raise ValueError("snapshot went away")
+
+    assert queue.put("text frame")
+    assert queue.put_stream(failing())
+    assert queue.put(b"after")
+    await queue.join()
+    assert sent == ["text frame", b"s1", b"after"]
@@ -0,0 +1,179 @@
+import asyncio
+import json
+
+import pytest
+
+import ipc
+from docengine import Doc
+from file_service import FileService
+from password_service import HashWorkerPool
+from sharding import ShardRouter, ShardWorker, WorkerHandler
+from user_service import UserService
+from user_store import SQLiteStore
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.incoming = asyncio.Queue()
+        self.sent = []
+
+    async def send(self, frame) -> None:
+        self.sent.append(frame)
+
+    async def close(self) -> None:
+        self.incoming.put_nowait(None)
+
+    def __aiter__(self) -> "FakeClient":
+        return self
+
+    async def __anext__(self) -> bytes:
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+
+async def request(client, message) -> dict:
+    """
+    Send message and wait for the next response
+    """
+    count = len(client.sent)
+    client.incoming.put_nowait(json.dumps(message).encode("utf-8"))
+    for _ in range(500):
+        if len(client.sent) > count:
+            return json.loads(client.sent[count])
+        await asyncio.sleep(0.01)
+    raise TimeoutError(message)
+
+
+def filename_on(shard, workers) -> str:
+    for i in range(100):
+        if ipc.shard_of(FileService.get_file_id("alice", f"file{i}"),
+                        workers) == shard:
+            return f"file{i}"
+
+
+@pytest.mark.asyncio
+async def test_sharding_moves_sessions_to_file_owner(tmp_path):
+    workers = []
+    hash_pool = HashWorkerPool(workers=2)
+    for index in range(2):
+        user_service = UserService(tmp_path / "users", hash_pool=hash_pool,
+                                   store=SQLiteStore(tmp_path / "users.db"))
+        handler = WorkerHandler(user_service,
+                                FileService(tmp_path / "users"))
+        worker = ShardWorker(handler, str(tmp_path / f"worker{index}.sock"))
+        workers.append(worker)
+    serving = [asyncio.ensure_future(worker.serve()) for worker in workers]
+    router = ShardRouter([worker.socket_path for worker in workers])
+    await router.connect()
+
+    alice, bob = FakeClient(), FakeClient()
+    tasks = [asyncio.ensure_future(router.handle_client(client))
+             for client in (alice, bob)]
+    # connections start on different workers
+    response = await request(alice, {"type": "user_register",
+                                     "username": "alice", "password": "a"})
+    alice_token = response["token"]
+    response = await request(bob, {"type": "user_register",
+                                   "username": "bob", "password": "b"})
+    bob_token = response["token"]
+
+    files = [filename_on(shard, 2) for shard in range(2)]
+    for filename in files:
+        response = await request(alice, {"type": "create_file_request",
+                                         "token": alice_token,
+                                         "filename": filename})
+        assert response["success"]
+    # shares are published to the worker bob is served by
+    response = await request(alice, {"type": "file_share_request",
+                                     "token": alice_token,
+                                     "filename": files[0],
+                                     "share_user": "bob"})
+    assert response["success"]
+
+    for filename in files:
+        response = await request(alice, {"type": "file_request",
+                                         "token": alice_token,
+                                         "filename": filename})
+        assert response["success"]
+    assert router.clients[1].home == 1
+    # save of a file of the other worker is handled there, without moving
+    response = await request(alice, {"type": "save_file_request",
+                                     "token": alice_token,
+                                     "filename": files[0]})
+    assert response["type"] == "save_file_response"
+    assert router.clients[1].home == 1
+
+    response = await request(bob, {"type": "file_request",
+                                   "token": bob_token, "owner": "alice",
+                                   "filename": files[0]})
+    assert response["success"]
+    assert router.clients[2].home == 0
+    response = await request(bob, {"type": "save_file_request",
+                                   "token": bob_token, "owner": "alice",
+                                   "filename": files[1]})
+    assert response["type"] == "auth_response"
+    assert response["success"] is False
+
+    response = await request(alice, {"type": "file_request",
+                                     "token": alice_token,
+                                     "filename": files[0]})
+    file_id = response["file_id"]
+    patch = Doc().insert(0, "A")
+    count = len(bob.sent)
+    alice.incoming.put_nowait(json.dumps({
+        "type": "patch", "token": alice_token, "filename": files[0],
+        "file_id": file_id, "content": patch}).encode("utf-8"))
+    for _ in range(100):
+        if len(bob.sent) > count:
+            break
+        await asyncio.sleep(0.01)
+    assert json.loads(bob.sent[count])["content"] == patch
+    assert router.moves == 3
+
+    for client in (alice, bob):
+        await client.close()
+    await asyncio.gather(*tasks)
+    router.close()
+    await asyncio.gather(*serving)
+    hash_pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_sharding_background_index_reaches_all_workers(tmp_path):
+    store = SQLiteStore(tmp_path / "users.db")
+    store.insert_user("alice", "hash")
+    store.close()
+    (tmp_path / "users" / "alice").mkdir(parents=True)
+    (tmp_path / "users" / "alice" / "notes").write_text("indexed later")
+
+    workers = []
+    hash_pool = HashWorkerPool(workers=1)
+    for index in range(2):
+        user_service = UserService(tmp_path / "users", hash_pool=hash_pool,
+                                   store=SQLiteStore(tmp_path / "users.db"),
+                                   index_on_start=False)
+        handler = WorkerHandler(user_service,
+                                FileService(tmp_path / "users"))
+        workers.append(ShardWorker(handler,
+                                   str(tmp_path / f"worker{index}.sock"),
+                                   background_index=index == 0))
+    assert all(not worker.handler.user_service.users["alice"]["files"]
+               for worker in workers)
+    serving = [asyncio.ensure_future(worker.serve()) for worker in workers]
+    router = ShardRouter([worker.socket_path for worker in workers])
+    await router.connect()
+
+    for _ in range(500):
+        if all(worker.handler.user_service.users["alice"]["files"]
+               for worker in workers):
+            break
+        await asyncio.sleep(0.01)
+    for worker in workers:
+        assert worker.handler.user_service.users["alice"]["files"] == \
+            ["notes"]
+
+    router.close()
+    await asyncio.gather(*serving)
+    hash_pool.shutdown()
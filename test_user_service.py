@@ -1,7 +1,13 @@
+import asyncio
+import gc
 import os
 import shutil
+import time
 from pathlib import Path
 
+import pytest
+
+from password_service import HashWorkerPool
 from user_service import UserService
 
 
@@ -50,3 +56,96 @@ def test_user_service_auth_add_file():
 
     assert user_service.check_is_author("admin", "new_file") is True
     clean_env()
+
+
+def test_user_service_writes_through_memory_model():
+    clean_env()
+    user_service = UserService(user_catalog, user_db)
+    user_service.try_reg_user("admin", "admin1234")
+    user_service.try_reg_user("guest", "guest1234")
+    user_service.try_add_file("admin", "new_file")
+    assert user_service.try_grant_access("admin", "guest", "new_file")
+    assert not user_service.try_grant_access("admin", "nobody", "new_file")
+
+    store = user_service.store
+    # reads are served from memory only
+    user_service.store = None
+    assert user_service.check_is_author("admin", "new_file")
+    assert not user_service.check_is_author("guest", "new_file")
+    assert user_service.has_access("admin", "guest", "new_file")
+    assert not user_service.has_access("guest", "admin", "new_file")
+    assert user_service.get_shared_files("guest") == {"admin": ["new_file"]}
+    assert user_service.get_user("nobody") is None
+    store.close()
+
+    reloaded = UserService(user_catalog, user_db)
+    assert reloaded.get_owned_files("admin") == ["new_file"]
+    assert reloaded.has_access("admin", "guest", "new_file")
+    reloaded.store.close()
+    clean_env()
+
+
+@pytest.mark.asyncio
+async def test_user_service_login_storm_keeps_loop_responsive():
+    """
+    Patch relay shares the loop with logins, so loop lag during a burst of
+    logins is the latency added to every patch.
+    """
+    clean_env()
+    user_service = UserService(user_catalog, user_db,
+                               hash_pool=HashWorkerPool(workers=2))
+    await user_service.try_reg_user_async("admin", "admin1234")
+
+    start = time.perf_counter()
+    assert user_service.auth_user("admin", "admin1234") is True
+    hash_time = time.perf_counter() - start
+
+    # garbage of earlier tests is not collected during the storm
+    gc.collect()
+    lags = []
+    storm = asyncio.gather(*[user_service.auth_user_async("admin",
+                                                          "admin1234")
+                             for _ in range(8)])
+    while not storm.done():
+        tick = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - tick - 0.001)
+
+    assert all(await storm)
+    assert max(lags) < hash_time / 2
+    user_service.hash_pool.shutdown()
+    clean_env()
+
+
+@pytest.mark.asyncio
+async def test_user_service_index_skips_unchanged_directories():
+    clean_env()
+    manifest = user_catalog / "manifest.json"
+    user_service = UserService(user_catalog, user_db, manifest=manifest)
+    user_service.try_reg_user("admin", "admin1234")
+    user_service.try_reg_user("guest", "guest1234")
+    (user_catalog / "guest").mkdir(parents=True)
+    (user_catalog / "guest" / "on_disk").write_text("")
+    user_service.try_add_file("admin", "removed")
+    assert user_service.try_grant_access("admin", "guest", "removed")
+    assert user_service.index() == ["guest"]
+    assert user_service.get_owned_files("guest") == ["on_disk"]
+    user_service.store.close()
+
+    admin_dir = user_catalog / "admin"
+    stat = admin_dir.stat()
+    (admin_dir / "removed").unlink()
+    # a change the manifest cannot see, admin directory is not scanned
+    os.utime(admin_dir, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    user_service = UserService(user_catalog, user_db, manifest=manifest)
+    assert user_service.check_is_author("admin", "removed")
+    user_service.store.close()
+
+    (admin_dir / "added").write_text("")
+    user_service = UserService(user_catalog, user_db, manifest=manifest,
+                               index_on_start=False)
+    assert sorted(await user_service.index_async()) == ["admin", "guest"]
+    assert user_service.get_owned_files("admin") == ["added"]
+    assert user_service.get_shared_files("guest") == {"admin": []}
+    user_service.store.close()
+    clean_env()
@@ -0,0 +1,43 @@
+import pytest
+
+from user_store import SQLiteStore, TinyDBStore, UserStore, migrate
+
+
+def test_user_store_migrate_to_sqlite(tmp_path):
+    source = TinyDBStore(tmp_path / "users.json")
+    source.insert_user("alice", "hash_a")
+    source.insert_user("bob", "hash_b")
+    source.add_file("alice", "notes")
+    source.add_file("alice", "draft")
+    source.share_file("alice", "bob", "notes")
+
+    target = SQLiteStore(tmp_path / "users.db")
+    assert migrate(source, target) == 2
+    target.close()
+
+    target = SQLiteStore(tmp_path / "users.db")
+    for name in ("alice", "bob"):
+        assert target.get_user(name) == dict(source.get_user(name))
+    assert target.shared_files("bob") == {"alice": ["notes"]}
+    assert target.get_user("carol") is None
+
+
+def test_user_store_all_users_in_three_queries(tmp_path):
+    store = SQLiteStore(tmp_path / "users.db")
+    for name in ("alice", "bob", "carol"):
+        store.insert_user(name, f"hash_{name}")
+        store.add_file(name, f"{name}_notes")
+    store.share_file("alice", "bob", "alice_notes")
+    store.share_file("carol", "bob", "carol_notes")
+    statements = []
+    store.db.set_trace_callback(statements.append)
+
+    users = store.all_users()
+
+    assert len(statements) == 3
+    assert users == [store.get_user(name)
+                     for name in ("alice", "bob", "carol")]
+    assert users[1]["shared_files"] == {"alice": ["alice_notes"],
+                                        "carol": ["carol_notes"]}
+    with pytest.raises(TypeError):
+        UserStore()
@@ -0,0 +1,34 @@
+import json
+
+import wire_protocol
+from docengine import Doc
+from file_service import FileService
+
+
+def test_wire_protocol_patch_roundtrip():
+    doc = Doc(site=-7)
+    for patch in doc.insert_text(0, "ab€") + [doc.delete(1)]:
+        decoded = json.loads(patch)
+        body = wire_protocol.encode_patch(decoded)
+
+        assert wire_protocol.decode_patch(body) == decoded
+        assert len(body) < len(patch) / 2
+
+
+def test_wire_protocol_message_roundtrip():
+    file_id = FileService.get_file_id("admin", "doc")
+    patches = Doc(site=1).insert_text(0, "binary")
+    message = {"type": "file_request_response", "success": True,
+               "file_id": file_id, "version": 3, "content": patches}
+    frame = wire_protocol.encode_message(message)
+
+    assert wire_protocol.is_binary(frame)
+    assert wire_protocol.read_header(frame) == (wire_protocol.PATCHES,
+                                                file_id)
+    assert wire_protocol.decode_message(frame) == {
+        **message, "content": [json.loads(patch) for patch in patches]}
+
+    plain = {"type": "auth_response", "success": True}
+    assert wire_protocol.decode_message(
+        wire_protocol.encode_message(plain)) == plain
+    assert not wire_protocol.is_binary(json.dumps(plain).encode("utf-8"))
@@ -1,58 +1,245 @@
+import asyncio
+import json
 import logging
 import os
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
 
-from tinydb import Query, TinyDB
-from tinydb.operations import set
-
-from password_service import PasswordService
+from password_service import HashWorkerPool, PasswordService
+from user_store import UserStore, open_store
 
 
 class UserService:
     """
     Provides functionality to interact with user database,
     create new users, add/delete/index files, check permissions for owned
-    and shared files opening
+    and shared files opening.
+    All users are kept in memory, so reads and permission checks never
+    touch the database, and every change is written through to the store.
     """
 
-    def __init__(self, users_dir, db_name='users.json'):
-        db = TinyDB(db_name)
-        self.users = db.table('users')
+    def __init__(self, users_dir, db_name='users.json', hash_pool=None,
+                 store=None, manifest=None, index_workers=None,
+                 index_on_start=True):
+        """
+        :param users_dir: users files directory
+        :param db_name: path to user database, TinyDB for .json files,
+        SQLite for others
+        :param hash_pool: pool for password hashing of async methods
+        :param store: user storage backend, opened from db_name if None
+        :param manifest: path to the manifest of user directory mtimes,
+        every directory is scanned on index if None
+        :param index_workers: number of threads scanning user directories
+        :param index_on_start: index users directory in the constructor,
+        otherwise index or index_async has to be called later
+        :type users_dir: Path
+        :type db_name: str
+        :type hash_pool: HashWorkerPool
+        :type store: UserStore
+        :type manifest: Path
+        :type index_workers: int
+        :type index_on_start: bool
+        """
+        self.store = store or open_store(db_name)
+        self.hash_pool = hash_pool or HashWorkerPool()
         self.users_dir = users_dir
         self.users_dir.mkdir(parents=True, exist_ok=True)
-        self.cleanup()
-        self.index()
-
-    def cleanup(self) -> None:
-        """
-        Remove files that do not exist on disk from database
-        """
-        all_users = self.users.all()
-        for user in all_users:
-            for file in user["files"]:
-                if not (self.users_dir / user["name"] / file).is_file():
-                    logging.info(f"Removed non-existing file {file}.")
-                    user["files"].remove(file)
-            for owner in user["shared_files"].keys():
-                for file in user["shared_files"][owner]:
-                    if not (self.users_dir / owner / file).is_file():
-                        logging.info(f"Removed non-existing file {file}.")
-                        user["shared_files"][owner].remove(file)
-        self.users.write_back(all_users)
-
-    def index(self) -> None:
-        """
-        Index files on disk and if there are new files,
-        assign them to the users
-        """
-        all_users = self.users.all()
-        for user in all_users:
-            # if no directory, create one
-            (self.users_dir / user["name"]).mkdir(parents=True, exist_ok=True)
-            for filename in os.listdir(self.users_dir / user["name"]):
-                if filename not in user["files"]:
-                    user["files"].append(filename)
-        self.users.write_back(all_users)
+        # user entities by login
+        self.users: Dict[str, dict] = {}
+        # owned files and shared (owner, filename) pairs by login
+        self.owned: Dict[str, Set[str]] = {}
+        self.shared: Dict[str, Set[Tuple[str, str]]] = {}
+        self.manifest_path: Path or None = manifest
+        self.index_workers = index_workers or min(32, (os.cpu_count() or 1)
+                                                  * 4)
+        # mtimes of user directories and numbers of their files at the
+        # last index
+        self.manifest: Dict[str, list] = self.__load_manifest()
+        self.load()
+        if index_on_start:
+            self.index()
+
+    def load(self) -> None:
+        """
+        Load all users from the store to memory
+        """
+        self.users, self.owned, self.shared = {}, {}, {}
+        for user in self.store.all_users():
+            self.__cache_user(user)
+        logging.info(f"Loaded {len(self.users)} users")
+
+    def reload_user(self, username) -> None:
+        """
+        Reload user from the store, after it was changed by another
+        process
+        :type username: str
+        """
+        user = self.store.get_user(username)
+        if user is not None:
+            self.__cache_user(user)
+            return
+        self.users.pop(username, None)
+        self.owned.pop(username, None)
+        self.shared.pop(username, None)
+
+    def __cache_user(self, user) -> None:
+        """
+        Put user entity to memory
+        :type user: dict
+        """
+        user = {"name": user["name"], "pass_hash": user["pass_hash"],
+                "files": list(user["files"]),
+                "shared_files": {owner: list(files) for owner, files in
+                                 user["shared_files"].items()}}
+        self.users[user["name"]] = user
+        self.owned[user["name"]] = set(user["files"])
+        self.shared[user["name"]] = {
+            (owner, filename) for owner, files in
+            user["shared_files"].items() for filename in files}
+
+    def index(self, executor=None) -> List[str]:
+        """
+        Synchronize users' files with the users directory: remove files
+        that do not exist on disk and assign new files on disk to their
+        owners. Directories are scanned in parallel, directories that did
+        not change since the last index are skipped.
+        :param executor: executor to scan directories in, a pool of
+        index_workers threads by default
+        :type executor: Executor
+        :return: logins of users whose files changed
+        """
+        start = time.perf_counter()
+        if executor is None:
+            with ThreadPoolExecutor(self.index_workers) as executor:
+                scans = list(executor.map(self.__scan, list(self.users)))
+        else:
+            scans = list(executor.map(self.__scan, list(self.users)))
+        return self.__apply_scans(scans, start)
+
+    async def index_async(self, executor=None) -> List[str]:
+        """
+        Same as index, directories are scanned without blocking the event
+        loop, so that the server may index after it starts listening
+        :type executor: Executor
+        :return: logins of users whose files changed
+        """
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        if executor is None:
+            with ThreadPoolExecutor(self.index_workers) as executor:
+                scans = await asyncio.gather(*[
+                    loop.run_in_executor(executor, self.__scan, username)
+                    for username in list(self.users)])
+        else:
+            scans = await asyncio.gather(*[
+                loop.run_in_executor(executor, self.__scan, username)
+                for username in list(self.users)])
+        return self.__apply_scans(scans, start)
+
+    def __scan(self, username) -> Tuple[str, int, Dict[str, bool] or None]:
+        """
+        Stat directory of user and list it if it changed since the last
+        index, create it if there is none
+        :type username: str
+        :return: username, directory mtime and entries of the directory
+        mapped to whether they are files, None if it did not change
+        """
+        user_dir = self.users_dir / username
+        # if no directory, create one
+        user_dir.mkdir(parents=True, exist_ok=True)
+        # stat before listing, so that a change during listing is seen by
+        # the next index
+        mtime = user_dir.stat().st_mtime_ns
+        if self.manifest.get(username) == \
+                [mtime, len(self.users[username]["files"])]:
+            return username, mtime, None
+        with os.scandir(user_dir) as entries:
+            listing = {entry.name: entry.is_file() for entry in entries}
+        return username, mtime, listing
+
+    def __apply_scans(self, scans, start) -> List[str]:
+        """
+        Update users by listings of their directories in a single write
+        and save the manifest
+        :param scans: results of __scan
+        :param start: perf_counter value of index start
+        :type scans: List[Tuple[str, int, Dict[str, bool] or None]]
+        :type start: float
+        :return: logins of users whose files changed
+        """
+        listings = {username: listing for username, _, listing in scans
+                    if listing is not None}
+        changed = []
+        for user in self.users.values():
+            files = user["files"]
+            listing = listings.get(user["name"])
+            if listing is not None:
+                files = [file for file in files
+                         if self.__exists(user["name"], file, listings)]
+                known = set(files)
+                files += [filename for filename in listing
+                          if filename not in known]
+            shared_files = {owner: [file for file in files_of_owner
+                                    if self.__exists(owner, file, listings)]
+                            for owner, files_of_owner in
+                            user["shared_files"].items()}
+            if files != user["files"] or \
+                    shared_files != user["shared_files"]:
+                logging.info(f"Indexed changed files of {user['name']}")
+                changed.append({**user, "files": files,
+                                "shared_files": shared_files})
+        if changed:
+            self.store.update_users(changed)
+            for user in changed:
+                self.__cache_user(user)
+        self.manifest.update(
+            (username, [mtime, len(self.users[username]["files"])])
+            for username, mtime, _ in scans if username in self.users)
+        self.__save_manifest()
+        logging.info(f"Indexed {len(scans)} users in "
+                     f"{time.perf_counter() - start:.3f}s, scanned "
+                     f"{len(listings)}, updated {len(changed)}")
+        return [user["name"] for user in changed]
+
+    def __exists(self, owner, filename, listings) -> bool:
+        """
+        Check if owner's file exists by the listing of owner's directory.
+        Files missing from the listing, as created after it, and files of
+        unknown owners are checked on disk.
+        :type owner: str
+        :type filename: str
+        :type listings: Dict[str, Dict[str, bool]]
+        """
+        listing = listings.get(owner)
+        if listing is not None and filename in listing:
+            return listing[filename]
+        if listing is None and owner in self.users:
+            # directory did not change since the last index
+            return True
+        return (self.users_dir / owner / filename).is_file()
+
+    def __load_manifest(self) -> Dict[str, list]:
+        """
+        :return: mtimes of user directories and numbers of their files at
+        the last index
+        """
+        if self.manifest_path is None:
+            return {}
+        try:
+            with open(self.manifest_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    def __save_manifest(self) -> None:
+        if self.manifest_path is None:
+            return
+        temp_path = self.manifest_path.with_suffix(".tmp")
+        with open(temp_path, "w") as file:
+            json.dump(self.manifest, file)
+        os.replace(temp_path, self.manifest_path)
 
     def try_add_file(self, username, file) -> bool:
         """
@@ -72,9 +259,10 @@ class UserService:
             pass
         logging.info(f"File {file} created successfully")
 
-        exist_user = self.get_user(username)
-        exist_user["files"].append(file)
-        self.__save_field(username, 'files', exist_user["files"])
+        self.store.add_file(username, file)
+        if username in self.users and file not in self.owned[username]:
+            self.users[username]["files"].append(file)
+            self.owned[username].add(file)
         return True
 
     def try_reg_user(self, username, password) -> bool:
@@ -89,21 +277,48 @@ class UserService:
         if self.get_user(username):
             return False
         pass_hash = PasswordService.hash_password(password)
-        self.users.insert({"name": username,
-                           "pass_hash": pass_hash,
-                           "files": [],
-                           "shared_files": {}})
+        self.__insert_user(username, pass_hash)
+        return True
+
+    async def try_reg_user_async(self, username, password) -> bool:
+        """
+        Try to register user in database, password is hashed in the hash
+        pool without blocking the event loop.
+        :param username: user login
+        :param password: user password
+        :type username: str
+        :type password: str
+        :return: True if successful, otherwise False
+        """
+        if self.get_user(username):
+            return False
+        pass_hash = await self.hash_pool.hash_password(password)
+        # user could have been registered while password was hashed
+        if self.get_user(username):
+            return False
+        self.__insert_user(username, pass_hash)
         return True
 
-    def get_user(self, username) -> dict:
+    def __insert_user(self, username, pass_hash) -> None:
+        """
+        Insert new user without files to database
+        :param username: user login
+        :param pass_hash: hashed password
+        :type username: str
+        :type pass_hash: str
+        """
+        self.store.insert_user(username, pass_hash)
+        self.__cache_user({"name": username, "pass_hash": pass_hash,
+                           "files": [], "shared_files": {}})
+
+    def get_user(self, username) -> dict or None:
         """
-        Get user from database by username
+        Get user by username
         :param username: user login
         :type username: str
-        :return: user entity
+        :return: user entity, None if there is no such user
         """
-        User = Query()
-        return self.users.get(User.name == username)
+        return self.users.get(username)
 
     def auth_user(self, username, password) -> bool:
         """
@@ -120,6 +335,22 @@ class UserService:
         return PasswordService.verify_password(exist_user["pass_hash"],
                                                password)
 
+    async def auth_user_async(self, username, password) -> bool:
+        """
+        Authenticate user, password is verified in the hash pool without
+        blocking the event loop.
+        :param username: user login
+        :param password: provided password
+        :type username: str
+        :type password: str
+        :return: True if successful, otherwise False
+        """
+        exist_user = self.get_user(username)
+        if not exist_user:
+            return False
+        return await self.hash_pool.verify_password(exist_user["pass_hash"],
+                                                    password)
+
     def check_is_author(self, username, filename) -> bool:
         """
         Check if user owns a file with specified filename
@@ -129,8 +360,7 @@ class UserService:
         :type filename: str
         :return: True if user owns a file, otherwise False
         """
-        exist_user = self.get_user(username)
-        return filename in exist_user["files"]
+        return filename in self.owned.get(username, ())
 
     def has_access(self, owner, username, filename) -> bool:
         """
@@ -143,9 +373,7 @@ class UserService:
         :type filename: str
         :return: True if user has access, otherwise False
         """
-        user = self.get_user(username)
-        return (owner in user["shared_files"].keys()) and (
-                filename in user["shared_files"][owner])
+        return (owner, filename) in self.shared.get(username, ())
 
     def try_grant_access(self, owner, username, filename) -> bool:
         """
@@ -161,40 +389,25 @@ class UserService:
         """
         if username == owner:
             return False
-        user = self.get_user(username)
-        if user is None:
+        if username not in self.users:
             return False
-        if not user["shared_files"].get(owner):
-            user["shared_files"][owner] = []
-        if filename not in user["shared_files"][owner]:
-            user["shared_files"][owner].append(filename)
-        self.__save_field(username, 'shared_files', user["shared_files"])
+        if (owner, filename) in self.shared[username]:
+            return True
+        self.store.share_file(owner, username, filename)
+        self.users[username]["shared_files"].setdefault(owner, []) \
+            .append(filename)
+        self.shared[username].add((owner, filename))
         return True
 
-    def __save_field(self, username, field_name, value) -> None:
-        """
-        Set field of user entity to the value provided
-        :param username: user login
-        :param field_name: user's field name
-        :param value: value to set
-        :type username: str
-        :type field_name: str
-        :type value: Any
-        """
-        User = Query()
-        logging.info(f"Updating {username} field {field_name} with value "
-                     f"{value}")
-        self.users.update(set(field_name, value), User.name == username)
-
-    def get_shared_files(self, username) -> List[dict]:
+    def get_shared_files(self, username) -> Dict[str, List[str]]:
         """
-        Get list of files shared with user
+        Get files shared with user
         :param username: user login
         :type username: str
-        :return: List of dictionaries, with owners as keys and files as items
+        :return: Dictionary with owners as keys and lists of files as items
         """
-        user = self.get_user(username)
-        return user["shared_files"]
+        return {owner: list(files) for owner, files in
+                self.users[username]["shared_files"].items()}
 
     def get_owned_files(self, username) -> List[str]:
         """
@@ -203,5 +416,4 @@ class UserService:
         :type username: str
         :return: List of filenames owned by user
         """
-        user = self.get_user(username)
-        return user["files"]
+        return list(self.users[username]["files"])
@@ -0,0 +1,316 @@
+import logging
+import sqlite3
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List
+
+from tinydb import Query, TinyDB
+from tinydb.operations import set
+
+
+class UserStore(ABC):
+    """
+    Storage backend of UserService. User entity is a dict with name,
+    pass_hash, list of owned files and shared_files dict, that maps owner
+    login to the list of owner's files shared with the user.
+    Permissions are checked by UserService on users it loads to memory.
+    """
+
+    @abstractmethod
+    def get_user(self, username) -> dict or None:
+        """
+        :type username: str
+        :return: user entity, None if there is no such user
+        """
+
+    @abstractmethod
+    def all_users(self) -> List[dict]:
+        """
+        :return: all user entities in insertion order
+        """
+
+    @abstractmethod
+    def count(self) -> int:
+        """
+        :return: number of users
+        """
+
+    @abstractmethod
+    def insert_user(self, username, pass_hash) -> None:
+        """
+        Insert new user without files
+        :type username: str
+        :type pass_hash: str
+        """
+
+    @abstractmethod
+    def update_users(self, users) -> None:
+        """
+        Replace owned and shared files of users with the ones of provided
+        user entities, in a single write
+        :type users: List[dict]
+        """
+
+    @abstractmethod
+    def add_file(self, username, filename) -> None:
+        """
+        Add file to files owned by user
+        :type username: str
+        :type filename: str
+        """
+
+    @abstractmethod
+    def share_file(self, owner, username, filename) -> None:
+        """
+        Share file of owner with user
+        :type owner: str
+        :type username: str
+        :type filename: str
+        """
+
+    @abstractmethod
+    def import_users(self, users) -> int:
+        """
+        Insert user entities with their files, in a single write
+        :type users: List[dict]
+        :return: number of imported users
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class TinyDBStore(UserStore):
+    """
+    Users in a TinyDB JSON table. Every lookup scans the table and every
+    write serializes the whole database.
+    """
+
+    def __init__(self, db_name) -> None:
+        """
+        :param db_name: path to database file
+        :type db_name: str or Path
+        """
+        self.db = TinyDB(db_name)
+        self.users = self.db.table('users')
+
+    def get_user(self, username) -> dict or None:
+        User = Query()
+        return self.users.get(User.name == username)
+
+    def all_users(self) -> List[dict]:
+        return self.users.all()
+
+    def count(self) -> int:
+        return len(self.users)
+
+    def insert_user(self, username, pass_hash) -> None:
+        self.users.insert({"name": username,
+                           "pass_hash": pass_hash,
+                           "files": [],
+                           "shared_files": {}})
+
+    def update_users(self, users) -> None:
+        changed = {user["name"]: user for user in users}
+        all_users = self.users.all()
+        for user in all_users:
+            if user["name"] in changed:
+                user["files"] = changed[user["name"]]["files"]
+                user["shared_files"] = changed[user["name"]]["shared_files"]
+        self.users.write_back(all_users)
+
+    def add_file(self, username, filename) -> None:
+        user = self.get_user(username)
+        if filename not in user["files"]:
+            user["files"].append(filename)
+        self.__save_field(username, 'files', user["files"])
+
+    def share_file(self, owner, username, filename) -> None:
+        user = self.get_user(username)
+        if not user["shared_files"].get(owner):
+            user["shared_files"][owner] = []
+        if filename not in user["shared_files"][owner]:
+            user["shared_files"][owner].append(filename)
+        self.__save_field(username, 'shared_files', user["shared_files"])
+
+    def import_users(self, users) -> int:
+        self.users.insert_multiple(
+            {"name": user["name"], "pass_hash": user["pass_hash"],
+             "files": list(user["files"]),
+             "shared_files": {owner: list(files) for owner, files in
+                              user["shared_files"].items()}}
+            for user in users)
+        return len(users)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __save_field(self, username, field_name, value) -> None:
+        """
+        Set field of user entity to the value provided
+        :param username: user login
+        :param field_name: user's field name
+        :param value: value to set
+        :type username: str
+        :type field_name: str
+        :type value: Any
+        """
+        User = Query()
+        logging.info(f"Updating {username} field {field_name} with value "
+                     f"{value}")
+        self.users.update(set(field_name, value), User.name == username)
+
+
+class SQLiteStore(UserStore):
+    """
+    Users in a SQLite database in WAL mode: users table keyed by name and
+    normalized tables of owned and shared files with unique indexes, so
+    lookups and writes touch only the rows they need.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            name TEXT PRIMARY KEY,
+            pass_hash TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS owned_files (
+            owner TEXT NOT NULL REFERENCES users(name),
+            filename TEXT NOT NULL,
+            UNIQUE (owner, filename)
+        );
+        CREATE TABLE IF NOT EXISTS shared_files (
+            username TEXT NOT NULL REFERENCES users(name),
+            owner TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            UNIQUE (username, owner, filename)
+        );
+    """
+
+    def __init__(self, db_name) -> None:
+        """
+        :param db_name: path to database file
+        :type db_name: str or Path
+        """
+        self.db = sqlite3.connect(str(db_name))
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+
+    def get_user(self, username) -> dict or None:
+        row = self.db.execute("SELECT name, pass_hash FROM users "
+                              "WHERE name = ?", (username,)).fetchone()
+        if row is None:
+            return None
+        return {"name": row[0], "pass_hash": row[1],
+                "files": self.owned_files(username),
+                "shared_files": self.shared_files(username)}
+
+    def all_users(self) -> List[dict]:
+        users = {name: {"name": name, "pass_hash": pass_hash, "files": [],
+                        "shared_files": {}}
+                 for name, pass_hash in self.db.execute(
+                     "SELECT name, pass_hash FROM users ORDER BY rowid")}
+        for owner, filename in self.db.execute(
+                "SELECT owner, filename FROM owned_files ORDER BY rowid"):
+            users[owner]["files"].append(filename)
+        for username, owner, filename in self.db.execute(
+                "SELECT username, owner, filename FROM shared_files "
+                "ORDER BY rowid"):
+            users[username]["shared_files"].setdefault(owner, []).append(
+                filename)
+        return list(users.values())
+
+    def count(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def insert_user(self, username, pass_hash) -> None:
+        with self.db:
+            self.db.execute("INSERT INTO users (name, pass_hash) "
+                            "VALUES (?, ?)", (username, pass_hash))
+
+    def update_users(self, users) -> None:
+        with self.db:
+            for user in users:
+                self.db.execute("DELETE FROM owned_files WHERE owner = ?",
+                                (user["name"],))
+                self.db.execute("DELETE FROM shared_files WHERE username = ?",
+                                (user["name"],))
+                self.__insert_files(user)
+
+    def add_file(self, username, filename) -> None:
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO owned_files "
+                            "(owner, filename) VALUES (?, ?)",
+                            (username, filename))
+
+    def share_file(self, owner, username, filename) -> None:
+        with self.db:
+            self.db.execute("INSERT OR IGNORE INTO shared_files "
+                            "(username, owner, filename) VALUES (?, ?, ?)",
+                            (username, owner, filename))
+
+    def owned_files(self, username) -> List[str]:
+        return [row[0] for row in self.db.execute(
+            "SELECT filename FROM owned_files WHERE owner = ? ORDER BY rowid",
+            (username,))]
+
+    def shared_files(self, username) -> Dict[str, List[str]]:
+        shared: Dict[str, List[str]] = {}
+        for owner, filename in self.db.execute(
+                "SELECT owner, filename FROM shared_files WHERE username = ? "
+                "ORDER BY rowid", (username,)):
+            shared.setdefault(owner, []).append(filename)
+        return shared
+
+    def import_users(self, users) -> int:
+        with self.db:
+            self.db.executemany("INSERT INTO users (name, pass_hash) "
+                                "VALUES (?, ?)",
+                                [(user["name"], user["pass_hash"])
+                                 for user in users])
+            for user in users:
+                self.__insert_files(user)
+        return len(users)
+
+    def close(self) -> None:
+        self.db.close()
+
+    def __insert_files(self, user) -> None:
+        """
+        Insert owned and shared files of user entity, inside transaction
+        :type user: dict
+        """
+        self.db.executemany("INSERT OR IGNORE INTO owned_files "
+                            "(owner, filename) VALUES (?, ?)",
+                            [(user["name"], filename)
+                             for filename in user["files"]])
+        self.db.executemany("INSERT OR IGNORE INTO shared_files "
+                            "(username, owner, filename) VALUES (?, ?, ?)",
+                            [(user["name"], owner, filename)
+                             for owner, files in user["shared_files"].items()
+                             for filename in files])
+
+
+def open_store(db_name) -> UserStore:
+    """
+    Open user store by database file extension: TinyDB for .json files,
+    SQLite for any other
+    :type db_name: str or Path
+    """
+    if Path(db_name).suffix == ".json":
+        return TinyDBStore(db_name)
+    return SQLiteStore(db_name)
+
+
+def migrate(source, target) -> int:
+    """
+    Copy all users of source store to empty target store
+    :type source: UserStore
+    :type target: UserStore
+    :return: number of migrated users
+    """
+    if target.count():
+        raise ValueError("Target user store is not empty")
+    users = source.all_users()
+    migrated = target.import_users(users)
+    logging.info(f"Migrated {migrated} users")
+    return migrated
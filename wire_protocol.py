@@ -0,0 +1,269 @@
+"""
+Compact binary encoding of messages, negotiated per connection at login
+with "protocol": "binary". JSON messages are the fallback and can always
+be told apart, as they start with "{".
+
+Frames start with a kind byte:
+ * PATCH: file id (28 bytes) and a patch body. Relay only needs the kind
+   and the file id, the body is forwarded as is.
+ * PATCHES: file id, JSON header of the message without content and
+   length-prefixed patch bodies of the content, used for file snapshots
+   and for patch_batch messages.
+ * MESSAGE: any other message as JSON.
+
+Patch body: op byte, clock, depth, pos of every level, number of sites
+and zigzag encoded sites as varints, followed by UTF-8 char.
+"""
+import json
+import struct
+from typing import Dict, List, Tuple
+
+JSON = "json"
+BINARY = "binary"
+
+PATCH = 1
+PATCHES = 2
+MESSAGE = 3
+
+FILE_ID_SIZE = 28
+HEADER_SIZE = 1 + FILE_ID_SIZE
+LENGTH = struct.Struct(">I")
+
+
+def is_binary(frame) -> bool:
+    """
+    Check if frame is in binary encoding
+    :type frame: bytes
+    """
+    return bool(frame) and frame[0] in (PATCH, PATCHES, MESSAGE)
+
+
+def read_header(frame) -> Tuple[int, str or None]:
+    """
+    Read routing header of binary frame
+    :type frame: bytes
+    :return: frame kind and file id, file id is None for MESSAGE frames
+    """
+    kind = frame[0]
+    if kind == MESSAGE:
+        return kind, None
+    if len(frame) < HEADER_SIZE:
+        raise ValueError("Frame is too short")
+    return kind, frame[1:HEADER_SIZE].hex()
+
+
+def encode_patch(patch) -> bytes:
+    """
+    Encode patch body
+    :param patch: decoded patch
+    :type patch: dict
+    """
+    out = bytearray(patch["op"].encode("ascii"))
+    _write_uvarint(out, patch["clock"])
+    _write_uvarint(out, len(patch["pos"]))
+    for pos in patch["pos"]:
+        _write_uvarint(out, pos)
+    _write_uvarint(out, len(patch["sites"]))
+    for site in patch["sites"]:
+        _write_uvarint(out, (site << 1) ^ (site >> 63))
+    out += patch["char"].encode("utf-8")
+    return bytes(out)
+
+
+def decode_patch(body) -> Dict:
+    """
+    Decode patch body
+    :type body: bytes
+    :return: patch in the same shape as JSON patches
+    """
+    try:
+        op = chr(body[0])
+        clock, offset = _read_uvarint(body, 1)
+        depth, offset = _read_uvarint(body, offset)
+        pos = []
+        for _ in range(depth):
+            value, offset = _read_uvarint(body, offset)
+            pos.append(value)
+        sites_len, offset = _read_uvarint(body, offset)
+        sites = []
+        for _ in range(sites_len):
+            value, offset = _read_uvarint(body, offset)
+            sites.append((value >> 1) ^ -(value & 1))
+        char = body[offset:].decode("utf-8")
+    except IndexError:
+        raise ValueError("Truncated patch")
+    return {"op": op, "char": char, "pos": pos, "sites": sites,
+            "clock": clock}
+
+
+def encode_patch_frame(file_id, patch) -> bytes:
+    """
+    :type file_id: str
+    :param patch: decoded patch
+    :type patch: dict
+    :return: PATCH frame
+    """
+    return bytes([PATCH]) + bytes.fromhex(file_id) + encode_patch(patch)
+
+
+def encode_message(message) -> bytes:
+    """
+    Encode message to binary frame. Messages with file id and a list of
+    JSON encoded or decoded patches as content are encoded as PATCHES
+    frames.
+    :type message: dict
+    """
+    content = message.get("content")
+    if not isinstance(content, list) or not message.get("file_id"):
+        return bytes([MESSAGE]) + json.dumps(message).encode("utf-8")
+    header = json.dumps({key: value for key, value in message.items()
+                         if key != "content"}).encode("utf-8")
+    out = bytearray([PATCHES])
+    out += bytes.fromhex(message["file_id"])
+    out += LENGTH.pack(len(header))
+    out += header
+    for patch in content:
+        body = encode_patch(patch if isinstance(patch, dict) else
+                            json.loads(patch))
+        _write_uvarint(out, len(body))
+        out += body
+    return bytes(out)
+
+
+def decode_message(frame) -> Dict:
+    """
+    Decode MESSAGE or PATCHES frame. Content of PATCHES frame is decoded
+    to a list of patch dicts.
+    :type frame: bytes
+    """
+    kind = frame[0]
+    if kind == MESSAGE:
+        return json.loads(frame[1:].decode("utf-8"))
+    if kind != PATCHES:
+        raise ValueError(f"Frame of kind {kind} is not a message")
+    offset = HEADER_SIZE + LENGTH.size
+    if len(frame) < offset:
+        raise ValueError("Frame is too short")
+    header_len, = LENGTH.unpack_from(frame, HEADER_SIZE)
+    message = json.loads(frame[offset:offset + header_len].decode("utf-8"))
+    message["content"] = decode_patches(frame[offset + header_len:])
+    return message
+
+
+def decode_patches(data) -> List[Dict]:
+    """
+    Decode sequence of length-prefixed patch bodies
+    :type data: bytes
+    """
+    patches = []
+    offset = 0
+    while offset < len(data):
+        try:
+            length, offset = _read_uvarint(data, offset)
+        except IndexError:
+            raise ValueError("Truncated patch length")
+        patches.append(decode_patch(data[offset:offset + length]))
+        offset += length
+    return patches
+
+
+class PatchFrames:
+    """
+    Frames of a relayed patch for every protocol. Frame that came from the
+    sender is relayed as is, frames for other protocols are encoded once,
+    when the first peer using that protocol needs it.
+    """
+
+    def __init__(self, file_id, frames, patch=None, content=None) -> None:
+        """
+        :param file_id: unique id of the file
+        :param frames: known frames by protocol
+        :param patch: decoded patch
+        :param content: JSON encoded patch
+        :type file_id: str
+        :type frames: Dict[str, bytes]
+        :type patch: dict
+        :type content: str
+        """
+        self.file_id = file_id
+        self.frames = frames
+        self.patch = patch
+        self.content = content
+
+    def get(self, protocol) -> bytes:
+        """
+        :param protocol: JSON or BINARY
+        :type protocol: str
+        """
+        frame = self.frames.get(protocol)
+        if frame is None:
+            frame = self.encode(protocol)
+            self.frames[protocol] = frame
+        return frame
+
+    def encode(self, protocol) -> bytes:
+        """
+        Encode frame for protocol the sender did not use
+        :type protocol: str
+        """
+        if protocol == BINARY:
+            if self.patch is None:
+                self.patch = json.loads(self.content)
+            return encode_patch_frame(self.file_id, self.patch)
+        if self.content is None:
+            self.content = json.dumps(self.patch, sort_keys=True)
+        return json.dumps({"type": "patch", "file_id": self.file_id,
+                           "content": self.content}).encode("utf-8")
+
+
+class BatchFrames(PatchFrames):
+    """
+    Frames of a relayed patch_batch message: a single PATCHES frame or
+    a single JSON message with the list of patches as content. Patch and
+    content are lists of decoded and of JSON encoded patches.
+    """
+
+    def encode(self, protocol) -> bytes:
+        if protocol == BINARY:
+            if self.patch is None:
+                self.patch = [json.loads(patch) for patch in self.content]
+            return encode_message({"type": "patch_batch",
+                                   "file_id": self.file_id,
+                                   "content": self.patch})
+        if self.content is None:
+            self.content = [json.dumps(patch, sort_keys=True)
+                            for patch in self.patch]
+        return json.dumps({"type": "patch_batch", "file_id": self.file_id,
+                           "content": self.content}).encode("utf-8")
+
+
+def _write_uvarint(out, value) -> None:
+    """
+    Append unsigned LEB128 varint to out
+    :type out: bytearray
+    :type value: int
+    """
+    if value < 0:
+        raise ValueError("Negative value for unsigned varint")
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_uvarint(data, offset) -> Tuple[int, int]:
+    """
+    Read unsigned LEB128 varint
+    :type data: bytes
+    :type offset: int
+    :return: value and offset after it
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7